@@ -49,6 +49,13 @@ def _build_arg_parser():
         '-outputDirectory',
         help='If this is given, separated clusters will be output under this folder. The output directory will be created if it does not exist.')
 
+    parser.add_argument(
+        '-compression', action="store", dest="writeProfile", choices=["fast", "small", "archive"],
+        help='Write profile for output vtp files: fast (LZ4), small (zlib level 9) or archive (LZMA level 9). By default the vtk writer defaults are used.')
+    parser.add_argument(
+        '-float32', action='store_true', dest="flag_float32",
+        help='Write double precision points and data arrays of output files as float.')
+
     return parser
 
 
@@ -84,17 +91,7 @@ def main():
                     print('  -- HemisphereLocation is in the input data: skip updating the vtk file.')
                     return inpd
     
-        vtk_array = vtk.vtkDoubleArray()
-        vtk_array.SetName('HemisphereLocation')
-    
-        inpd.GetLines().InitTraversal()
-        for lidx in range(0, inpd.GetNumberOfLines()):
-            ptids = vtk.vtkIdList()
-            inpd.GetLines().GetNextCell(ptids)
-            for pidx in range(0, ptids.GetNumberOfIds()):
-                vtk_array.InsertNextTuple1(mask_location[lidx])
-    
-        inpd.GetPointData().AddArray(vtk_array)
+        wma.filter.add_point_data_array(inpd, mask_location, 'HemisphereLocation', array_type=vtk.VTK_DOUBLE)
         # inpd.Update()
     
         return inpd
@@ -283,7 +280,7 @@ def main():
         
              # Update the input vtk file
             pd = write_mask_location_to_vtk(pd, mask_location)
-            wma.io.write_polydata(pd, fname)
+            wma.io.write_polydata(pd, fname, profile=args.writeProfile, float32=args.flag_float32)
     
         # for sanity check 
         if len(np.where(mask_location ==0)[0]) > 1:
@@ -306,11 +303,11 @@ def main():
             pd_commissure = wma.filter.mask(pd, mask_commissure, preserve_point_data=True, preserve_cell_data=True, verbose=False)
     
             fname_output = os.path.join(outdir_right, fname_base)
-            wma.io.write_polydata(pd_right, fname_output)
+            wma.io.write_polydata(pd_right, fname_output, profile=args.writeProfile, float32=args.flag_float32)
             fname_output = os.path.join(outdir_left, fname_base)
-            wma.io.write_polydata(pd_left, fname_output)
+            wma.io.write_polydata(pd_left, fname_output, profile=args.writeProfile, float32=args.flag_float32)
             fname_output = os.path.join(outdir_commissure, fname_base)
-            wma.io.write_polydata(pd_commissure, fname_output)
+            wma.io.write_polydata(pd_commissure, fname_output, profile=args.writeProfile, float32=args.flag_float32)
     
     f = open(os.path.join(args.inputDirectory, 'cluster_location_by_hemisphere.log'), 'a')
     f.write('<wm_assess_cluster_location_by_hemisphere.py> Done!!!')
@@ -48,6 +48,19 @@ def _build_arg_parser():
         '-norender', action='store_true', dest="flag_norender",
         help='No Render. Prevents rendering of images that would require an X connection.')
 
+    parser.add_argument(
+        '-compression', action="store", dest="writeProfile", choices=["fast", "small", "archive"],
+        help='Write profile for output vtp files: fast (LZ4), small (zlib level 9) or archive (LZMA level 9). By default the vtk writer defaults are used.')
+    parser.add_argument(
+        '-float32', action='store_true', dest="flag_float32",
+        help='Write double precision points and data arrays of output files as float.')
+    parser.add_argument(
+        '-cache', action="store", dest="cacheDirectory",
+        help='Directory of an on-disk cache of preprocessed and resampled subject data, shared between runs. Results of steps with identical inputs and parameters are reused.')
+    parser.add_argument(
+        '-cache_size', action="store", dest="cacheSize", type=float, default=10,
+        help='Maximum size of the cache in GB. Least recently used entries are removed beyond this size. Default is 10.')
+
     return parser
 
 
@@ -61,6 +74,9 @@ def main():
     parser = _build_arg_parser()
     args = _parse_args(parser)
 
+    if args.cacheDirectory is not None:
+        wma.cache.enable_cache(args.cacheDirectory, max_size=int(args.cacheSize * 1024 ** 3))
+
     if not os.path.exists(args.inputFile):
         print(f"<{os.path.basename(__file__)}> Error: Input file", args.inputFile, "does not exist.")
         exit()
@@ -256,7 +272,7 @@ def main():
         # prepend the output directory
         fname_c = os.path.join(outdir, fname_c)
         cluster_fnames.append(fname_c)
-        wma.io.write_polydata(pd_c, fname_c)
+        wma.io.write_polydata(pd_c, fname_c, profile=args.writeProfile, float32=args.flag_float32)
         color_c = color[mask,:]
         if cluster_size:
             cluster_colors.append(np.mean(color_c,0))
@@ -302,6 +318,9 @@ def main():
     
     print("\n==========================")
     print(f'<{os.path.basename(__file__)}> Done clustering subject.  See output in directory:\n ', outdir, '\n')
+
+    if args.cacheDirectory is not None:
+        print(wma.cache.get_cache().report())
     
     
 if __name__ == '__main__':
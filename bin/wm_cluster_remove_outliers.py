@@ -40,6 +40,13 @@ def _build_arg_parser():
         '-j', action="store", dest="numberOfJobs", type=str,
         help='Number of processors to use.')
 
+    parser.add_argument(
+        '-compression', action="store", dest="writeProfile", choices=["fast", "small", "archive"],
+        help='Write profile for output vtp files: fast (LZ4), small (zlib level 9) or archive (LZMA level 9). By default the vtk writer defaults are used.')
+    parser.add_argument(
+        '-float32', action='store_true', dest="flag_float32",
+        help='Write double precision points and data arrays of output files as float.')
+
     return parser
 
 
@@ -166,7 +173,7 @@ def main():
 
         # if either cluster is empty, we have to skip outlier removal
         if number_fibers_in_subject_cluster == 0:
-            wma.io.write_polydata(pd_subject, pd_out_fname)
+            wma.io.write_polydata(pd_subject, pd_out_fname, profile=args.writeProfile, float32=args.flag_float32)
             print(f"cluster {c} empty in subject")
             log_str = f'{str(c)} \t {str(number_fibers_in_subject_cluster)} \t 0 \t 0 \t 0 \t 0 \t 0 \t 0 \t 0'
             
@@ -175,7 +182,7 @@ def main():
         if number_fibers_in_atlas_cluster == 0:
             # this should not ever happen. Note that "outlier removed" atlas is temporary and should not be used for classification.
             # (Note the other option is to remove this cluster as it was removed at the end of the iteration for the atlas.)
-            wma.io.write_polydata(pd_subject, pd_out_fname)
+            wma.io.write_polydata(pd_subject, pd_out_fname, profile=args.writeProfile, float32=args.flag_float32)
             print(f"cluster {c} empty in atlas")
             print("ERROR: An atlas should not contain empty clusters. Please use the initial_clusters atlas for this outlier removal script and for subject clustering.")
             log_str = f'{str(c)} \t {str(number_fibers_in_subject_cluster)} \t 0 \t 0 \t 0 \t 0 \t 0 \t 0 \t 0'
@@ -244,7 +251,7 @@ def main():
         mask[reject_idx] = 0
         #print mask, number_fibers_in_subject_cluster, mask.shape, pd_subject.GetNumberOfLines()
         pd_c = wma.filter.mask(pd_subject, mask, verbose=False, preserve_point_data=True, preserve_cell_data=True)
-        wma.io.write_polydata(pd_c, pd_out_fname)
+        wma.io.write_polydata(pd_c, pd_out_fname, profile=args.writeProfile, float32=args.flag_float32)
 
         cluster_distances = np.sqrt(cluster_distances)
         cluster_mean_distances = np.mean(cluster_distances, axis=0)
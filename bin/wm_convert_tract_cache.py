@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import multiprocessing
+import os
+
+from joblib import Parallel, delayed
+
+import whitematteranalysis as wma
+
+
+def _build_arg_parser():
+
+    parser = argparse.ArgumentParser(
+        description="Converts tractography files between vtkPolyData (vtk/vtp) and the native whitematteranalysis cache format (.wmt). The cache stores points, line offsets and point/cell data as raw little-endian arrays that are memory mapped on reading, so repeated pipelines over the same subjects do not pay the vtk/vtp parsing cost.",
+        epilog="Written by Lauren O\'Donnell, odonnell@bwh.harvard.edu")
+    parser.add_argument(
+        'inputDirectory',
+        help='Contains tractography as vtkPolyData (vtk/vtp) file(s), or .wmt cache directories when converting back.')
+    parser.add_argument(
+        'outputDirectory',
+        help='The output directory should be a new empty directory. It will be created if needed.')
+    parser.add_argument(
+        '-format', action="store", dest="outputFormat", default="wmt", choices=["wmt", "vtk", "vtp"],
+        help='Output format. Default is wmt (cache). If vtk or vtp, input .wmt caches are converted back to vtkPolyData.')
+    parser.add_argument(
+        '-j', action="store", dest="numberOfJobs", type=int,
+        help='Number of processors to use.')
+
+    return parser
+
+
+def _parse_args(parser):
+
+    return parser.parse_args()
+
+
+def main():
+
+    parser = _build_arg_parser()
+    args = _parse_args(parser)
+
+    if not os.path.isdir(args.inputDirectory):
+        print(f"Error: Input directory {args.inputDirectory} does not exist.")
+        exit()
+
+    outdir = args.outputDirectory
+    if not os.path.exists(outdir):
+        print(f"Output directory {outdir} does not exist, creating it.")
+        os.makedirs(outdir)
+
+    if args.numberOfJobs is not None:
+        parallel_jobs = args.numberOfJobs
+    else:
+        parallel_jobs = multiprocessing.cpu_count()
+
+    print(f"{os.path.basename(__file__)}. Converting tractography to {args.outputFormat} format.")
+    print(f"=====input directory======\n {args.inputDirectory}")
+    print(f"=====output directory=====\n {args.outputDirectory}")
+    print(f'Using N jobs: {parallel_jobs}')
+    print("==========================")
+
+    if args.outputFormat == "wmt":
+        input_fnames = wma.io.list_vtk_files(args.inputDirectory)
+    else:
+        input_fnames = wma.io.list_tract_cache_files(args.inputDirectory)
+
+    print(f"<{os.path.basename(__file__)}> Input number of files: {len(input_fnames)}")
+
+    def convert(in_fname):
+        subject_id = os.path.splitext(os.path.basename(os.path.normpath(in_fname)))[0]
+        out_fname = os.path.join(outdir, f"{subject_id}.{args.outputFormat}")
+        print(f"<{os.path.basename(__file__)}> {in_fname} -> {out_fname}")
+        if args.outputFormat == "wmt":
+            wma.io.write_tract_cache(wma.io.read_polydata(in_fname), out_fname)
+        else:
+            wma.io.write_polydata(wma.io.read_polydata(in_fname), out_fname)
+
+    Parallel(n_jobs=parallel_jobs, verbose=0)(
+        delayed(convert)(in_fname) for in_fname in input_fnames)
+
+    print(f"<{os.path.basename(__file__)}> Done converting {len(input_fnames)} files.")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,7 @@ import whitematteranalysis as wma
 def _build_arg_parser():
 
     parser = argparse.ArgumentParser(
-        description="Harden transform with Slicer.",
+        description="Harden transform into tractography (vtk/vtp) files. ITK affine and B-spline transforms (.tfm/.txt) and displacement fields (.nii/.nii.gz) are applied natively to the points and tensors of all files in one process pool. 3D Slicer is only needed with -engine slicer.",
         epilog="Written by Fan Zhang, fzhang@bwh.harvard.edu")
     parser.add_argument(
         'inputDirectory',
@@ -21,8 +21,8 @@ def _build_arg_parser():
         'outputDirectory',
         help='Directory of output transformed results.')
     parser.add_argument(
-        'Slicer',
-        help='Path of 3D Slicer.')
+        'Slicer', nargs='?',
+        help='Path of 3D Slicer. Only used with -engine slicer.')
     parser.add_argument(
         '-t', dest="transform_file",
         help='Individual transform matrix file. If this is assigned, all input files will be transformed with this transform matrix.')
@@ -35,6 +35,15 @@ def _build_arg_parser():
     parser.add_argument(
         '-j', action="store", dest="numberOfJobs", type=int,
         help='Number of processors to use.')
+    parser.add_argument(
+        '-engine', action="store", dest="engine", default="native", choices=["native", "slicer"],
+        help='native (default) applies the transforms in this process pool. slicer runs 3D Slicer for the inputs, as in older versions.')
+    parser.add_argument(
+        '-compression', action="store", dest="writeProfile", choices=["fast", "small", "archive"],
+        help='Write profile for output vtp files: fast (LZ4), small (zlib level 9) or archive (LZMA level 9). By default the vtk writer defaults are used. Native engine only.')
+    parser.add_argument(
+        '-float32', action='store_true', dest="flag_float32",
+        help='Write double precision points and data arrays of output files as float. Native engine only.')
 
     return parser
 
@@ -59,10 +68,13 @@ def main():
         print(f"Output directory {args.outputDirectory} does not exist, creating it.")
         os.makedirs(outdir)
     
-    slicer_path = os.path.abspath(args.Slicer)
-    if not os.path.exists(args.Slicer):
-        print(f"Error: 3D Slicer {args.Slicer} does not exist.")
-        exit()
+    if args.engine == 'slicer':
+        if args.Slicer is None or not os.path.exists(args.Slicer):
+            print(f"Error: 3D Slicer {args.Slicer} does not exist.")
+            exit()
+        slicer_path = os.path.abspath(args.Slicer)
+    else:
+        slicer_path = None
     
     if (args.transform_file is None and args.transform_folder is None) or \
         (args.transform_file is not None and args.transform_folder is not None):
@@ -102,7 +114,9 @@ def main():
     print("")
     print(f"=====input directory======\n {inputdir}")
     print(f"=====output directory=====\n {outdir}")
-    print(f"=====3D Slicer====\n {slicer_path}")
+    print(f"=====Engine====\n {args.engine}")
+    if args.engine == 'slicer':
+        print(f"=====3D Slicer====\n {slicer_path}")
     print(f"=====Way of transform====\n {transform_way}")
     print(f"=====Inverse? ====\n {inverse}")
     print(f"=====Transform file(s) path====\n {transform_path}")
@@ -119,7 +133,17 @@ def main():
     
         os.system(cmd)
     
-    if transform_way == 'multiple':
+    if args.engine == 'native':
+        if transform_way == 'multiple':
+            for polydata, transform in zip(input_polydatas, input_transforms):
+                print(f"====== {transform} <TO> {polydata}")
+            failures = wma.harden.harden_transform_directory(input_polydatas, input_transforms, outdir, inverse, number_of_jobs, args.writeProfile, args.flag_float32)
+        else:
+            print(f"====== {transform_path} will be applied to all inputs.\n")
+            failures = wma.harden.harden_transform_directory(input_polydatas, transform_path, outdir, inverse, number_of_jobs, args.writeProfile, args.flag_float32)
+        if failures:
+            print(f"Error: {len(failures)} inputs could not be transformed.")
+    elif transform_way == 'multiple':
         for polydata, transform in zip(input_polydatas, input_transforms):
             print(f"====== {transform} <TO> {polydata}")
         print("\n")
@@ -141,7 +165,7 @@ def main():
     
     if number_of_results != number_of_polydatas:
         print("Error: The numbers of inputs and outputs are different. Check log file for errors.")
-    else:
+    elif args.engine == 'slicer':
         os.remove(os.path.join(outdir, 'log.txt'))
 
 if __name__ == '__main__':
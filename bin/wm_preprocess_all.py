@@ -42,6 +42,13 @@ def _build_arg_parser():
         '--nonidentical', action='store_true',
         help='Obtain nonidentical results across runs for downsampling.')
 
+    parser.add_argument(
+        '-compression', action="store", dest="writeProfile", choices=["fast", "small", "archive"],
+        help='Write profile for output vtp files: fast (LZ4), small (zlib level 9) or archive (LZMA level 9). By default the vtk writer defaults are used.')
+    parser.add_argument(
+        '-float32', action='store_true', dest="flag_float32",
+        help='Write double precision points and data arrays of output files as float.')
+
     return parser
 
 
@@ -125,46 +132,35 @@ def main():
         num_lines = wm.GetNumberOfLines()
         #print "Input number of fibers", num_lines
 
-        # remove short fibers
+        # remove short fibers and downsample
         # -------------------
-        wm2 = None
-        if args.fiberLength is not None or args.maxFiberLength is not None:
+        # Both steps are done in a single pass so that only the
+        # retained fibers are copied.
+        if args.fiberLength is not None or args.maxFiberLength is not None or args.numberOfFibers is not None:
             msg = f"**Preprocessing: {subjectID}"
             print(id_msg + msg)
 
             if args.fiberLength is not None:
                 minlen = args.fiberLength
-            else:
+            elif args.maxFiberLength is not None:
                 minlen = 0
+            else:
+                minlen = None
 
             if args.maxFiberLength is not None:
                 maxlen = args.maxFiberLength
             else:
                 maxlen = None
 
-            wm2 = wma.filter.preprocess(wm, minlen, preserve_point_data=retaindata, preserve_cell_data=retaindata, verbose=False, max_length_mm=maxlen)
-            print(f"Number of fibers retained (length threshold {args.fiberLength}): {wm2.GetNumberOfLines()} / {num_lines}")
+            if args.numberOfFibers is not None:
+                msg = f"**Downsampling input: {subjectID} number of fibers: {args.numberOfFibers}"
+                print(id_msg + msg)
 
-        if wm2 is None:
-            wm2 = wm
-        else:
+            wm3 = wma.filter.preprocess_and_downsample(wm, minlen, args.numberOfFibers, max_length_mm=maxlen, preserve_point_data=retaindata, preserve_cell_data=retaindata, verbose=False, random_seed=wma.filter.random_generator(random_seed, sidx))
+            print(f"Number of fibers retained (length threshold {args.fiberLength}): {wm3.GetNumberOfLines()} / {num_lines}")
             del wm
-
-        # downsample
-        # -------------------
-        wm3 = None
-        if args.numberOfFibers is not None:
-            msg = f"**Downsampling input: {subjectID} number of fibers: {args.numberOfFibers}"
-            print(id_msg + msg)
-
-            # , preserve_point_data=True needs editing of preprocess function to use mask function
-            wm3 = wma.filter.downsample(wm2, args.numberOfFibers, preserve_point_data=retaindata, preserve_cell_data=retaindata, verbose=False, random_seed=random_seed)
-            print(f"Number of fibers retained: {wm3.GetNumberOfLines()} / {num_lines}")
-
-        if wm3 is None:
-            wm3 = wm2
         else:
-            del wm2
+            wm3 = wm
 
         # outputs
         # -------------------
@@ -176,7 +172,7 @@ def main():
 
         try:
             print(f"Writing output polydata {fname}...")
-            wma.io.write_polydata(wm3, fname)
+            wma.io.write_polydata(wm3, fname, profile=args.writeProfile, float32=args.flag_float32)
             print(f"Wrote output {fname}.")
         except:
             print("Unknown exception in IO")
@@ -51,6 +51,21 @@ def _build_arg_parser():
     parser.add_argument(
         '-midsag_symmetric', action="store_true", dest="flag_midsag_symmetric",
         help='Register all subjects including reflected copies of input subjects, for a symmetric registration.')
+    parser.add_argument(
+        '-tolerance', action="store", dest="objectiveTolerance", type=float,
+        help='Adaptive schedule: move on to the next scale (or finish, after the last scale) when the relative objective improvement of an iteration is below this value, e.g. 0.001. Subjects whose own improvement is below it are not registered again at the current scale. The default is to run every iteration of the fixed schedule.')
+    parser.add_argument(
+        '-transform_tolerance', action="store", dest="transformTolerance", type=float,
+        help='Adaptive schedule: as -tolerance, for the largest change of a transform parameter in an iteration (mm for nonrigid; for affine, translation in mm with rotation, scale and shear in comparable units). For example 0.1.')
+    parser.add_argument(
+        '-approximate', action='store_true', dest="flag_approximate",
+        help='Approximate the registration objective by comparing each fiber only with fibers whose centroid is within 3 sigma. This is much faster at the small sigma of the final scales, and the approximation error versus the exact objective is reported after each optimization.')
+    parser.add_argument(
+        '-cache', action="store", dest="cacheDirectory",
+        help='Directory of an on-disk cache of preprocessed and resampled subject data, shared between runs. Results of steps with identical inputs and parameters are reused. Preprocessed subjects are only reused when a random seed is given.')
+    parser.add_argument(
+        '-cache_size', action="store", dest="cacheSize", type=float, default=10,
+        help='Maximum size of the cache in GB. Least recently used entries are removed beyond this size. Default is 10.')
     parser.add_argument(
         '-advanced_only_random_seed', action='store', dest="randomSeed", type=int,
         help='(Advanced parameter for testing only.) Set random seed for reproducible sampling in software tests.')
@@ -68,6 +83,9 @@ def main():
     parser = _build_arg_parser()
     args = _parse_args(parser)
 
+    if args.cacheDirectory is not None:
+        wma.cache.enable_cache(args.cacheDirectory, max_size=int(args.cacheSize * 1024 ** 3))
+
     print("\n\n<register> =========GROUP REGISTRATION============")
     print(f"<{os.path.basename(__file__)}> Performing unbiased group registration.")
     print(f"<{os.path.basename(__file__)}> Input  directory: {args.inputDirectory}")
@@ -303,7 +321,7 @@ def main():
         exit()
     
     # Get input data
-    input_pds, subject_ids = wma.io.read_and_preprocess_polydata_directory(args.inputDirectory, fiber_length, number_of_fibers, random_seed, fiber_length_max)
+    input_pds, subject_ids = wma.io.read_and_preprocess_polydata_directory(args.inputDirectory, fiber_length, number_of_fibers, random_seed, fiber_length_max, parallel_jobs=parallel_jobs)
     
     # If we are registering for symmetry, include reflected copy of each brain
     if midsag_symmetric:
@@ -337,6 +355,9 @@ def main():
     register.verbose = verbose
     register.parallel_jobs = parallel_jobs
     register.render = not no_render
+    register.approximate_objective = args.flag_approximate
+    register.objective_tolerance = args.objectiveTolerance
+    register.transform_tolerance = args.transformTolerance
     if nonrigid:
         register.mode = "Nonrigid"
     # We have to add polydatas after setting nonrigid in the register object
@@ -479,11 +500,22 @@ def main():
             # Intermediate save. For testing only.
             if verbose:
                 register.save_transformed_polydatas(intermediate_save=True, midsag_symmetric=midsag_symmetric)
+
+            if register.converged:
+                comparisons_so_far += (iterations_per_scale[scale] - idx - 1) * comparisons_this_scale
+                print(f"<{os.path.basename(__file__)}> Converged at scale {scale + 1} / {len(do_scales)} after {idx + 1} iterations.")
+                progress_file = open(progress_filename, 'a')
+                print(f"Converged at scale {scale + 1} / {len(do_scales)} after {idx + 1} iterations.", file=progress_file)
+                progress_file.close()
+                break
     
     # Final save when we are done
     register.save_transformed_polydatas(midsag_symmetric=midsag_symmetric)
     
     print(f"\nDone registering. For more information on the output, please read: {readme_fname}\n")
+
+    if args.cacheDirectory is not None:
+        print(wma.cache.get_cache().report())
     
     progress_file = open(progress_filename, 'a')
     print("\nFinished registration.", file=progress_file)
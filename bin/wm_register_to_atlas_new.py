@@ -5,9 +5,7 @@ import argparse
 import glob
 import multiprocessing
 import os
-import time
 
-import numpy as np
 import vtk
 
 import whitematteranalysis as wma
@@ -20,7 +18,7 @@ def _build_arg_parser():
         epilog="Written by Lauren O\'Donnell, odonnell@bwh.harvard.edu.  Please reference \"Unbiased Groupwise Registration of White Matter Tractography. LJ O'Donnell,  WM Wells III, Golby AJ, CF Westin. Med Image Comput Comput Assist Interv. 2012;15(Pt 3):123-30.\"")
     parser.add_argument(
         'inputSubject',
-        help='One subject data: whole-brain tractography as vtkPolyData (.vtk or .vtp).')
+        help='One subject data: whole-brain tractography as vtkPolyData (.vtk or .vtp). Or a directory of subjects, which are all registered to the atlas (batch mode). The atlas is then read and prepared only once.')
     parser.add_argument(
         'inputAtlas',
         help='An atlas, one file containing whole-brain tractography as vtkPolyData (.vtk or .vtp).')
@@ -36,9 +34,21 @@ def _build_arg_parser():
     parser.add_argument(
         '-lmax', action="store", dest="fiberLengthMax", type=int, default=260,
         help='Maximum length (in mm) of fibers to analyze. This parameter can be used to remove extremely long fibers that may have traversed several structures. For example, a value of 200 will avoid sampling the tail end of the fiber length distribution. The default is 260 mm.')
+    parser.add_argument(
+        '-j', action="store", dest="numberOfJobs", type=int, default=1,
+        help='Number of subjects to register in parallel in batch mode.')
     parser.add_argument(
         '-verbose', action='store_true', dest="flag_verbose",
         help='Verbose. Run with -verbose to store more files and images of intermediate and final polydatas.')
+    parser.add_argument(
+        '-tolerance', action="store", dest="objectiveTolerance", type=float,
+        help='Adaptive schedule: move on to the next scale (or finish, after the last scale) when the relative objective improvement of an iteration is below this value, e.g. 0.001. The default is to run every iteration of the fixed schedule.')
+    parser.add_argument(
+        '-transform_tolerance', action="store", dest="transformTolerance", type=float,
+        help='Adaptive schedule: as -tolerance, for the largest change of a transform parameter in an iteration (mm for nonrigid; for affine, translation in mm with rotation, scale and shear in comparable units). For example 0.1.')
+    parser.add_argument(
+        '-approximate', action='store_true', dest="flag_approximate",
+        help='Approximate the registration objective by comparing each fiber only with fibers whose centroid is within 3 sigma. This is much faster at the small sigma of the final scales, and the approximation error versus the exact objective is reported after each optimization.')
     #parser.add_argument(
     #    '-pf', action="store", dest="pointsPerFiber", type=int, default=15,
     #    help='Number of points for fiber representation during registration. The default of 15 is reasonable.')
@@ -58,7 +68,7 @@ def main():
 
     print("\n\n<register> =========GROUP REGISTRATION============")
     print(f"<{os.path.basename(__file__)}> Registering to atlas.")
-    print(f"<{os.path.basename(__file__)}> Input  subject file: ", args.inputSubject)
+    print(f"<{os.path.basename(__file__)}> Input  subject file or directory: ", args.inputSubject)
     print(f"<{os.path.basename(__file__)}> Input  atlas file: ", args.inputAtlas)
     print(f"<{os.path.basename(__file__)}> Output directory: ", args.outputDirectory)
     print("\n<register> ============PARAMETERS=================")
@@ -66,7 +76,15 @@ def main():
     mode = args.mode
     print(f"<{os.path.basename(__file__)}> Registration mode:", mode)
     
-    if not os.path.isfile(args.inputSubject):
+    if os.path.isdir(args.inputSubject):
+        subject_filenames = wma.io.list_vtk_files(args.inputSubject)
+        print(f"<{os.path.basename(__file__)}> Batch mode: found {len(subject_filenames)} subjects in input directory {args.inputSubject}")
+        if len(subject_filenames) < 1:
+            print(f"<{os.path.basename(__file__)}> Error: No .vtk or .vtp files were found in the input directory.")
+            exit()
+    elif os.path.isfile(args.inputSubject):
+        subject_filenames = None
+    else:
         print(f"<{os.path.basename(__file__)}> Error: Input subject data", args.inputSubject, "does not exist.")
         exit()
     
@@ -74,9 +92,6 @@ def main():
         print(f"<{os.path.basename(__file__)}> Error: Input atlas", args.inputAtlas, "does not exist.")
         exit()
     
-    fname = args.inputSubject
-    subject_id = os.path.splitext(os.path.basename(fname))[0]
-    subject_pd = wma.io.read_polydata(fname)
     fname = args.inputAtlas
     atlas_id = os.path.splitext(os.path.basename(fname))[0]
     atlas_pd = wma.io.read_polydata(fname)
@@ -85,10 +100,6 @@ def main():
     if not os.path.exists(outdir):
         print(f"<{os.path.basename(__file__)}> Output directory {outdir} does not exist, creating it.")
         os.makedirs(outdir)
-    subject_outdir = os.path.join(outdir, subject_id)
-    if not os.path.exists(subject_outdir):
-        print(f"<{os.path.basename(__file__)}> Output directory {outdir} does not exist, creating it.")
-        os.makedirs(subject_outdir)
     
     fiber_length = args.fiberLength
     print(f"<{os.path.basename(__file__)}> Minimum length of fibers to analyze (in mm): ", fiber_length)
@@ -292,84 +303,39 @@ def main():
     
     
     
-    register = wma.congeal_to_atlas.SubjectToAtlasRegistration()
-    register.output_directory = subject_outdir
-    register.input_polydata_filename = args.inputSubject
-    register.fiber_length = args.fiberLength
-    register.fiber_length_max = args.fiberLengthMax
+    schedule = {'sigma': sigma_per_scale,
+                'iterations': iterations_per_scale,
+                'maxfun': maxfun_per_scale,
+                'mean_brain_size': mean_brain_size_per_scale,
+                'subject_brain_size': subject_brain_size_per_scale,
+                'initial_step': initial_step_per_scale,
+                'final_step': final_step_per_scale}
+    if nonrigid:
+        schedule['grid_resolution'] = grid_resolution_per_scale
+    if rigid:
+        schedule['rigid'] = rigid_scale
 
+    settings = {'fiber_length': args.fiberLength,
+                'fiber_length_max': args.fiberLengthMax,
+                'points_per_fiber': points_per_fiber,
+                'approximate_objective': args.flag_approximate,
+                'objective_tolerance': args.objectiveTolerance,
+                'transform_tolerance': args.transformTolerance}
     if nonrigid:
-        register.mode = "Nonrigid"
-    # We have to add polydatas after setting nonrigid in the register object
-    register.set_subject(subject_pd, subject_id)
-    register.set_atlas(atlas_pd, atlas_id)
-    
-    register.points_per_fiber = points_per_fiber
-    
+        settings['mode'] = "Nonrigid"
+
     # -------------
     # Done SETTINGS. Below is computation
     # -------------
-    total_iterations = np.sum(np.array(iterations_per_scale))
-    iteration = 1
-    # estimate percentage complete based on number of fibers compared,
-    # because the times cobyla calls the objective function are approx
-    # constant per scale (except first scale where they are cut short)
-    total_comparisons = np.multiply(iterations_per_scale,np.multiply(np.array(mean_brain_size_per_scale), np.array(subject_brain_size_per_scale)))
-    total_comparisons = np.sum(total_comparisons)
-    comparisons_so_far = 0
-    
-    progress_filename = os.path.join(subject_outdir, 'progress.txt')
-    progress_file = open(progress_filename, 'w')
-    print(f"Beginning registration. Total iterations will be: {total_iterations}", file=progress_file)
-    print(f"Start date: {time.strftime('%x')}", file=progress_file)
-    print(f"Start time: {time.strftime('%X')}\n", file=progress_file)
-    progress_file.close()
-    prev_time = time.time()
-    
-    do_scales = list(range(len(sigma_per_scale)))
-    
-    for scale in do_scales:
-        register.sigma = sigma_per_scale[scale]
-        register.initial_step = initial_step_per_scale[scale]
-        register.final_step = final_step_per_scale[scale]
-        register.maxfun = maxfun_per_scale[scale]
-        register.mean_brain_size = mean_brain_size_per_scale[scale]
-        register.subject_brain_size = subject_brain_size_per_scale[scale]
-        if register.mode == "Nonrigid":
-            register.nonrigid_grid_resolution = grid_resolution_per_scale[scale]
-            register.update_nonrigid_grid()
-        if rigid:
-            if rigid_scale[scale]:
-                register.mode = "Rigid"
-            else:
-                register.mode = "Affine"
-    
-        for idx in range(0,iterations_per_scale[scale]):
-            register.iterate()
-            comparisons_this_scale = mean_brain_size_per_scale[scale]*subject_brain_size_per_scale[scale]
-            comparisons_so_far += comparisons_this_scale
-            percent = 100*(float(comparisons_so_far)/total_comparisons)
-            print(f"Done iteration {iteration} / {total_iterations}. Percent finished approx: {percent:.2f}")
-            progress_file = open(progress_filename, 'a')
-            curr_time = time.time()
-            print(f"Done iteration {iteration} / {total_iterations}. Percent finished approx: {percent:.2f}. Time: {time.strftime('%X')}. Minutes Elapsed: {(curr_time - prev_time) / 60}", file=progress_file)
-            progress_file.close()
-            prev_time = curr_time
-            iteration += 1
-            # Intermediate save. For testing only.
-            if verbose:
-                register.save_transformed_polydata(intermediate_save=True)
-    
-    # Final save when we are done
-    register.save_transformed_polydata()
-    
-    print(f"Done registering. See output in: {subject_outdir}")
-    
-    progress_file = open(progress_filename, 'a')
-    print("\nFinished registration.", file=progress_file)
-    print(f"End date: {time.strftime('%x')}", file=progress_file)
-    print(f"End time: {time.strftime('%X')}", file=progress_file)
-    progress_file.close()
+    if subject_filenames is None:
+        atlas_fibers = wma.congeal_to_atlas.preprocess_fibers(atlas_pd, args.fiberLength, args.fiberLengthMax, points_per_fiber)
+        wma.congeal_to_atlas.register_subject_to_atlas(args.inputSubject, atlas_fibers, atlas_id, outdir, schedule, settings, verbose=verbose)
+    else:
+        failures = wma.congeal_to_atlas.register_subjects_to_atlas(subject_filenames, atlas_pd, atlas_id, outdir, schedule, settings,
+                                                                  parallel_jobs=args.numberOfJobs, verbose=verbose)
+        print(f"Done registering. See output in: {outdir}")
+        if failures:
+            exit(1)
 
 if __name__ == '__main__':
     main()
@@ -37,6 +37,13 @@ def _build_arg_parser():
         'outputDirectory',
         help='The output directory will be created if it does not exist.')
 
+    parser.add_argument(
+        '-compression', action="store", dest="writeProfile", choices=["fast", "small", "archive"],
+        help='Write profile for output vtp files: fast (LZ4), small (zlib level 9) or archive (LZMA level 9). By default the vtk writer defaults are used.')
+    parser.add_argument(
+        '-float32', action='store_true', dest="flag_float32",
+        help='Write double precision points and data arrays of output files as float.')
+
     return parser
 
 
@@ -95,17 +102,7 @@ def main():
                     print('  -- HemisphereLocation is in the input data: skip updating the vtk file.')
                     return inpd
     
-        vtk_array = vtk.vtkDoubleArray()
-        vtk_array.SetName('HemisphereLocation')
-    
-        inpd.GetLines().InitTraversal()
-        for lidx in range(0, inpd.GetNumberOfLines()):
-            ptids = vtk.vtkIdList()
-            inpd.GetLines().GetNextCell(ptids)
-            for pidx in range(0, ptids.GetNumberOfIds()):
-                vtk_array.InsertNextTuple1(mask_location[lidx])
-    
-        inpd.GetPointData().AddArray(vtk_array)
+        wma.filter.add_point_data_array(inpd, mask_location, 'HemisphereLocation', array_type=vtk.VTK_DOUBLE)
         inpd.Update()
     
         return inpd
@@ -198,11 +195,11 @@ def main():
         pd_commissure = wma.filter.mask(pd, mask_commissure, preserve_point_data=True, preserve_cell_data=True, verbose=False)
     
         fname_output = os.path.join(outdir_right, fname_base)
-        wma.io.write_polydata(pd_right, fname_output)
+        wma.io.write_polydata(pd_right, fname_output, profile=args.writeProfile, float32=args.flag_float32)
         fname_output = os.path.join(outdir_left, fname_base)
-        wma.io.write_polydata(pd_left, fname_output)
+        wma.io.write_polydata(pd_left, fname_output, profile=args.writeProfile, float32=args.flag_float32)
         fname_output = os.path.join(outdir_commissure, fname_base)
-        wma.io.write_polydata(pd_commissure, fname_output)
+        wma.io.write_polydata(pd_commissure, fname_output, profile=args.writeProfile, float32=args.flag_float32)
     
     print("")
     print(f"<{os.path.basename(__file__)}> Done!!!")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the vtp write profiles of wma.io.write_polydata: file size,
+write throughput and read throughput for each profile, relative to the
+uncompressed size of the tractography.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import whitematteranalysis as wma
+
+
+def _build_arg_parser():
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        'inputFilename',
+        help='Tractography as vtkPolyData file (vtk/vtp).')
+    parser.add_argument(
+        '-repeat', action="store", dest="repeat", type=int, default=3,
+        help='Number of timed writes and reads per profile. The fastest is reported.')
+    parser.add_argument(
+        '-float32', action='store_true', dest="float32",
+        help='Also downcast double precision arrays to float.')
+    parser.add_argument(
+        '-tmpdir', action="store", dest="tmpdir",
+        help='Directory for the benchmark files, by default the system temporary directory.')
+
+    return parser
+
+
+def _parse_args(parser):
+
+    return parser.parse_args()
+
+
+def main():
+
+    parser = _build_arg_parser()
+    args = _parse_args(parser)
+
+    if not os.path.exists(args.inputFilename):
+        print(f"Error: Input file {args.inputFilename} does not exist.")
+        exit()
+
+    pd = wma.io.read_polydata(args.inputFilename)
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+
+    try:
+        # size of the raw arrays, as written without compression
+        fname = os.path.join(tmpdir, "none.vtp")
+        wma.io.write_polydata(pd, fname, compressor='none', float32=args.float32)
+        raw_mb = os.path.getsize(fname) / 1e6
+
+        print(f"{os.path.basename(__file__)}: {pd.GetNumberOfLines()} fibers, {raw_mb:.1f} MB uncompressed")
+        print(f"{'profile':10s} {'size':>8s} {'write MB/s':>11s} {'read MB/s':>10s}")
+        for profile in [None] + list(wma.io.WRITE_PROFILES):
+            fname = os.path.join(tmpdir, f"{profile}.vtp")
+            write_time = read_time = float('inf')
+            for repeat in range(args.repeat):
+                t0 = time.perf_counter()
+                wma.io.write_polydata(pd, fname, profile=profile, float32=args.float32)
+                t1 = time.perf_counter()
+                wma.io.read_polydata(fname)
+                t2 = time.perf_counter()
+                write_time = min(write_time, t1 - t0)
+                read_time = min(read_time, t2 - t1)
+            size = 100.0 * os.path.getsize(fname) / 1e6 / raw_mb
+            print(f"{str(profile or 'default'):10s} {size:7.0f}% {raw_mb / write_time:11.0f} {raw_mb / read_time:10.0f}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
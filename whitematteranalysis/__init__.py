@@ -1,6 +1,6 @@
 print("Importing whitematteranalysis package.")
-from . import (cluster, congeal_multisubject, congeal_to_atlas, fibers, filter,
-               io, laterality, mrml, register_two_subjects,
+from . import (cache, cluster, congeal_multisubject, congeal_to_atlas, fibers,
+               filter, harden, io, laterality, mrml, register_two_subjects,
                register_two_subjects_nonrigid,
                register_two_subjects_nonrigid_bsplines, relative_distance,
-               render, similarity, tract_measurement)
+               render, shared, similarity, tract_measurement)
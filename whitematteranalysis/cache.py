@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+""" cache.py
+
+Opt-in content-addressed on-disk cache for preprocessed subject data.
+
+Reading, length filtering, downsampling and resampling the same
+subjects with the same parameters is repeated across registration,
+atlas building, clustering and QC runs. When a cache is enabled, the
+results of the expensive steps (read_and_preprocess_polydata_directory
+and FiberArray.convert_from_polydata) are stored in a directory, keyed by a hash of
+the input (file contents, or the points and lines of a polydata) and of
+all parameters that affect the result. Entries are uncompressed .npz
+files, evicted least recently used first when the cache grows beyond
+its size limit.
+
+enable_cache, disable_cache, get_cache
+
+Functions to switch the cache on and off. enable_cache also sets the
+WMA_CACHE_DIR environment variable, so worker processes use the same
+cache. Setting WMA_CACHE_DIR (and optionally WMA_CACHE_MAX_SIZE in
+bytes) before starting a program enables the cache as well, limited to DEFAULT_MAX_SIZE unless
+WMA_CACHE_MAX_SIZE is given.
+
+class TractographyCache
+
+The cache itself, with get/put of named arrays and a stats report.
+
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# increase when the content of cached entries changes
+CACHE_VERSION = 1
+
+# default size limit, 10 GB
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+
+_CACHE_EXTENSION = '.npz'
+
+
+class TractographyCache:
+
+    """Directory of cached arrays, with least recently used eviction.
+
+    Each entry is a dictionary of named numpy arrays. Access times are
+    recorded as file modification times, so they are shared by all
+    processes using the directory.
+
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        # statistics for this process
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        # content hashes of files, by (path, size, modification time)
+        self._file_digests = dict()
+
+    def file_digest(self, filename):
+        """Hash of the contents of a file, computed once per process for
+        each version of the file."""
+
+        stat = os.stat(filename)
+        memo_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._file_digests:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 24), b''):
+                    digest.update(block)
+            self._file_digests[memo_key] = digest.hexdigest()
+        return self._file_digests[memo_key]
+
+    @staticmethod
+    def array_digest(*arrays):
+        """Hash of the contents, shapes and types of numpy arrays."""
+
+        digest = hashlib.blake2b(digest_size=16)
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(f'{array.dtype.str}{array.shape}'.encode())
+            digest.update(memoryview(array).cast('B'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(kind, input_digest, **parameters):
+        """Cache key for the result of step kind on the given input."""
+
+        description = json.dumps([CACHE_VERSION, kind, input_digest, parameters], sort_keys=True, default=str)
+        return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + _CACHE_EXTENSION)
+
+    def get(self, key):
+        """Return the dictionary of arrays stored under key, or None."""
+
+        fname = self._filename(key)
+        try:
+            with np.load(fname, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            # mark as recently used
+            os.utime(fname)
+        except (OSError, ValueError):
+            # missing, evicted by another process, or partially written by an older version
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def count_lookup(self, hit):
+        """Add a lookup done by a worker process to the statistics."""
+
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def put(self, key, **arrays):
+        """Store arrays under key, then evict old entries if needed."""
+
+        fd, tmp_fname = tempfile.mkstemp(suffix=_CACHE_EXTENSION, prefix='.tmp_', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_fname, self._filename(key))
+        except Exception:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            raise
+        self.stores += 1
+        self.evict()
+
+    def _entries(self):
+        """List of (access time, size, filename) of the cache entries."""
+
+        entries = list()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_CACHE_EXTENSION) and not entry.name.startswith('.'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        """Total size in bytes of the cache entries."""
+
+        return sum(size for (atime, size, fname) in self._entries())
+
+    def evict(self, max_size=None):
+        """Remove least recently used entries until the cache is at most
+        max_size bytes (default self.max_size)."""
+
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return
+        entries = sorted(self._entries())
+        total = sum(size for (atime, size, fname) in entries)
+        for (atime, size, fname) in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(fname)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all entries."""
+
+        self.evict(max_size=0)
+
+    def stats(self):
+        """Dictionary of statistics: hits, misses, stores and evictions
+        in this process, and the current number and size of entries."""
+
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {'directory': self.directory,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'entries': len(entries),
+                'size': sum(size for (atime, size, fname) in entries),
+                'max_size': self.max_size}
+
+    def report(self):
+        """Human-readable summary of stats()."""
+
+        stats = self.stats()
+        max_size = 'unlimited' if stats['max_size'] is None else f"{stats['max_size'] / 1e6:.1f} MB"
+        return (f"<{os.path.basename(__file__)}> Cache {stats['directory']}: "
+                f"{stats['hits']} hits, {stats['misses']} misses (hit rate {100 * stats['hit_rate']:.1f}%), "
+                f"{stats['stores']} stored, {stats['evictions']} evicted, "
+                f"{stats['entries']} entries using {stats['size'] / 1e6:.1f} MB of {max_size}")
+
+
+_cache = None
+
+
+def enable_cache(directory, max_size=DEFAULT_MAX_SIZE):
+    """Use a cache in directory for the rest of this program and its
+    worker processes. Returns the TractographyCache."""
+
+    global _cache
+    _cache = TractographyCache(directory, max_size=max_size)
+    os.environ['WMA_CACHE_DIR'] = _cache.directory
+    if max_size is None:
+        os.environ.pop('WMA_CACHE_MAX_SIZE', None)
+    else:
+        os.environ['WMA_CACHE_MAX_SIZE'] = str(int(max_size))
+    return _cache
+
+
+def disable_cache():
+    """Stop using the cache. Cached entries are kept on disk."""
+
+    global _cache
+    _cache = None
+    os.environ.pop('WMA_CACHE_DIR', None)
+    os.environ.pop('WMA_CACHE_MAX_SIZE', None)
+
+
+def get_cache():
+    """Return the enabled TractographyCache, or None if caching is off."""
+
+    global _cache
+    directory = os.environ.get('WMA_CACHE_DIR')
+    if directory is None:
+        return None
+    if _cache is None or _cache.directory != os.path.abspath(directory):
+        max_size = int(os.environ.get('WMA_CACHE_MAX_SIZE', DEFAULT_MAX_SIZE))
+        _cache = TractographyCache(directory, max_size=max_size)
+    return _cache
+
+
+def polydata_digest(inpd):
+    """Hash of the points and lines of a vtkPolyData (not its point or
+    cell data)."""
+
+    from . import filter
+    if inpd.GetNumberOfPoints() == 0 or inpd.GetNumberOfLines() == 0:
+        return TractographyCache.array_digest(np.zeros(0), np.zeros(0))
+    return TractographyCache.array_digest(*filter._get_line_arrays(inpd))
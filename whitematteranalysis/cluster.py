@@ -18,7 +18,7 @@ from joblib import Parallel, delayed
 
 from whitematteranalysis.utils.opt_pckg import optional_package
 
-from . import fibers, filter, io, mrml, render, similarity
+from . import fibers, filter, io, mrml, render, shared, similarity
 
 matplotlib, have_mpl, _ = optional_package("matplotlib")
 plt, _, _ = optional_package("matplotlib.pyplot")
@@ -698,6 +698,28 @@ def _rectangular_similarity_matrix(input_polydata_n, input_polydata_m, threshold
 
     return similarity_matrix
 
+def _shared_fiber_distance(fiber_index, shared_fibers, threshold, distance_method='Hausdorff',
+                           fiber_landmarks=None, use_landmarks=False, bilateral=False, sigmasq=6400):
+
+    """ Distance from fiber number fiber_index to all fibers, for
+    Parallel jobs. shared_fibers (R,A,S by fiber by point) and
+    fiber_landmarks are shared.SharedArray handles.
+
+    """
+
+    fiber_array = fibers.FiberArray()
+    (fiber_array.fiber_array_r, fiber_array.fiber_array_a, fiber_array.fiber_array_s) = shared_fibers.attach()
+    fiber_array.number_of_fibers = shared_fibers.shape[1]
+    fiber_array.points_per_fiber = shared_fibers.shape[2]
+    landmarks = fiber_landmarks.attach()
+
+    return similarity.fiber_distance(
+        fiber_array.get_fiber(fiber_index),
+        fiber_array,
+        threshold, distance_method=distance_method,
+        fiber_landmarks=landmarks[fiber_index, :],
+        landmarks=landmarks if use_landmarks else None, bilateral=bilateral, sigmasq=sigmasq)
+
 def _pairwise_distance_matrix(input_polydata, threshold,
                               number_of_jobs=3, landmarks=None, distance_method='Hausdorff',
                               bilateral=False, sigmasq=6400):
@@ -728,15 +750,20 @@ def _pairwise_distance_matrix(input_polydata, threshold,
         else:
             landmarks2 = landmarks
 
-        distances = Parallel(n_jobs=number_of_jobs,
-                             verbose=0)(
-            delayed(similarity.fiber_distance)(
-                fiber_array.get_fiber(lidx),
-                fiber_array,
-                threshold, distance_method=distance_method, 
-                fiber_landmarks=landmarks2[lidx,:], 
-                landmarks=landmarks, bilateral=bilateral, sigmasq=sigmasq)
-            for lidx in all_fibers)
+        # The fibers and landmarks are shared with the subprocesses, so
+        # each job only receives the index of its fiber.
+        with shared.SharedArrays() as shared_arrays:
+            shared_fibers = shared_arrays.add('fibers', [fiber_array.fiber_array_r, fiber_array.fiber_array_a, fiber_array.fiber_array_s])
+            shared_landmarks = shared_arrays.add('landmarks', landmarks2)
+            distances = Parallel(n_jobs=number_of_jobs,
+                                 verbose=0)(
+                delayed(_shared_fiber_distance)(
+                    lidx,
+                    shared_fibers,
+                    threshold, distance_method=distance_method,
+                    fiber_landmarks=shared_landmarks,
+                    use_landmarks=landmarks is not None, bilateral=bilateral, sigmasq=sigmasq)
+                for lidx in all_fibers)
 
         distances = np.array(distances)
 
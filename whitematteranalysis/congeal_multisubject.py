@@ -59,6 +59,15 @@ class MultiSubjectRegistration:
         self.subject_brain_size = 1000
         # options are Affine, Rigid, Nonrigid
         self.mode = "Affine"
+        # compare fibers only with neighbours within a few sigma, which
+        # is much faster at small sigma (fine scales)
+        self.approximate_objective = False
+        # A subject, or the whole group, has converged at the current
+        # scale when in one iteration the relative objective improvement
+        # or the largest transform change (see transform_change) is below
+        # its tolerance. None turns the test off.
+        self.objective_tolerance = None
+        self.transform_tolerance = None
 
         # internal stuff
         self.polydatas = list()
@@ -68,6 +77,14 @@ class MultiSubjectRegistration:
         self.objectives_after = list()
         self.total_iterations = 0
         self.subject_ids = list()
+        # converged subjects are skipped until the scale changes
+        self.subject_converged = list()
+        self.converged = False
+        # last objective of each subject (normalized by
+        # subject_brain_size), counted unchanged in the totals of
+        # iterations that skip it
+        self.subject_objectives = list()
+        self._convergence_scale = None
 
         #self.nonrigid_grid_resolution = 3
         #self.nonrigid_grid_resolution = 5
@@ -131,6 +148,8 @@ class MultiSubjectRegistration:
             self.transforms.append(trans)
             self.transforms_as_array.append(np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0, 0]).astype(float))
         self.subject_ids.append(subject_id)
+        self.subject_converged.append(False)
+        self.subject_objectives.append(None)
         
     def remove_mean_from_transforms(self):
         """ Remove mean rotations and mean scaling and mean
@@ -179,8 +198,23 @@ class MultiSubjectRegistration:
                 transform[9:15] = transform[9:15] - meantrans[9:15]
 
     def iterate(self):
-        """ Run a single iteration of optimization, multiprocessing over input subjects."""
-        
+        """ Run a single iteration of optimization, multiprocessing over input subjects.
+
+        Subjects that have converged at the current scale are skipped,
+        and self.converged is set when the group has converged."""
+
+        # Convergence is tested again from the start of each scale
+        scale = (self.mode, self.sigma, self.nonrigid_grid_resolution, self.initial_step, self.final_step,
+                 self.maxfun, self.mean_brain_size, self.subject_brain_size)
+        if scale != self._convergence_scale:
+            self._convergence_scale = scale
+            self.subject_converged = [False] * len(self.polydatas)
+            self.converged = False
+        if all(self.subject_converged):
+            print(f"All subjects have converged at sigma {self.sigma}. Skipping iteration.")
+            self.converged = True
+            return
+
         self.total_iterations += 1
         start_time = time.time()
 
@@ -188,7 +222,7 @@ class MultiSubjectRegistration:
         if self.total_iterations == 1:
             self.progress_filename = os.path.join(self.output_directory, 'registration_performance.txt')
             progress_file = open(self.progress_filename, 'w')
-            print('iteration\tsigma\tnonrigid\tsubject_brain_fibers\tfibers_per_subject_in_mean_brain\tmean_brain_fibers\tmaxfun\tgrid_resolution_if_nonrigid\tinitial_step\tfinal_step\tobjective_before\tobjective_after\tobjective_change\tobjective_percent_change\tmean_function_calls_per_subject\tmin_function_calls_per_subject\tmax_function_calls_per_subject\tsubjects_hitting_maxfun\ttotal_subjects\tsubjects_decreased\tmean_subject_change\tmean_subject_decrease_if_decreased\ttime', file=progress_file)
+            print('iteration\tsigma\tnonrigid\tsubject_brain_fibers\tfibers_per_subject_in_mean_brain\tmean_brain_fibers\tmaxfun\tgrid_resolution_if_nonrigid\tinitial_step\tfinal_step\tobjective_before\tobjective_after\tobjective_change\tobjective_percent_change\tmean_function_calls_per_subject\tmin_function_calls_per_subject\tmax_function_calls_per_subject\tsubjects_hitting_maxfun\ttotal_subjects\tsubjects_decreased\tmean_subject_change\tmean_subject_decrease_if_decreased\ttime\tsubjects_skipped_converged\tmax_transform_change', file=progress_file)
             progress_file.close()
             
         # make a directory for the current iteration
@@ -211,7 +245,7 @@ class MultiSubjectRegistration:
             print(f"Fibers per subject for computing mean brain: {fibers_per_subject} = {self.mean_brain_size} / {len(self.polydatas) - 1}")
 
         # Set up lists of data to pass to the per-subject processes
-        mean_list = list()
+        exclude_list = list()
         subject_list = list()
         mode_list = list()
         sigma_list = list()
@@ -222,9 +256,12 @@ class MultiSubjectRegistration:
         maxfun_list = list()
         render_list = list()
         grid_resolution_list = list()
+        initial_transform_list = list()
         
         # Each subject will be registered to the current model or "mean brain"
-        # Sample fibers from each subject for use in the "mean brain"
+        # Sample fibers from each subject for use in the "mean brain".
+        # Each sample is transformed and resampled once, into one array
+        # holding the samples of all subjects one after another.
         subject_sampled_fibers = list()
         for (input_pd, trans) in zip(self.polydatas, self.transforms):
             pd = wma.filter.downsample(input_pd, fibers_per_subject, verbose=False, random_seed=self.random_seed)
@@ -236,38 +273,34 @@ class MultiSubjectRegistration:
                 transformer.SetInput(pd)
             transformer.SetTransform(trans)
             transformer.Update()
-            subject_sampled_fibers.append(transformer.GetOutput())
+            sampled_fibers = wma.fibers.FiberArray()
+            sampled_fibers.convert_from_polydata(transformer.GetOutput(), self.points_per_fiber, use_cache=False)
+            subject_sampled_fibers.append(np.array([sampled_fibers.fiber_array_r, sampled_fibers.fiber_array_a, sampled_fibers.fiber_array_s]))
             del transformer
-            
-        # Loop over all subjects and prepare lists of inputs for subprocesses
-        subj_idx = 0
-        for input_pd in self.polydatas:
-            # Compute current atlas model "mean brain" in a leave-one out fashion.
-            # Otherwise, the optimal transform may be identity.
-            appender = vtk.vtkAppendPolyData()
-            for subj_idx2 in range(len(subject_sampled_fibers)):
-                if subj_idx2 != subj_idx:
-                    pd = subject_sampled_fibers[subj_idx2]
-                    if (vtk.vtkVersion().GetVTKMajorVersion() >= 6.0):
-                        appender.AddInputData(pd)
-                    else:
-                        appender.AddInput(pd)
+        #  R,A,S is the first index
+        # then fiber number
+        # then points along fiber
+        sample_offsets = np.cumsum([0] + [sample.shape[1] for sample in subject_sampled_fibers])
+        all_sampled_fibers = np.concatenate(subject_sampled_fibers, axis=1)
+        del subject_sampled_fibers
 
-            # Convert "mean brain" from vtk to numpy format
-            appender.Update()
-            mean_brain = appender.GetOutput()
-            mean_fibers = wma.fibers.FiberArray()
-            mean_fibers.convert_from_polydata(mean_brain, self.points_per_fiber)
-            mean_fibers = np.array([mean_fibers.fiber_array_r,mean_fibers.fiber_array_a,mean_fibers.fiber_array_s])
-            #  R,A,S is the first index
-            # then fiber number
-            # then points along fiber
-            mean_list.append(mean_fibers)
+        # Loop over all subjects and prepare lists of inputs for subprocesses
+        for (subj_idx, input_pd) in enumerate(self.polydatas):
+            # Converged subjects are still part of the mean brain, but
+            # are not registered again at this scale
+            if self.subject_converged[subj_idx]:
+                continue
+
+            # The current atlas model "mean brain" is computed in a
+            # leave-one out fashion, otherwise the optimal transform may
+            # be identity. Each process excludes this subject's fibers
+            # from the shared array of all samples.
+            exclude_list.append((sample_offsets[subj_idx], sample_offsets[subj_idx + 1]))
 
             # Now get the current sample of fibers from the subject for registration to the "mean brain"
             pd = wma.filter.downsample(input_pd, self.subject_brain_size, verbose=False, random_seed=self.random_seed)
             fibers = wma.fibers.FiberArray()
-            fibers.convert_from_polydata(pd, self.points_per_fiber)
+            fibers.convert_from_polydata(pd, self.points_per_fiber, use_cache=False)
             fibers_array = np.array([fibers.fiber_array_r,fibers.fiber_array_a,fibers.fiber_array_s])
             subject_list.append(fibers_array)
 
@@ -275,33 +308,41 @@ class MultiSubjectRegistration:
             sigma_list.append(self.sigma)
             mode_list.append(self.mode)
             subj_idx_list.append(subj_idx)
-            subj_idx += 1
             iteration_list.append(self.total_iterations)
             outdir_list.append(outdir_render)
             stepsize_list.append(np.array([self.initial_step, self.final_step]))
             maxfun_list.append(self.maxfun)
             render_list.append(self.render)
             grid_resolution_list.append(self.nonrigid_grid_resolution)
-            
+            initial_transform_list.append(self.transforms_as_array[subj_idx])
+
         # Multiprocess over subjects
         print(f"\nITERATION {self.total_iterations} STARTING MULTIPROCESSING. NUMBER OF JOBS: {self.parallel_jobs}\n")
 
         # note we can't pass vtk objects to subprocesses since they can't be pickled.
-        ret = Parallel(
-            n_jobs=self.parallel_jobs, verbose=self.parallel_verbose)(
-                delayed(congeal_multisubject_inner_loop)(fixed, moving, initial_transform, mode, sigma, subject_idx, iteration_count, output_directory, step_size, maxfun, render, grid_resolution)
-                for (fixed, moving, initial_transform, mode, sigma, subject_idx, iteration_count, output_directory, step_size, maxfun, render, grid_resolution) in zip(mean_list, subject_list, self.transforms_as_array, mode_list, sigma_list, subj_idx_list, iteration_list, outdir_list, stepsize_list, maxfun_list, render_list, grid_resolution_list))
+        # The fiber arrays are shared with the subprocesses, which
+        # attach to one read-only copy, so each job only receives
+        # handles, indices and parameters.
+        with wma.shared.SharedArrays() as shared:
+            sampled_fibers = shared.add('sampled_fibers', all_sampled_fibers)
+            subject_list = [shared.add(f'subject_{idx:05d}', moving) for (idx, moving) in zip(subj_idx_list, subject_list)]
+            ret = Parallel(
+                n_jobs=self.parallel_jobs, verbose=self.parallel_verbose)(
+                    delayed(congeal_multisubject_leave_one_out_inner_loop)(sampled_fibers, exclude, moving, initial_transform, mode, sigma, subject_idx, iteration_count, output_directory, step_size, maxfun, render, grid_resolution, approximate=self.approximate_objective)
+                    for (exclude, moving, initial_transform, mode, sigma, subject_idx, iteration_count, output_directory, step_size, maxfun, render, grid_resolution) in zip(exclude_list, subject_list, initial_transform_list, mode_list, sigma_list, subj_idx_list, iteration_list, outdir_list, stepsize_list, maxfun_list, render_list, grid_resolution_list))
 
-            
         #print "RETURNED VALUES", ret
         
         # Progress reporting: loop over all registration outputs.
         # Get the current transform for each subject and report the
         # objective values to the user by printing, saving, and plotting.
+        previous_transforms = self.transforms_as_array
+        results = dict(zip(subj_idx_list, ret))
         self.transforms_as_array = list()
         objective_total_before = 0.0
         objective_total_after = 0.0
         sidx = 0
+        transform_changes = list()
         functions_per_subject = list()
         objective_changes_per_subject = list()
         decreases = list()
@@ -312,24 +353,38 @@ class MultiSubjectRegistration:
             plt.xlabel('objective function computations')
             plt.ylabel('objective value')
             
-        for (trans, objectives, diff) in ret:
+        for subj_idx in range(len(self.polydatas)):
+            if subj_idx not in results:
+                self.transforms_as_array.append(previous_transforms[subj_idx])
+                print(f"Iteration: {self.total_iterations} Subject: {subj_idx} skipped, converged")
+                # carry its last objective forward, so the totals stay
+                # comparable across iterations
+                objective_total_before += self.subject_objectives[subj_idx]
+                objective_total_after += self.subject_objectives[subj_idx]
+                continue
+            (trans, objectives, diff) = results[subj_idx]
             self.transforms_as_array.append(trans)
-            print(f"Iteration: {self.total_iterations} Subject: {sidx} Objective function computations: {len(objectives)} change {diff}")
+            print(f"Iteration: {self.total_iterations} Subject: {subj_idx} Objective function computations: {len(objectives)} change {diff}")
+            change = transform_change(previous_transforms[subj_idx], trans, self.mode)
+            transform_changes.append(change)
+            self.subject_converged[subj_idx] = has_converged(relative_improvement(objectives[0], objectives[0] + min(diff, 0)), change,
+                                                             self.objective_tolerance, self.transform_tolerance)
             functions_per_subject.append(len(objectives))
             # Normalize by the number of fibers so this is comparable across iterations if sigma does not change
             objectives = np.divide(objectives, self.subject_brain_size)
             # Compute total objective for progress reporting.
             objective_total_before += objectives[0]
             if diff < 0:
-                objective_total_after += objectives[-1]
+                self.subject_objectives[subj_idx] = objectives[-1]
                 decreases.append(diff)
             else:
-                objective_total_after += objectives[0]
+                self.subject_objectives[subj_idx] = objectives[0]
+            objective_total_after += self.subject_objectives[subj_idx]
             objective_changes_per_subject.append(diff)
             sidx += 1
             if have_mpl:
                 plt.figure(0)
-                plt.plot(objectives, 'o-', label=sidx)
+                plt.plot(objectives, 'o-', label=subj_idx + 1)
 
         number_of_subjects = sidx
         functions_per_subject = np.array(functions_per_subject)
@@ -340,6 +395,11 @@ class MultiSubjectRegistration:
         self.objectives_after.append(objective_total_after)
         total_change =  self.objectives_after[-1] - self.objectives_before[-1]
         percent_change = total_change / self.objectives_before[-1]
+        max_transform_change = np.max(transform_changes)
+        self.converged = all(self.subject_converged) or \
+            has_converged(relative_improvement(self.objectives_before[-1], self.objectives_after[-1]), max_transform_change,
+                          self.objective_tolerance, self.transform_tolerance)
+        print(f"Iteration: {self.total_iterations} MAX transform change: {max_transform_change} Subjects converged: {np.sum(self.subject_converged)} / {len(self.subject_converged)}")
         print(f"Iteration: {self.total_iterations} TOTAL objective change: {total_change}")
         print(f"Iteration: {self.total_iterations} PERCENT objective change: {percent_change}")
 
@@ -363,7 +423,7 @@ class MultiSubjectRegistration:
             mean_decreases = 0.0
         else:
             mean_decreases = np.mean(decreases)
-        print(f'{self.total_iterations}\t{self.sigma}\t{self.mode}\t{self.subject_brain_size}\t{fibers_per_subject}\t{self.mean_brain_size}\t{self.maxfun}\t{self.nonrigid_grid_resolution}\t{self.initial_step}\t{self.final_step}\t{self.objectives_before[-1]}\t{self.objectives_after[-1]}\t{total_change}\t{percent_change}\t{np.mean(functions_per_subject)}\t{np.min(functions_per_subject)}\t{np.max(functions_per_subject)}\t{np.sum(functions_per_subject >= self.maxfun)}\t{number_of_subjects}\t{len(decreases)}\t{np.mean(objective_changes_per_subject)}\t{mean_decreases}\t{elapsed_time}', file=progress_file)
+        print(f'{self.total_iterations}\t{self.sigma}\t{self.mode}\t{self.subject_brain_size}\t{fibers_per_subject}\t{self.mean_brain_size}\t{self.maxfun}\t{self.nonrigid_grid_resolution}\t{self.initial_step}\t{self.final_step}\t{self.objectives_before[-1]}\t{self.objectives_after[-1]}\t{total_change}\t{percent_change}\t{np.mean(functions_per_subject)}\t{np.min(functions_per_subject)}\t{np.max(functions_per_subject)}\t{np.sum(functions_per_subject >= self.maxfun)}\t{number_of_subjects}\t{len(decreases)}\t{np.mean(objective_changes_per_subject)}\t{mean_decreases}\t{elapsed_time}\t{len(self.polydatas) - number_of_subjects}\t{max_transform_change}', file=progress_file)
         progress_file.close()
 
         # remove_mean_from_transforms
@@ -417,7 +477,7 @@ class MultiSubjectRegistration:
             if not os.path.exists(outdir_pds):
                 os.makedirs(outdir_pds)
 
-            wma.io.transform_polydatas_from_disk(self.input_directory, transform_list, outdir_pds)
+            wma.io.transform_polydatas_from_disk(self.input_directory, transform_list, outdir_pds, parallel_jobs=self.parallel_jobs)
 
         else:
             # make a directory for the final output
@@ -432,7 +492,7 @@ class MultiSubjectRegistration:
                     else:
                         print(trans.GetMatrix())
 
-            wma.io.transform_polydatas_from_disk(self.input_directory, transform_list, outdir)
+            wma.io.transform_polydatas_from_disk(self.input_directory, transform_list, outdir, parallel_jobs=self.parallel_jobs)
 
             # Save the current atlas representation to disk.
             # Right now this is all the input fibers from all subjects.
@@ -464,11 +524,63 @@ class MultiSubjectRegistration:
             print(f"WRITE TXFORMS: {elapsed_time}")
 
 
-def congeal_multisubject_inner_loop(mean, subject, initial_transform, mode, sigma, subject_idx, iteration_count, output_directory, step_size, maxfun, render, grid_resolution):
+def transform_change(before, after, mode):
+    """Largest change of any parameter between two transforms as
+    arrays. For Nonrigid mode this is a displacement in mm, otherwise
+    the affine parameters are compared in the optimizer search space
+    (register_two_subjects.TRANSFORM_SCALING), where a change of 1 is
+    comparable to 1 mm."""
+
+    change = np.abs(np.subtract(after, before))
+    if mode != "Nonrigid":
+        change = change * wma.register_two_subjects.TRANSFORM_SCALING
+    return np.max(change)
+
+
+def relative_improvement(objective_before, objective_after):
+    """Decrease of the objective relative to its initial value."""
+
+    if objective_before == 0:
+        return 0.0
+    return (objective_before - objective_after) / abs(objective_before)
+
+
+def has_converged(improvement, change, objective_tolerance=None, transform_tolerance=None):
+    """True if the relative objective improvement or the transform
+    change is below its tolerance. Tolerances of None are not tested."""
+
+    if objective_tolerance is not None and improvement < objective_tolerance:
+        return True
+    if transform_tolerance is not None and change < transform_tolerance:
+        return True
+    return False
+
+
+def leave_one_out_mean(sampled_fibers, exclude):
+    """Return the fibers of the "mean brain" for one subject: all
+    sampled_fibers (R,A,S by fiber by point) except those in the range
+    exclude = (start, stop), which are the subject's own."""
+
+    (start, stop) = exclude
+    return np.concatenate((sampled_fibers[:, :start, :], sampled_fibers[:, stop:, :]), axis=1)
+
+
+def congeal_multisubject_leave_one_out_inner_loop(sampled_fibers, exclude, subject, initial_transform, mode, sigma, subject_idx, iteration_count, output_directory, step_size, maxfun, render, grid_resolution, approximate=False):
+
+    """congeal_multisubject_inner_loop with the "mean brain" built in the
+    subprocess, from the samples of all subjects excluding this one.
+    sampled_fibers and subject are wma.shared.SharedArray handles."""
+
+    mean = leave_one_out_mean(sampled_fibers.attach(), exclude)
+    return congeal_multisubject_inner_loop(mean, np.array(subject.attach()), initial_transform, mode, sigma, subject_idx, iteration_count, output_directory, step_size, maxfun, render, grid_resolution, approximate=approximate)
+
+
+def congeal_multisubject_inner_loop(mean, subject, initial_transform, mode, sigma, subject_idx, iteration_count, output_directory, step_size, maxfun, render, grid_resolution, approximate=False):
 
     """This is the code executed by each subprocess that launches the
 
     registration of one subject to the current atlas model or mean brain.
+    If approximate is True, the truncated kernel objective is used.
     """
     
     #print "\n BEGIN ITERATION", iteration_count, "subject", subject_idx, "sigma:", sigma, "mean brain:", mean.shape, "subject:", subject.shape, "initial transform length:", len(initial_transform), "steps:", step_size[0], step_size[1], "maxfun:", maxfun, type(initial_transform), "Grid:", grid_resolution, "Mode:", mode, "initial transform:", initial_transform,
@@ -506,6 +618,7 @@ def congeal_multisubject_inner_loop(mean, subject, initial_transform, mode, sigm
     register.initial_step = step_size[0]
     register.final_step = step_size[1]
     register.render = render
+    register.approximate = approximate
 
     # Run the current iteration of optimization.    
     register.compute()
@@ -6,13 +6,19 @@ re-implementation of fiber tractography registration (group)
 
 class MultiSubjectRegistration
 
+register_subject_to_atlas, register_subjects_to_atlas
+
+Run a multiscale schedule for one subject, or for many subjects in
+parallel, sharing one preprocessed copy of the atlas.
 
 """
 
 import os
+import time
 
 import numpy as np
 import vtk
+from joblib import Parallel, delayed
 
 import whitematteranalysis as wma
 
@@ -40,6 +46,15 @@ class SubjectToAtlasRegistration:
         self.subject_brain_size = 1000
         # options are Affine, Rigid, Nonrigid
         self.mode = "Affine"
+        # compare fibers only with neighbours within a few sigma
+        self.approximate_objective = False
+        # The registration has converged at the current scale when in
+        # one iteration the relative objective improvement or the
+        # transform change is below its tolerance (None: not tested).
+        # See congeal_multisubject.has_converged.
+        self.objective_tolerance = None
+        self.transform_tolerance = None
+        self.converged = False
 
         self.fiber_length = 40
         self.fiber_length_max = 260
@@ -47,11 +62,15 @@ class SubjectToAtlasRegistration:
         # internal stuff
         self.subject_polydata = None
         self.atlas_polydata = None
+        # preprocessed atlas fibers, if given instead of atlas_polydata
+        self.atlas_fibers = None
         self.transform = None
         self.transform_as_array = None
         self.objectives = list()
         self.total_iterations = 0
         self.subject_id = None
+        # length filtered, resampled atlas and subject fibers, by name: (polydata, parameters, array)
+        self._preprocessed = dict()
 
         self.target_landmarks = list()
         self.nonrigid_grid_resolution = 6
@@ -102,8 +121,49 @@ class SubjectToAtlasRegistration:
 
     def set_atlas(self, polydata, atlas_id):
         self.atlas_polydata = polydata
+        self.atlas_fibers = None
         self.atlas_id = atlas_id
 
+    def set_atlas_fibers(self, fibers, atlas_id):
+        """Use atlas fibers already filtered and resampled by
+        preprocess_fibers, as an array of R, A, S by fiber by point or a
+        wma.shared.SharedArray of one. This allows many registrations to
+        share one atlas."""
+
+        self.atlas_polydata = None
+        self.atlas_fibers = fibers
+        self.atlas_id = atlas_id
+
+    def _preprocessed_fibers(self, name, polydata):
+        """Length filtered fibers of polydata, resampled to
+        points_per_fiber, as an array of R, A, S by fiber by point.
+
+        The result is kept until the polydata or the filtering
+        parameters change. Each iteration samples this array, which
+        gives the same fibers as filtering, downsampling and resampling
+        the polydata again.
+        """
+
+        parameters = (self.fiber_length, self.fiber_length_max, self.points_per_fiber)
+        cached = self._preprocessed.get(name)
+        if cached is None or cached[0] is not polydata or cached[1] != parameters:
+            print(f"filtering {name}")
+            cached = (polydata, parameters, preprocess_fibers(polydata, *parameters))
+            self._preprocessed[name] = cached
+        return cached[2]
+
+    def _atlas_fibers(self):
+        """Preprocessed atlas fibers, from set_atlas_fibers or set_atlas."""
+
+        if self.atlas_fibers is None:
+            return self._preprocessed_fibers('atlas', self.atlas_polydata)
+        atlas_fibers = self.atlas_fibers
+        if isinstance(atlas_fibers, wma.shared.SharedArray):
+            atlas_fibers = atlas_fibers.attach()
+        if atlas_fibers.shape[2] != self.points_per_fiber:
+            raise ValueError(f"Atlas fibers have {atlas_fibers.shape[2]} points per fiber, expected {self.points_per_fiber}")
+        return atlas_fibers
+
     def iterate(self):
         self.total_iterations += 1
 
@@ -113,21 +173,17 @@ class SubjectToAtlasRegistration:
         if not os.path.exists(outdir):
             os.makedirs(outdir)
 
-        print("filtering and downsampling atlas")
-        mean_brain = wma.filter.preprocess(self.atlas_polydata, self.fiber_length, max_length_mm=self.fiber_length_max, return_indices=False, preserve_point_data=False, preserve_cell_data=False, verbose=False)
-        mean_brain, tmp = wma.filter.downsample(mean_brain, self.mean_brain_size, return_indices=True, verbose=False, random_seed=self.random_seed+self.total_iterations) 
-
-        mean_fibers = wma.fibers.FiberArray()
-        mean_fibers.convert_from_polydata(mean_brain, self.points_per_fiber)
-        fixed = np.array([mean_fibers.fiber_array_r,mean_fibers.fiber_array_a,mean_fibers.fiber_array_s])
-        
-        print("filtering and downsampling subject")
-        subject_brain = wma.filter.preprocess(self.subject_polydata, self.fiber_length, max_length_mm=self.fiber_length_max, return_indices=False, preserve_point_data=False, preserve_cell_data=False, verbose=False)
-        subject_brain, tmp = wma.filter.downsample(subject_brain, self.subject_brain_size, return_indices=True, verbose=False, random_seed=self.random_seed+self.total_iterations)
+        # Random samples are drawn by index from the length filtered,
+        # resampled fibers, which are only computed once.
+        print("downsampling atlas")
+        atlas_fibers = self._atlas_fibers()
+        line_indices = wma.filter.sample_line_indices(atlas_fibers.shape[1], self.mean_brain_size, random_seed=self.random_seed+self.total_iterations)
+        fixed = atlas_fibers[:, line_indices, :]
 
-        fibers = wma.fibers.FiberArray()
-        fibers.convert_from_polydata(subject_brain, self.points_per_fiber)
-        moving = np.array([fibers.fiber_array_r,fibers.fiber_array_a,fibers.fiber_array_s])
+        print("downsampling subject")
+        subject_fibers = self._preprocessed_fibers('subject', self.subject_polydata)
+        line_indices = wma.filter.sample_line_indices(subject_fibers.shape[1], self.subject_brain_size, random_seed=self.random_seed+self.total_iterations)
+        moving = subject_fibers[:, line_indices, :]
 
         subject_idx = 1
         iteration_count = self.total_iterations
@@ -135,7 +191,8 @@ class SubjectToAtlasRegistration:
         step_size = np.array([self.initial_step, self.final_step])
         render = False
         
-        (self.transform_as_array, objectives, diff) = wma.congeal_multisubject.congeal_multisubject_inner_loop(fixed, moving, self.transform_as_array, self.mode, self.sigma, subject_idx, iteration_count, self.output_directory, step_size, self.maxfun, render, self.nonrigid_grid_resolution)
+        previous_transform = self.transform_as_array
+        (self.transform_as_array, objectives, diff) = wma.congeal_multisubject.congeal_multisubject_inner_loop(fixed, moving, self.transform_as_array, self.mode, self.sigma, subject_idx, iteration_count, self.output_directory, step_size, self.maxfun, render, self.nonrigid_grid_resolution, approximate=self.approximate_objective)
 
         if self.mode == "Nonrigid":
             vtktrans = wma.register_two_subjects_nonrigid_bsplines.convert_transform_to_vtk(self.transform_as_array)
@@ -145,6 +202,11 @@ class SubjectToAtlasRegistration:
             print(vtktrans.GetMatrix())
         self.transform = vtktrans
 
+        improvement = wma.congeal_multisubject.relative_improvement(objectives[0], objectives[0] + min(diff, 0))
+        change = wma.congeal_multisubject.transform_change(previous_transform, self.transform_as_array, self.mode)
+        self.converged = wma.congeal_multisubject.has_converged(improvement, change, self.objective_tolerance, self.transform_tolerance)
+        print(f"Iteration: {self.total_iterations} relative objective improvement: {improvement} transform change: {change} converged: {self.converged}")
+
         # get the subject's objectives as computed so far
         # also get the total objective right now (future. now just printed to screen)
         # if requested, render all (future)
@@ -212,3 +274,168 @@ class SubjectToAtlasRegistration:
         pd2 = transformer.GetOutput()
         wma.io.write_polydata(pd2, out_fname)
 
+
+def preprocess_fibers(polydata, fiber_length, fiber_length_max, points_per_fiber):
+    """Fibers of polydata between fiber_length and fiber_length_max mm
+    long, resampled to points_per_fiber, as an array of R, A, S by fiber
+    by point."""
+
+    pd = wma.filter.preprocess(polydata, fiber_length, max_length_mm=fiber_length_max, return_indices=False, preserve_point_data=False, preserve_cell_data=False, verbose=False)
+    fibers = wma.fibers.FiberArray()
+    fibers.convert_from_polydata(pd, points_per_fiber)
+    return np.array([fibers.fiber_array_r, fibers.fiber_array_a, fibers.fiber_array_s])
+
+
+def run_schedule(register, schedule, progress_filename, verbose=False):
+    """Run the multiscale registration schedule with register, a
+    SubjectToAtlasRegistration with its subject and atlas set.
+
+    schedule is a dictionary of per-scale lists: sigma, iterations,
+    maxfun, mean_brain_size, subject_brain_size, initial_step and
+    final_step, plus grid_resolution for Nonrigid mode and optionally
+    rigid (true for scales run in Rigid mode). Progress is written to
+    progress_filename. A scale ends early when the registration has
+    converged (see objective_tolerance and transform_tolerance).
+    """
+
+    iterations_per_scale = schedule['iterations']
+    mean_brain_size_per_scale = schedule['mean_brain_size']
+    subject_brain_size_per_scale = schedule['subject_brain_size']
+    total_iterations = np.sum(np.array(iterations_per_scale))
+    iteration = 1
+    # estimate percentage complete based on number of fibers compared,
+    # because the times cobyla calls the objective function are approx
+    # constant per scale (except first scale where they are cut short)
+    total_comparisons = np.multiply(iterations_per_scale, np.multiply(np.array(mean_brain_size_per_scale), np.array(subject_brain_size_per_scale)))
+    total_comparisons = np.sum(total_comparisons)
+    comparisons_so_far = 0
+
+    progress_file = open(progress_filename, 'w')
+    print(f"Beginning registration. Total iterations will be: {total_iterations}", file=progress_file)
+    print(f"Start date: {time.strftime('%x')}", file=progress_file)
+    print(f"Start time: {time.strftime('%X')}\n", file=progress_file)
+    progress_file.close()
+    prev_time = time.time()
+
+    do_scales = list(range(len(schedule['sigma'])))
+
+    for scale in do_scales:
+        register.sigma = schedule['sigma'][scale]
+        register.initial_step = schedule['initial_step'][scale]
+        register.final_step = schedule['final_step'][scale]
+        register.maxfun = schedule['maxfun'][scale]
+        register.mean_brain_size = mean_brain_size_per_scale[scale]
+        register.subject_brain_size = subject_brain_size_per_scale[scale]
+        if register.mode == "Nonrigid":
+            register.nonrigid_grid_resolution = schedule['grid_resolution'][scale]
+            register.update_nonrigid_grid()
+        if 'rigid' in schedule:
+            if schedule['rigid'][scale]:
+                register.mode = "Rigid"
+            else:
+                register.mode = "Affine"
+
+        for idx in range(0, iterations_per_scale[scale]):
+            register.iterate()
+            comparisons_this_scale = mean_brain_size_per_scale[scale]*subject_brain_size_per_scale[scale]
+            comparisons_so_far += comparisons_this_scale
+            percent = 100*(float(comparisons_so_far)/total_comparisons)
+            print(f"Done iteration {iteration} / {total_iterations}. Percent finished approx: {percent:.2f}")
+            progress_file = open(progress_filename, 'a')
+            curr_time = time.time()
+            print(f"Done iteration {iteration} / {total_iterations}. Percent finished approx: {percent:.2f}. Time: {time.strftime('%X')}. Minutes Elapsed: {(curr_time - prev_time) / 60}", file=progress_file)
+            progress_file.close()
+            prev_time = curr_time
+            iteration += 1
+            # Intermediate save. For testing only.
+            if verbose:
+                register.save_transformed_polydata(intermediate_save=True)
+
+            if register.converged:
+                comparisons_so_far += (iterations_per_scale[scale] - idx - 1) * comparisons_this_scale
+                print(f"<{os.path.basename(__file__)}> Converged at scale {scale + 1} / {len(do_scales)} after {idx + 1} iterations.")
+                progress_file = open(progress_filename, 'a')
+                print(f"Converged at scale {scale + 1} / {len(do_scales)} after {idx + 1} iterations.", file=progress_file)
+                progress_file.close()
+                break
+
+    # Final save when we are done
+    register.save_transformed_polydata()
+
+    progress_file = open(progress_filename, 'a')
+    print("\nFinished registration.", file=progress_file)
+    print(f"End date: {time.strftime('%x')}", file=progress_file)
+    print(f"End time: {time.strftime('%X')}", file=progress_file)
+    progress_file.close()
+
+
+def register_subject_to_atlas(subject_filename, atlas_fibers, atlas_id, output_directory, schedule, settings, verbose=False):
+    """Register one subject's tractography file to the atlas with
+    run_schedule. Outputs go to a directory named by the subject in
+    output_directory.
+
+    atlas_fibers is the atlas from preprocess_fibers, or a
+    wma.shared.SharedArray of it. settings is a dictionary of
+    SubjectToAtlasRegistration attributes, such as mode, fiber_length,
+    fiber_length_max and points_per_fiber.
+    """
+
+    subject_id = os.path.splitext(os.path.basename(subject_filename))[0]
+    subject_outdir = os.path.join(output_directory, subject_id)
+    if not os.path.exists(subject_outdir):
+        print(f"<{os.path.basename(__file__)}> Output directory {subject_outdir} does not exist, creating it.")
+        os.makedirs(subject_outdir)
+
+    register = SubjectToAtlasRegistration()
+    for (name, value) in settings.items():
+        setattr(register, name, value)
+    register.output_directory = subject_outdir
+    register.input_polydata_filename = subject_filename
+    # We have to add polydatas after setting nonrigid in the register object
+    subject_pd = wma.io.read_polydata(subject_filename)
+    register.set_subject(subject_pd, subject_id)
+    register.set_atlas_fibers(atlas_fibers, atlas_id)
+
+    run_schedule(register, schedule, os.path.join(subject_outdir, 'progress.txt'), verbose=verbose)
+    print(f"Done registering. See output in: {subject_outdir}")
+    return subject_outdir
+
+
+def _register_subject_to_atlas_job(subject_filename, atlas_fibers, atlas_id, output_directory, schedule, settings, verbose):
+    """register_subject_to_atlas for Parallel. Returns None on success
+    or an error message, so one failed subject does not stop the batch."""
+
+    try:
+        register_subject_to_atlas(subject_filename, atlas_fibers, atlas_id, output_directory, schedule, settings, verbose=verbose)
+    except Exception as err:
+        return f"{type(err).__name__}: {err}"
+    return None
+
+
+def register_subjects_to_atlas(subject_filenames, atlas_polydata, atlas_id, output_directory, schedule, settings, parallel_jobs=1, verbose=False):
+    """Register many subjects to one atlas, parallel_jobs at a time.
+
+    The atlas is filtered and resampled once, and shared read-only with
+    the worker processes. Returns a list of (subject file, error message)
+    for the subjects that failed.
+    """
+
+    register = SubjectToAtlasRegistration()
+    for (name, value) in settings.items():
+        setattr(register, name, value)
+    print(f"<{os.path.basename(__file__)}> Preprocessing atlas {atlas_id} once for {len(subject_filenames)} subjects.")
+    atlas_fibers = preprocess_fibers(atlas_polydata, register.fiber_length, register.fiber_length_max, register.points_per_fiber)
+
+    with wma.shared.SharedArrays() as shared:
+        shared_atlas = shared.add('atlas', atlas_fibers)
+        errors = Parallel(
+            n_jobs=parallel_jobs, verbose=0)(
+                delayed(_register_subject_to_atlas_job)(subject_filename, shared_atlas, atlas_id, output_directory, schedule, settings, verbose)
+                for subject_filename in subject_filenames)
+
+    failures = [(subject_filename, error) for (subject_filename, error) in zip(subject_filenames, errors) if error is not None]
+    for (subject_filename, error) in failures:
+        print(f"<{os.path.basename(__file__)}> ERROR: Failed to register {subject_filename}: {error}")
+    print(f"<{os.path.basename(__file__)}> Registered {len(subject_filenames) - len(failures)} / {len(subject_filenames)} subjects.")
+
+    return failures
@@ -14,6 +14,26 @@ import time
 
 import numpy as np
 import vtk
+from vtk.util import numpy_support
+
+from . import cache
+
+
+def _resampled_point_indices(offsets, points_per_fiber):
+    """Indices of the points kept when each line (points offsets[i] to
+    offsets[i + 1] - 1) is downsampled to points_per_fiber points.
+
+    These are the first and last points plus evenly spaced points in
+    between, rounded to the nearest point as in
+    FiberArray._calculate_line_indices. Returns an array of shape
+    (number of lines, points_per_fiber).
+    """
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = offsets[1:] - offsets[:-1]
+    step = (lengths - 1.0) / (points_per_fiber - 1.0)
+    line_indices = np.round(step[:, np.newaxis] * np.arange(points_per_fiber))
+    return offsets[:-1, np.newaxis] + line_indices.astype(np.int64)
 
 
 class Fiber:
@@ -126,6 +146,8 @@ class FiberArray:
         # output arrays indicating hemisphere/callosal (L,C,R= -1, 0, 1)
         self.fiber_hemisphere = None
         self.hemispheres = False
+        # fraction of a fiber that must be in one hemisphere
+        self.hemisphere_percent_threshold = 0.95
         
         # output boolean arrays for each hemisphere and callosal fibers
         self.is_left_hem = None
@@ -317,7 +339,7 @@ class FiberArray:
 
         return fibers
 
-    def convert_from_polydata(self, input_vtk_polydata, points_per_fiber=None):
+    def convert_from_polydata(self, input_vtk_polydata, points_per_fiber=None, use_cache=True):
 
         """Convert input vtkPolyData to the fixed length fiber
         representation of this class.
@@ -327,6 +349,12 @@ class FiberArray:
         The output is downsampled fibers in array format and
         hemisphere info is also calculated.
 
+        If the tractography cache is enabled (see cache.enable_cache) and
+        use_cache is True, the fiber arrays are looked up by the points
+        and lines of the input and points_per_fiber. Callers converting
+        polydata that is only used once, such as random samples inside
+        registration iterations, should pass use_cache=False.
+
         """
 
         # points used in discretization of each trajectory
@@ -339,48 +367,96 @@ class FiberArray:
         if self.verbose:
             print(f"<{os.path.basename(__file__)}> Converting polydata to array representation. Lines: {self.number_of_fibers}")
 
-        # allocate array number of lines by line length
-        self.fiber_array_r = np.zeros((self.number_of_fibers,
-                                          self.points_per_fiber))
-        self.fiber_array_a = np.zeros((self.number_of_fibers,
-                                          self.points_per_fiber))
-        self.fiber_array_s = np.zeros((self.number_of_fibers,
-                                          self.points_per_fiber))
-
-        # loop over lines
-        input_vtk_polydata.GetLines().InitTraversal()
-        line_ptids = vtk.vtkIdList()
-        inpoints = input_vtk_polydata.GetPoints()
-        
-        for lidx in range(0, self.number_of_fibers):
+        # look up the resampled fibers in the tractography cache, if enabled
+        tract_cache = cache.get_cache() if use_cache else None
+        if tract_cache is not None:
+            key = tract_cache.key('fiber_array', cache.polydata_digest(input_vtk_polydata),
+                                  points_per_fiber=self.points_per_fiber)
+            cached = tract_cache.get(key)
+            if cached is not None:
+                self.fiber_array_r = cached['fiber_array_r']
+                self.fiber_array_a = cached['fiber_array_a']
+                self.fiber_array_s = cached['fiber_array_s']
+                if self.hemispheres:
+                    self.calculate_hemispheres()
+                return
+
+        if self.number_of_fibers == 0:
+            self._set_fiber_arrays(np.zeros((0, self.points_per_fiber, 3)))
+        else:
+            inlines = input_vtk_polydata.GetLines()
+            points = numpy_support.vtk_to_numpy(input_vtk_polydata.GetPoints().GetData())
+            connectivity = numpy_support.vtk_to_numpy(inlines.GetConnectivityArray())
+            offsets = numpy_support.vtk_to_numpy(inlines.GetOffsetsArray())
+            # do nearest neighbor interpolation at the indices that we want
+            point_indices = connectivity[_resampled_point_indices(offsets, self.points_per_fiber)]
+            self._set_fiber_arrays(points[point_indices])
 
-            input_vtk_polydata.GetLines().GetNextCell(line_ptids)
-            line_length = line_ptids.GetNumberOfIds()
+        if tract_cache is not None:
+            tract_cache.put(key, fiber_array_r=self.fiber_array_r, fiber_array_a=self.fiber_array_a, fiber_array_s=self.fiber_array_s)
 
-            if self.verbose:
-                if lidx % 100 == 0:
-                    print(f"<{os.path.basename(__file__)}> Line: {lidx} / {self.number_of_fibers}")
-                    print(f"<{os.path.basename(__file__)}> number of points: {line_length}")
+        # initialize hemisphere info
+        if self.hemispheres:
+            self.calculate_hemispheres()
+            
+    def _set_fiber_arrays(self, resampled_points):
+        """Store (number of fibers, points_per_fiber, 3) points as the
+        r, a and s fiber arrays."""
 
-            # loop over the indices that we want and get those points
-            pidx = 0
-            for line_index in self._calculate_line_indices(line_length,
-                                                 self.points_per_fiber):
+        resampled_points = np.asarray(resampled_points, dtype=np.float64)
+        self.fiber_array_r = np.ascontiguousarray(resampled_points[:, :, 0])
+        self.fiber_array_a = np.ascontiguousarray(resampled_points[:, :, 1])
+        self.fiber_array_s = np.ascontiguousarray(resampled_points[:, :, 2])
 
-                # do nearest neighbor interpolation: round index
-                ptidx = line_ptids.GetId(int(round(line_index)))
+    def convert_from_arrays(self, points, offsets, points_per_fiber=None):
 
-                point = inpoints.GetPoint(ptidx)
+        """Convert lines stored as flat arrays to the fixed length fiber
+        representation of this class.
 
-                self.fiber_array_r[lidx, pidx] = point[0]
-                self.fiber_array_a[lidx, pidx] = point[1]
-                self.fiber_array_s[lidx, pidx] = point[2]
-                pidx = pidx + 1
+        points holds the points of all lines one after another, and line
+        i is points[offsets[i]:offsets[i + 1]], as in
+        io.TractographyArrays. No vtkPolyData is created.
+
+        """
+
+        if points_per_fiber is not None:
+            self.points_per_fiber = points_per_fiber
+
+        self.number_of_fibers = len(offsets) - 1
+        points = np.asarray(points)
+        self._set_fiber_arrays(points[_resampled_point_indices(offsets, self.points_per_fiber)].reshape(-1, self.points_per_fiber, 3))
 
-        # initialize hemisphere info
         if self.hemispheres:
             self.calculate_hemispheres()
-            
+
+    def convert_from_chunks(self, chunks, points_per_fiber=None):
+
+        """Convert an iterable of io.TractographyArrays, such as the
+        chunks of io.iter_tck_chunks or io.iter_trk_chunks, to the fixed
+        length fiber representation of this class.
+
+        Each chunk is resampled as it arrives, so only the resampled
+        fibers of the whole input are kept in memory.
+
+        """
+
+        if points_per_fiber is not None:
+            self.points_per_fiber = points_per_fiber
+
+        resampled = [np.zeros((0, self.points_per_fiber, 3))]
+        for chunk in chunks:
+            point_indices = _resampled_point_indices(chunk.offsets, self.points_per_fiber)
+            resampled.append(np.asarray(chunk.points)[point_indices].astype(np.float64))
+
+        resampled = np.concatenate(resampled)
+        self.number_of_fibers = len(resampled)
+        if self.verbose:
+            print(f"<{os.path.basename(__file__)}> Converted chunks to array representation. Lines: {self.number_of_fibers}")
+        self._set_fiber_arrays(resampled)
+
+        if self.hemispheres:
+            self.calculate_hemispheres()
+
     def calculate_hemispheres(self):
 
         """ For each fiber assign a hemisphere using the first (R)
@@ -12,6 +12,8 @@ distance. Downsample. Mask.  Create symmetrized test data.
 
 preprocess
 downsample
+preprocess_and_downsample
+preprocess_chunks, downsample_chunks, compute_lengths_chunks
 mask
 symmetrize
 remove_hemisphere
@@ -24,6 +26,7 @@ import warnings
 
 import numpy as np
 import vtk
+from vtk.util import numpy_support
 
 from whitematteranalysis.utils.opt_pckg import optional_package
 
@@ -41,23 +44,130 @@ if not have_joblib:
 verbose = 0
 
 
-def add_point_data_array(inpd, data, array_name):
+def _get_line_arrays(inpd):
+    """Return numpy views of the points, line offsets and line
+    connectivity of inpd. No data is copied."""
+
+    points = numpy_support.vtk_to_numpy(inpd.GetPoints().GetData())
+    lines = inpd.GetLines()
+    offsets = numpy_support.vtk_to_numpy(lines.GetOffsetsArray())
+    connectivity = numpy_support.vtk_to_numpy(lines.GetConnectivityArray())
+    return points, offsets, connectivity
+
+
+def _line_point_ranges(starts, lengths):
+    """Concatenate the ranges [start, start + length) of each line."""
+
+    total = int(np.sum(lengths))
+    out_starts = np.cumsum(lengths) - lengths
+    return np.repeat(starts - out_starts, lengths) + np.arange(total, dtype=np.int64)
+
+
+def _set_active_tensors(outpd, tensor_names):
+    """Set one of the expected tensor arrays as default for vis in Slicer."""
+
+    tensors_labeled = False
+    for name in tensor_names:
+        if name in ("tensors", "Tensors", "tensor1", "Tensor1"):
+            outpd.GetPointData().SetTensors(outpd.GetPointData().GetArray(name))
+            tensors_labeled = True
+    if not tensors_labeled:
+        if len(tensor_names) > 0:
+            print(f"Data has unexpected tensor name(s). Unable to set active for visualization: {tensor_names}")
+
+
+def _gather_lines(inpd, line_indices, preserve_point_data=False, preserve_cell_data=False):
+    """Copy the lines of inpd listed in line_indices into a new polydata.
+
+    Points, point data and cell data of the kept lines are gathered
+    directly from the input arrays, so the output is the only copy
+    made. Output arrays keep their input data types and are attached
+    to the polydata without further copying.
+    """
+
+    points, offsets, connectivity = _get_line_arrays(inpd)
+    line_indices = np.asarray(line_indices, dtype=np.int64)
+    starts = offsets[:-1][line_indices]
+    lengths = offsets[1:][line_indices] - starts
+    ptids = connectivity[_line_point_ranges(starts, lengths)]
+
+    out_offsets = np.zeros(len(line_indices) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=out_offsets[1:])
+    out_connectivity = np.arange(out_offsets[-1], dtype=np.int64)
+
+    outpd = vtk.vtkPolyData()
+    outpoints = vtk.vtkPoints()
+    outpoints.SetData(numpy_support.numpy_to_vtk(points[ptids], deep=False))
+    outlines = vtk.vtkCellArray()
+    outlines.SetData(numpy_support.numpy_to_vtk(out_offsets, deep=False, array_type=vtk.VTK_ID_TYPE),
+                     numpy_support.numpy_to_vtk(out_connectivity, deep=False, array_type=vtk.VTK_ID_TYPE))
+    outpd.SetPoints(outpoints)
+    outpd.SetLines(outlines)
+
+    if preserve_point_data:
+        inpointdata = inpd.GetPointData()
+        tensor_names = []
+        for idx in range(inpointdata.GetNumberOfArrays()):
+            array = inpointdata.GetArray(idx)
+            if array is None:
+                continue
+            data = numpy_support.vtk_to_numpy(array)[ptids]
+            out_array = numpy_support.numpy_to_vtk(data, deep=False, array_type=array.GetDataType())
+            out_array.SetName(array.GetName())
+            outpd.GetPointData().AddArray(out_array)
+            if array.GetNumberOfComponents() == 9:
+                tensor_names.append(array.GetName())
+        _set_active_tensors(outpd, tensor_names)
+
+    if preserve_cell_data:
+        incelldata = inpd.GetCellData()
+        for idx in range(incelldata.GetNumberOfArrays()):
+            array = incelldata.GetArray(idx)
+            if array is None:
+                continue
+            data = numpy_support.vtk_to_numpy(array)[line_indices]
+            out_array = numpy_support.numpy_to_vtk(data, deep=False, array_type=array.GetDataType())
+            out_array.SetName(array.GetName())
+            outpd.GetCellData().AddArray(out_array)
+    outpd.GetCellData().SetActiveScalars(None)
+
+    return outpd
+
+
+def line_to_point_data(inpd, data):
+    """Broadcast per-line values to per-point values.
+
+    data has the number of lines of inpd as its first dimension. Each
+    line's value (scalar or tuple) is repeated for every point of the
+    line, using the line lengths from the cell offsets. The returned
+    array is indexed by point id.
+    """
+
+    points, offsets, connectivity = _get_line_arrays(inpd)
+    data = np.asarray(data)
+    per_point = np.repeat(data, np.diff(offsets), axis=0)
+    # lines usually store their points in order, then no scatter is needed
+    if len(connectivity) == len(points) and np.array_equal(connectivity, np.arange(len(points))):
+        return per_point
+    out = np.zeros((len(points),) + data.shape[1:], dtype=data.dtype)
+    out[connectivity] = per_point
+    return out
+
+def add_point_data_array(inpd, data, array_name, array_type=vtk.VTK_FLOAT):
     """Make a vtk point data array from input data array and add to inpd.
 
     Input data must have dimensions of the number of lines in the
     input polydata. The output array will be added to the polydata and
     will be point data, so the per-line values will be duplicated to
     become per-point values (each point on the line) for visualization.
+    The array is of array_type (float by default) and is added without
+    copying the broadcast values.
     """
 
-    ptids = vtk.vtkIdList()
-    inpd.GetLines().InitTraversal()
-    outarray = vtk.vtkFloatArray()
+    dtype = numpy_support.get_numpy_array_type(array_type)
+    per_point = np.ascontiguousarray(line_to_point_data(inpd, data), dtype=dtype)
+    outarray = numpy_support.numpy_to_vtk(per_point, deep=False, array_type=array_type)
     outarray.SetName(array_name)
-    for lidx in range(0, inpd.GetNumberOfLines()):
-        inpd.GetLines().GetNextCell(ptids)
-        for pidx in range(0, ptids.GetNumberOfIds()):
-            outarray.InsertNextTuple1(data[lidx])
     inpd.GetPointData().AddArray(outarray)
 
 def flatten_length_distribution(inpd, min_length_mm=None, max_length_mm=None, num_bins=10, fibers_per_bin=1000, verbose=True):
@@ -115,44 +225,87 @@ def compute_lengths(inpd):
     if (inpd.GetNumberOfLines() == 0) or (inpd.GetNumberOfPoints() == 0):
         print(f"<{os.path.basename(__file__)}> No fibers found in input polydata.")
         return 0, 0
-    
+
+    return _compute_lengths_from_arrays(*_get_line_arrays(inpd))
+
+def _compute_lengths_from_arrays(points, offsets, connectivity):
+    """Array implementation of compute_lengths."""
+
+    line_lengths = np.diff(offsets)
+
     # measure step size (using first line that has >=5 points)
-    cell_idx = 0
-    ptids = vtk.vtkIdList()
-    inpoints = inpd.GetPoints()
-    inpd.GetLines().InitTraversal()
-    while (ptids.GetNumberOfIds() < 5) & (cell_idx < inpd.GetNumberOfLines()):
-        inpd.GetLines().GetNextCell(ptids)
-        ##    inpd.GetLines().GetCell(cell_idx, ptids)
-        ## the GetCell function is not wrapped in Canopy python-vtk
-        cell_idx += 1
-    # make sure we have some points along this fiber
     # In case all fibers in the brain are really short, treat it the same as no fibers.
-    if ptids.GetNumberOfIds() < 5:
+    long_lines = np.nonzero(line_lengths >= 5)[0]
+    if len(long_lines) == 0:
         return 0, 0
-    
+    cell_idx = long_lines[0]
+
     # Use points from the middle of the fiber to estimate step length.
     # This is because the step size may vary near endpoints (in order to include
     # endpoints when downsampling the fiber to reduce file size).
-    step_size = 0.0
-    count = 0.0
-    for ptidx in range(1, ptids.GetNumberOfIds()-1):
-        point0 = inpoints.GetPoint(ptids.GetId(ptidx))
-        point1 = inpoints.GetPoint(ptids.GetId(ptidx + 1))
-        step_size += np.sqrt(np.sum(np.power(np.subtract(point0, point1), 2)))
-        count += 1
-    step_size = step_size / count
-
-    fiber_lengths = list()
-    # loop over lines
-    inpd.GetLines().InitTraversal()
-    num_lines = inpd.GetNumberOfLines()
-    for lidx in range(0, num_lines):
-        inpd.GetLines().GetNextCell(ptids)
-        # save length
-        fiber_lengths.append(ptids.GetNumberOfIds() * step_size)
+    ptids = connectivity[offsets[cell_idx]:offsets[cell_idx + 1]]
+    line_points = points[ptids[1:]].astype(float)
+    step_size = np.mean(np.sqrt(np.sum(np.power(np.diff(line_points, axis=0), 2), axis=1)))
+
+    fiber_lengths = line_lengths * step_size
+
+    return fiber_lengths, step_size
+
+def _preprocess_line_mask(points, offsets, connectivity, min_length_mm,
+                          remove_u=False, remove_u_endpoint_dist=40,
+                          remove_brainstem=False, max_length_mm=None,
+                          verbose=True):
+    """Evaluate the preprocess criteria for every line at once.
+
+    Returns a boolean mask of the lines to keep, the fiber lengths and
+    the step size.
+    """
+
+    fiber_lengths, step_size = _compute_lengths_from_arrays(points, offsets, connectivity)
+
+    if verbose:
+        print(f"<{os.path.basename(__file__)}> Minimum length {min_length_mm} mm. Tractography step size * minimum number of points = {step_size} * {round(min_length_mm / float(step_size))}")
+
+    keep = _line_mask(points, offsets, connectivity, step_size, min_length_mm,
+                      remove_u=remove_u, remove_u_endpoint_dist=remove_u_endpoint_dist,
+                      remove_brainstem=remove_brainstem, max_length_mm=max_length_mm)
+
+    return keep, fiber_lengths, step_size
 
-    return np.array(fiber_lengths), step_size
+def _line_mask(points, offsets, connectivity, step_size, min_length_mm,
+               remove_u=False, remove_u_endpoint_dist=40,
+               remove_brainstem=False, max_length_mm=None):
+    """Boolean mask of the lines meeting the preprocess criteria, for a
+    known tractography step size."""
+
+    min_length_pts = round(min_length_mm / float(step_size))
+    line_lengths = np.diff(offsets)
+
+    # test for line being long enough
+    keep = line_lengths > min_length_pts
+
+    if max_length_mm is not None:
+        keep &= ~(line_lengths * step_size > max_length_mm)
+
+    if remove_u | remove_brainstem:
+        # find first and last points on the fiber
+        nonempty = line_lengths > 0
+        point0 = np.zeros((len(line_lengths), 3))
+        point1 = np.zeros((len(line_lengths), 3))
+        point0[nonempty] = points[connectivity[offsets[:-1][nonempty]]]
+        point1[nonempty] = points[connectivity[offsets[1:][nonempty] - 1]]
+
+    if remove_u:
+        # compute distance between endpoints
+        endpoint_dist = np.sqrt(np.sum(np.power(point0 - point1, 2), axis=1))
+        keep &= ~(endpoint_dist < remove_u_endpoint_dist)
+
+    if remove_brainstem:
+        # compute average SI (third coordinate) < -40
+        mean_sup_inf = (point0[:, 2] + point1[:, 2]) / 2
+        keep &= ~(mean_sup_inf < -40)
+
+    return keep
 
 def preprocess(inpd, min_length_mm,
                remove_u=False,
@@ -185,65 +338,16 @@ def preprocess(inpd, min_length_mm,
             else:
                 return inpd
 
-    
-    fiber_lengths, step_size = compute_lengths(inpd)
-
-    #print "LINES:", inpd.GetNumberOfLines(), "STEP", step_size
-
-    min_length_pts = round(min_length_mm / float(step_size))
-    if verbose:
-        print(f"<{os.path.basename(__file__)}> Minimum length {min_length_mm} mm. Tractography step size * minimum number of points = {step_size} * {min_length_pts}")
 
-    # set up processing and output objects
-    ptids = vtk.vtkIdList()
-    inpoints = inpd.GetPoints()
+    fiber_mask, fiber_lengths, step_size = _preprocess_line_mask(
+        *_get_line_arrays(inpd), min_length_mm,
+        remove_u=remove_u, remove_u_endpoint_dist=remove_u_endpoint_dist,
+        remove_brainstem=remove_brainstem, max_length_mm=max_length_mm,
+        verbose=verbose)
 
-    # loop over lines
-    inpd.GetLines().InitTraversal()
-    num_lines = inpd.GetNumberOfLines()
     # keep track of the lines we will keep
-    line_indices = list()
- 
-    for lidx in range(0, num_lines):
-        inpd.GetLines().GetNextCell(ptids)
-
-        # first figure out whether to keep this line
-        keep_curr_fiber = False
-
-        # test for line being long enough
-        if ptids.GetNumberOfIds() > min_length_pts:
-            keep_curr_fiber = True
+    line_indices = np.nonzero(fiber_mask)[0]
 
-            if max_length_mm is not None:
-                if ptids.GetNumberOfIds() * step_size > max_length_mm:
-                    keep_curr_fiber = False
-                
-            if remove_u | remove_brainstem:
-                # find first and last points on the fiber
-                ptid = ptids.GetId(0)
-                point0 = inpoints.GetPoint(ptid)
-                ptid = ptids.GetId(ptids.GetNumberOfIds() - 1)
-                point1 = inpoints.GetPoint(ptid)
-
-            if remove_u:
-                # compute distance between endpoints
-                endpoint_dist = np.sqrt(np.sum(np.power(
-                            np.subtract(point0, point1), 2)))
-                if endpoint_dist < remove_u_endpoint_dist:
-                    keep_curr_fiber = False
-
-            if remove_brainstem:
-                # compute average SI (third coordinate) < -40
-                mean_sup_inf = (point0[2] + point1[2]) / 2
-                if mean_sup_inf < -40:
-                    keep_curr_fiber = False
-
-        # if we are keeping the line record its index
-        if keep_curr_fiber:
-            line_indices.append(lidx)
-
-    fiber_mask = np.zeros(num_lines)
-    fiber_mask[line_indices] = 1
     outpd = mask(inpd, fiber_mask, preserve_point_data=preserve_point_data, preserve_cell_data=preserve_cell_data, verbose=verbose)
 
     if return_indices:
@@ -257,8 +361,46 @@ def preprocess(inpd, min_length_mm,
         else:
             return outpd
 
-def downsample(inpd, output_number_of_lines, return_indices=False, preserve_point_data=False, preserve_cell_data=True, initial_indices=None, verbose=True, random_seed=1234):
-    """ Random (down)sampling of fibers without replacement. """
+def random_generator(random_seed=None, subject_index=None):
+    """Return a numpy random Generator for reproducible sampling.
+
+    random_seed may be None (unpredictable output), an integer base
+    seed, or an existing numpy Generator which is returned unchanged.
+    If subject_index is given, an independent stream is derived from
+    the base seed for that subject, so subjects can be sampled in any
+    order or concurrently and still give identical results. The
+    global numpy random state is never modified.
+    """
+
+    if isinstance(random_seed, np.random.Generator):
+        return random_seed
+    if random_seed is None or subject_index is None:
+        return np.random.default_rng(random_seed)
+    return np.random.default_rng(np.random.SeedSequence(random_seed, spawn_key=(subject_index,)))
+
+def sample_line_indices(num_lines, output_number_of_lines, random_seed=1234):
+    """Sorted random sample of output_number_of_lines indices from
+    range(num_lines), without replacement.
+
+    Indices are drawn directly, without permuting all lines. If there
+    are not more lines than requested, all indices are returned.
+    """
+
+    if num_lines <= output_number_of_lines:
+        return np.arange(num_lines)
+
+    rng = random_generator(random_seed)
+    return np.sort(rng.choice(num_lines, size=output_number_of_lines, replace=False))
+
+def downsample(inpd, output_number_of_lines, return_indices=False, preserve_point_data=False, preserve_cell_data=True, initial_indices=None, verbose=True, random_seed=1234, indices_only=False):
+    """ Random (down)sampling of fibers without replacement.
+
+    random_seed may be an integer seed, None, or a numpy Generator (see
+    random_generator). If indices_only is True, only the sorted indices
+    of the sampled lines are returned and no polydata is created, so
+    callers can gather the lines once together with any other
+    selection.
+    """
 
     if initial_indices is None:
         num_lines = inpd.GetNumberOfLines()
@@ -266,39 +408,235 @@ def downsample(inpd, output_number_of_lines, return_indices=False, preserve_poin
         num_lines = len(initial_indices)
 
     if num_lines < output_number_of_lines:
+        if indices_only or return_indices:
+            if initial_indices is None:
+                line_indices = np.arange(num_lines)
+            else:
+                line_indices = np.sort(initial_indices)
+            if indices_only:
+                return line_indices
+            return inpd, line_indices
         return inpd
 
-    # use the input random seed every time for code testing experiments
-    if random_seed is not None:
-        if verbose:
-            print(f"<{os.path.basename(__file__)}> Setting random seed to {random_seed}")
-        np.random.seed(seed=random_seed)
+    if verbose and random_seed is not None:
+        print(f"<{os.path.basename(__file__)}> Using random seed {random_seed}")
 
     # randomly pick the lines that we will keep
-    line_indices = np.random.permutation(num_lines)
-    if initial_indices is None:
-        line_indices = line_indices[0:output_number_of_lines]
-        fiber_mask = np.zeros(num_lines)
-        fiber_mask[line_indices] = 1
-    else:
-        line_indices = initial_indices[line_indices[0:output_number_of_lines]]
-        fiber_mask = np.zeros(inpd.GetNumberOfLines())
-        fiber_mask[line_indices] = 1
+    line_indices = sample_line_indices(num_lines, output_number_of_lines, random_seed=random_seed)
+    if initial_indices is not None:
+        line_indices = np.sort(np.asarray(initial_indices)[line_indices])
 
-    # don't color by line index by default, preserve whatever was there
-    #outpd = mask(inpd, fiber_mask, fiber_mask)
-    outpd = mask(inpd, fiber_mask, preserve_point_data=preserve_point_data, preserve_cell_data=preserve_cell_data, verbose=verbose)
+    if indices_only:
+        return line_indices
+
+    # don't color by line index by default, preserve whatever was there.
+    # Lines are gathered in input order.
+    outpd = _gather_lines(inpd, line_indices, preserve_point_data=preserve_point_data, preserve_cell_data=preserve_cell_data)
+
+    if verbose:
+        print(f"<{os.path.basename(__file__)}> Fibers sampled: {outpd.GetNumberOfLines()} / {inpd.GetNumberOfLines()}")
 
-    # final line count
-    #print(f"<{os.path.basename(__file__)}> Number of lines selected: {outpd.GetNumberOfLines()}")
     if return_indices:
         # return sorted indices, this is the line ordering of output
         # polydata (because we mask rather than changing input line order)
-        return outpd, np.sort(line_indices)
+        return outpd, line_indices
+    else:
+        return outpd
+
+
+def preprocess_and_downsample(inpd, min_length_mm=None, output_number_of_lines=None,
+                              remove_u=False,
+                              remove_u_endpoint_dist=40,
+                              remove_brainstem=False,
+                              max_length_mm=None,
+                              return_indices=False,
+                              preserve_point_data=False,
+                              preserve_cell_data=False,
+                              verbose=True, random_seed=1234):
+    """Length filter and randomly downsample fibers, copying data once.
+
+    Gives the same fibers as preprocess followed by downsample, but the
+    length and u-fiber criteria and the random sample are computed on
+    the input arrays, and only the surviving lines (with their point and
+    cell data) are gathered into the output. Peak memory is the input
+    plus the output, rather than one extra full copy per stage.
+
+    If min_length_mm and max_length_mm are None, no length filtering is
+    done. If output_number_of_lines is None, all retained fibers are
+    kept. random_seed is handled as in downsample.
+
+    """
+
+    # Make sure we have lines and points.
+    if (inpd.GetNumberOfLines() == 0) or (inpd.GetNumberOfPoints() == 0):
+        print(f"<{os.path.basename(__file__)}> No fibers found in input polydata.")
+        if return_indices:
+            return inpd, np.array([], dtype=int)
+        else:
+            return inpd
+
+    points, offsets, connectivity = _get_line_arrays(inpd)
+    num_lines = len(offsets) - 1
+
+    if (min_length_mm is None) and (max_length_mm is None) and not (remove_u | remove_brainstem):
+        line_indices = np.arange(num_lines)
+    else:
+        if min_length_mm is None:
+            min_length_mm = 0
+        fiber_mask, fiber_lengths, step_size = _preprocess_line_mask(
+            points, offsets, connectivity, min_length_mm,
+            remove_u=remove_u, remove_u_endpoint_dist=remove_u_endpoint_dist,
+            remove_brainstem=remove_brainstem, max_length_mm=max_length_mm,
+            verbose=verbose)
+        line_indices = np.nonzero(fiber_mask)[0]
+
+    if output_number_of_lines is not None:
+        # keep the input line order, as downsample does
+        sample = sample_line_indices(len(line_indices), output_number_of_lines, random_seed=random_seed)
+        line_indices = line_indices[sample]
+
+    outpd = _gather_lines(inpd, line_indices, preserve_point_data=preserve_point_data, preserve_cell_data=preserve_cell_data)
+
+    if verbose:
+        print(f"<{os.path.basename(__file__)}> Fibers sampled: {outpd.GetNumberOfLines()} / {num_lines}")
+
+    if return_indices:
+        return outpd, line_indices
     else:
         return outpd
 
 
+def _chunk_line_arrays(chunk):
+    """Points, offsets and connectivity of a chunk of streamlines (an
+    io.TractographyArrays), whose lines store their points in order."""
+
+    points = np.asarray(chunk.points)
+    return points, np.asarray(chunk.offsets), np.arange(len(points))
+
+def compute_lengths_chunks(chunks):
+    """Streaming version of compute_lengths for an iterable of chunks of
+    streamlines (see io.iter_tractography_chunks). Returns lengths and
+    step size.
+
+    Only the number of points of each line is kept in memory. The step
+    size is estimated from the first line with at least 5 points, as in
+    compute_lengths.
+    """
+
+    line_lengths = list()
+    step_size = None
+    for chunk in chunks:
+        line_lengths.append(np.diff(np.asarray(chunk.offsets)))
+        if step_size is None and chunk.number_of_lines:
+            fiber_lengths, chunk_step_size = _compute_lengths_from_arrays(*_chunk_line_arrays(chunk))
+            if chunk_step_size != 0:
+                step_size = chunk_step_size
+
+    if step_size is None:
+        print(f"<{os.path.basename(__file__)}> No fibers found in input chunks.")
+        return 0, 0
+
+    return np.concatenate(line_lengths) * step_size, step_size
+
+def preprocess_chunks(chunks, min_length_mm,
+                      remove_u=False,
+                      remove_u_endpoint_dist=40,
+                      remove_brainstem=False,
+                      preserve_point_data=False,
+                      preserve_cell_data=False,
+                      verbose=True, max_length_mm=None):
+    """Streaming version of preprocess for an iterable of chunks of
+    streamlines (see io.iter_tractography_chunks).
+
+    Yields the retained lines of each chunk as io.TractographyArrays,
+    in input order. The step size is estimated from the first chunk
+    containing a line with at least 5 points, so chunks are only
+    buffered until that line is found.
+    """
+
+    step_size = None
+    pending = list()
+    for chunk in chunks:
+        if step_size is None:
+            pending.append(chunk)
+            if chunk.number_of_lines:
+                fiber_lengths, chunk_step_size = _compute_lengths_from_arrays(*_chunk_line_arrays(chunk))
+                if chunk_step_size != 0:
+                    step_size = chunk_step_size
+            if step_size is None:
+                continue
+            if verbose:
+                print(f"<{os.path.basename(__file__)}> Minimum length {min_length_mm} mm. Tractography step size * minimum number of points = {step_size} * {round(min_length_mm / float(step_size))}")
+            ready, pending = pending, list()
+        else:
+            ready = [chunk]
+
+        for chunk in ready:
+            keep = _line_mask(*_chunk_line_arrays(chunk), step_size, min_length_mm,
+                              remove_u=remove_u, remove_u_endpoint_dist=remove_u_endpoint_dist,
+                              remove_brainstem=remove_brainstem, max_length_mm=max_length_mm)
+            yield chunk.select_lines(np.nonzero(keep)[0], preserve_point_data=preserve_point_data, preserve_cell_data=preserve_cell_data)
+
+    if pending:
+        print(f"<{os.path.basename(__file__)}> No fibers found in input chunks.")
+
+def downsample_chunks(chunks, output_number_of_lines, return_indices=False, preserve_point_data=False, preserve_cell_data=True, verbose=True, random_seed=1234):
+    """Streaming version of downsample for an iterable of chunks of
+    streamlines (see io.iter_tractography_chunks).
+
+    Reservoir sampling: every line gets a random key and the lines with
+    the output_number_of_lines smallest keys seen so far are kept, so
+    memory is bounded by the output plus one chunk. Returns the sampled
+    lines in input order as io.TractographyArrays, and their indices if
+    return_indices is True. random_seed is handled as in downsample,
+    but the sample differs from the one downsample draws.
+    """
+
+    from . import io
+
+    rng = random_generator(random_seed)
+    reservoir = None
+    reservoir_keys = np.zeros(0)
+    reservoir_indices = np.zeros(0, dtype=np.int64)
+    num_lines = 0
+    for chunk in chunks:
+        keys = rng.random(chunk.number_of_lines)
+        line_indices = np.arange(num_lines, num_lines + chunk.number_of_lines)
+        num_lines += chunk.number_of_lines
+
+        # only lines with keys below the largest kept key can enter a full reservoir
+        candidates = np.arange(chunk.number_of_lines)
+        if len(reservoir_keys) == output_number_of_lines:
+            candidates = np.nonzero(keys < reservoir_keys.max())[0]
+        if len(candidates) == 0:
+            continue
+
+        keys = np.concatenate((reservoir_keys, keys[candidates]))
+        line_indices = np.concatenate((reservoir_indices, line_indices[candidates]))
+        selected = chunk.select_lines(candidates, preserve_point_data=preserve_point_data, preserve_cell_data=preserve_cell_data)
+        reservoir = selected if reservoir is None else io.concatenate_tractography_arrays([reservoir, selected])
+        if len(keys) > output_number_of_lines:
+            keep = np.argpartition(keys, output_number_of_lines - 1)[:output_number_of_lines]
+            keys = keys[keep]
+            line_indices = line_indices[keep]
+            reservoir = reservoir.select_lines(keep)
+        reservoir_keys = keys
+        reservoir_indices = line_indices
+
+    if reservoir is None:
+        reservoir = io.concatenate_tractography_arrays([])
+
+    # output lines in input order
+    order = np.argsort(reservoir_indices)
+    outarrays = reservoir.select_lines(order)
+    if verbose:
+        print(f"<{os.path.basename(__file__)}> Fibers sampled: {outarrays.number_of_lines} / {num_lines}")
+
+    if return_indices:
+        return outarrays, reservoir_indices[order]
+    else:
+        return outarrays
+
 def mask(inpd, fiber_mask, color=None, preserve_point_data=False, preserve_cell_data=True, verbose=True):
     """ Keep lines and their points where fiber_mask == 1.
 
@@ -401,23 +739,7 @@ def mask(inpd, fiber_mask, color=None, preserve_point_data=False, preserve_cell_
     #ren = wma.render.render(output_polydata_s, 1000, data_mode="Cell", data_name='EmbeddingColor')
 
     # For Slicer: First set one of the expected tensor arrays as default for vis
-    tensors_labeled = False
-    for name in tensor_names:
-        if name == "tensors":
-            outpd.GetPointData().SetTensors(outpd.GetPointData().GetArray("tensors"))
-            tensors_labeled = True
-        if name == "Tensors":
-            outpd.GetPointData().SetTensors(outpd.GetPointData().GetArray("Tensors"))
-            tensors_labeled = True
-        if name == "tensor1":
-            outpd.GetPointData().SetTensors(outpd.GetPointData().GetArray("tensor1"))
-            tensors_labeled = True
-        if name == "Tensor1":
-            outpd.GetPointData().SetTensors(outpd.GetPointData().GetArray("Tensor1"))
-            tensors_labeled = True
-    if not tensors_labeled:
-        if len(tensor_names) > 0:
-            print(f"Data has unexpected tensor name(s). Unable to set active for visualization: {tensor_names}")
+    _set_active_tensors(outpd, tensor_names)
     # now set cell data visualization inactive.
     outpd.GetCellData().SetActiveScalars(None)
                 
@@ -479,57 +801,42 @@ def mask(inpd, fiber_mask, color=None, preserve_point_data=False, preserve_cell_
 def symmetrize(inpd):
     """Generate symmetric polydata by reflecting.
 
-    Output polydata has twice as many lines as input.
+    Output polydata has twice as many lines as input. Each input line
+    is followed by its reflection, and the reflected points are stored
+    after all input points.
 
     """
 
-    # output and temporary objects
-    ptids = vtk.vtkIdList()
-    points = inpd.GetPoints()
+    points, offsets, connectivity = _get_line_arrays(inpd)
+    number_of_points = len(points)
+    print(f"<{os.path.basename(__file__)}> Input number of points: {number_of_points}")
+
+    # reflect (RAS -> reflect first value) the points of every line,
+    # appending them to the END of the point array
+    refpoints = points[connectivity]
+    refpoints[:, 0] = -refpoints[:, 0]
+    outpoints_array = np.concatenate((points, refpoints))
+
+    # insert fiber (ptids are same since new points go at the end),
+    # then its reflection, whose ptids are shifted by the input point count
+    all_connectivity = np.concatenate(
+        (connectivity, number_of_points + np.arange(len(connectivity), dtype=np.int64)))
+    starts = np.stack((offsets[:-1], len(connectivity) + offsets[:-1]), axis=1).ravel()
+    lengths = np.repeat(np.diff(offsets), 2)
+    out_connectivity = all_connectivity[_line_point_ranges(starts, lengths)]
+    out_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=out_offsets[1:])
+
     outpd = vtk.vtkPolyData()
-    outlines = vtk.vtkCellArray()
     outpoints = vtk.vtkPoints()
-    outpoints.DeepCopy(points)
-
-    # loop over lines
-    inpd.GetLines().InitTraversal()
-    outlines.InitTraversal()
+    outpoints.SetData(numpy_support.numpy_to_vtk(outpoints_array, deep=False))
+    outlines = vtk.vtkCellArray()
+    outlines.SetData(numpy_support.numpy_to_vtk(out_offsets, deep=False, array_type=vtk.VTK_ID_TYPE),
+                     numpy_support.numpy_to_vtk(out_connectivity, deep=False, array_type=vtk.VTK_ID_TYPE))
 
     # set scalar cell data to 1 for orig, -1 for reflect, for vis
-    outcolors = vtk.vtkFloatArray()
-
-    # index into end of point array
-    lastidx = outpoints.GetNumberOfPoints()
-    print(f"<{os.path.basename(__file__)}> Input number of points: {lastidx}")
-
-    # loop over all lines, insert line and reflected copy into output pd
-    for lidx in range(0, inpd.GetNumberOfLines()):
-        # progress
-        if verbose:
-            if lidx % 100 == 0:
-                print(f"<{os.path.basename(__file__)}> Line: {lidx} / {inpd.GetNumberOfLines()}")
-
-        inpd.GetLines().GetNextCell(ptids)
-
-        num_points = ptids.GetNumberOfIds()
-
-        # insert fiber (ptids are same since new points go at the end)
-        outlines.InsertNextCell(ptids)
-        outcolors.InsertNextTuple1(1)
-
-        # insert reflection into END of point array and into line array
-        refptids = vtk.vtkIdList()
-        for pidx in range(0, num_points):
-
-            point = points.GetPoint(ptids.GetId(pidx))
-
-            # reflect (RAS -> reflect first value)
-            refpoint = (-point[0], point[1], point[2])
-            idx = outpoints.InsertNextPoint(refpoint)
-            refptids.InsertNextId(idx)
-
-        outlines.InsertNextCell(refptids)
-        outcolors.InsertNextTuple1(-1)
+    outcolors = numpy_support.numpy_to_vtk(
+        np.tile(np.array([1, -1], dtype=np.float32), len(offsets) - 1), deep=False)
 
     # put data into output polydata
     outpd.SetLines(outlines)
@@ -539,51 +846,80 @@ def symmetrize(inpd):
     return outpd
 
 
-def remove_hemisphere(inpd, hemisphere=-1):
-    """ Remove left (-1) or right (+1) hemisphere points. """
+def remove_hemisphere(inpd, hemisphere=-1, preserve_point_data=False, preserve_cell_data=False, verbose=False):
+    """ Remove left (-1) or right (+1) hemisphere points.
 
-    # output and temporary objects
-    ptids = vtk.vtkIdList()
-    outpd = vtk.vtkPolyData()
-    outlines = vtk.vtkCellArray()
-    outlines.InitTraversal()
-    outpoints = vtk.vtkPoints()
+    Lines are clipped at the midline: each run of consecutive points
+    in the kept hemisphere becomes its own output line, so a fiber
+    crossing the midline several times gives several pieces. Pieces
+    with fewer than two points are discarded. Cell data of a piece is
+    taken from the line it came from.
 
-    # loop over lines
-    inpd.GetLines().InitTraversal()
+    """
 
-    # loop over all lines, inserting into output only
-    # the part in the correct hemisphere
-    for lidx in range(0, inpd.GetNumberOfLines()):
-        # progress
-        if verbose:
-            if lidx % 100 == 0:
-                print(f"<{os.path.basename(__file__)}> Line: {lidx} / {inpd.GetNumberOfLines()}")
+    points, offsets, connectivity = _get_line_arrays(inpd)
+    number_of_lines = len(offsets) - 1
+    lengths = np.diff(offsets)
 
-        inpd.GetLines().GetNextCell(ptids)
+    # if we keep this point (if not in removed hemisphere)
+    coordinate_r = points[connectivity, 0]
+    if hemisphere == 1:
+        keep = coordinate_r < 0
+    else:
+        keep = coordinate_r > 0
 
-        num_points = ptids.GetNumberOfIds()
+    # a piece starts at a kept point that begins a line or follows a removed point
+    line_start = np.zeros(len(connectivity), dtype=bool)
+    line_start[offsets[:-1][lengths > 0]] = True
+    previous_kept = np.concatenate(([False], keep[:-1]))
+    piece_start = keep & (line_start | ~previous_kept)
 
-        # insert kept points into point array and into line array
-        keptptids = vtk.vtkIdList()
-        for pidx in range(0, num_points):
+    kept_positions = np.nonzero(keep)[0]
+    piece_ids = np.cumsum(piece_start)[kept_positions] - 1
+    piece_lengths = np.bincount(piece_ids, minlength=int(np.sum(piece_start)))
+    piece_lines = np.repeat(np.arange(number_of_lines), lengths)[piece_start]
 
-            point = inpd.GetPoints().GetPoint(ptids.GetId(pidx))
+    # discard pieces that are single points
+    long_pieces = piece_lengths >= 2
+    kept_positions = kept_positions[long_pieces[piece_ids]]
+    piece_lengths = piece_lengths[long_pieces]
+    piece_lines = piece_lines[long_pieces]
 
-            # if we keep this point (if not in removed hemisphere)
-            if ((point[0] < 0) &
-                (hemisphere == 1)) | ((point[0] > 0) &
-                                      (hemisphere == -1)):
+    if verbose:
+        print(f"<{os.path.basename(__file__)}> Lines: {number_of_lines} Output line pieces: {len(piece_lengths)}")
 
-                idx = outpoints.InsertNextPoint(point)
-                keptptids.InsertNextIdx(idx)
+    ptids = connectivity[kept_positions]
+    out_offsets = np.zeros(len(piece_lengths) + 1, dtype=np.int64)
+    np.cumsum(piece_lengths, out=out_offsets[1:])
 
-        outlines.InsertNextCell(keptptids)
+    outpd = vtk.vtkPolyData()
+    outpoints = vtk.vtkPoints()
+    outpoints.SetData(numpy_support.numpy_to_vtk(points[ptids], deep=False))
+    outlines = vtk.vtkCellArray()
+    outlines.SetData(numpy_support.numpy_to_vtk(out_offsets, deep=False, array_type=vtk.VTK_ID_TYPE),
+                     numpy_support.numpy_to_vtk(np.arange(len(ptids), dtype=np.int64), deep=False, array_type=vtk.VTK_ID_TYPE))
 
     # put data into output polydata
     outpd.SetLines(outlines)
     outpd.SetPoints(outpoints)
 
+    if preserve_point_data:
+        for idx in range(inpd.GetPointData().GetNumberOfArrays()):
+            array = inpd.GetPointData().GetArray(idx)
+            if array is None:
+                continue
+            out_array = numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(array)[ptids], deep=False, array_type=array.GetDataType())
+            out_array.SetName(array.GetName())
+            outpd.GetPointData().AddArray(out_array)
+    if preserve_cell_data:
+        for idx in range(inpd.GetCellData().GetNumberOfArrays()):
+            array = inpd.GetCellData().GetArray(idx)
+            if array is None:
+                continue
+            out_array = numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(array)[piece_lines], deep=False, array_type=array.GetDataType())
+            out_array.SetName(array.GetName())
+            outpd.GetCellData().AddArray(out_array)
+
     return outpd
 
 
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+""" harden.py
+
+Native hardening of ITK transforms into tractography, without 3D Slicer.
+
+read_itk_transform
+
+Function to read an ITK transform file: affine and B-spline transforms
+from .tfm/.txt text files (including composite transforms), and
+displacement fields from NIfTI images.
+
+transform_points
+
+Function to apply a list of ITK transforms to RAS points, following the
+3D Slicer hardening conventions.
+
+harden_transform_polydata, harden_transform_directory
+
+Functions to transform the points and tensor point data of vtkPolyData,
+for single polydatas or for whole cluster directories using a pool of
+worker processes.
+
+ITK transform files store resampling transforms in LPS space. As in
+Slicer, hardening a transform into a polydata applies the inverse of the
+stored transform to the (RAS) points, and hardening its inverse applies
+the stored transform itself. This matches the files written by
+io.write_transforms_to_itk_format: hardening with inverse=False moves
+tractography from subject to atlas space, and inverse=True moves it back.
+
+"""
+
+import itertools
+import os
+import shutil
+
+import nibabel
+import numpy as np
+import vtk
+from joblib import Parallel, delayed
+from vtk.util import numpy_support
+
+from . import io
+
+# RAS <-> LPS flip, its own inverse
+_RAS_TO_LPS = np.array([-1.0, -1.0, 1.0])
+
+
+class AffineTransform:
+    """ITK affine (MatrixOffsetTransformBase) transform in LPS space.
+
+    matrix is the 4x4 homogeneous matrix mapping points.
+    """
+
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+    @classmethod
+    def from_parameters(cls, parameters, fixed_parameters):
+        parameters = np.asarray(parameters, dtype=np.float64)
+        linear = parameters[0:9].reshape(3, 3)
+        translation = parameters[9:12]
+        if len(fixed_parameters) >= 3:
+            center = np.asarray(fixed_parameters[0:3], dtype=np.float64)
+        else:
+            center = np.zeros(3)
+        matrix = np.eye(4)
+        matrix[0:3, 0:3] = linear
+        matrix[0:3, 3] = translation + center - linear @ center
+        return cls(matrix)
+
+    def transform_points(self, points):
+        return points @ self.matrix[0:3, 0:3].T + self.matrix[0:3, 3]
+
+    def inverse_transform_points(self, points):
+        inverse = np.linalg.inv(self.matrix)
+        return points @ inverse[0:3, 0:3].T + inverse[0:3, 3]
+
+
+class _DisplacementTransform:
+    """Base for transforms of the form y = x + d(x), where d is sampled on
+    a regular grid. Subclasses implement displacement(points)."""
+
+    def __init__(self, origin, spacing, direction):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.spacing = np.asarray(spacing, dtype=np.float64)
+        self.direction = np.asarray(direction, dtype=np.float64).reshape(3, 3)
+        # physical point -> continuous grid index
+        self._index_matrix = np.linalg.inv(self.direction @ np.diag(self.spacing))
+
+    def continuous_index(self, points):
+        return (points - self.origin) @ self._index_matrix.T
+
+    def transform_points(self, points):
+        return points + self.displacement(points)
+
+    def inverse_transform_points(self, points, maximum_iterations=50, tolerance=1e-4):
+        """Invert by fixed point iteration y <- x - d(y), which converges
+        for the smooth, small deformations produced by registration."""
+        output = points - self.displacement(points)
+        for iteration in range(maximum_iterations):
+            residual = points - self.transform_points(output)
+            output += residual
+            if np.max(np.abs(residual), initial=0.0) < tolerance:
+                break
+        return output
+
+
+def _cubic_bspline(x):
+    x = np.abs(x)
+    return np.where(x < 1.0, (4.0 - 6.0 * x * x + 3.0 * x * x * x) / 6.0,
+                    np.where(x < 2.0, (2.0 - x) ** 3 / 6.0, 0.0))
+
+
+class BSplineTransform(_DisplacementTransform):
+    """ITK cubic B-spline transform in LPS space.
+
+    coefficients has shape (size_x, size_y, size_z, 3). As in ITK, points
+    whose B-spline support is not entirely inside the coefficient grid
+    are not displaced.
+    """
+
+    def __init__(self, coefficients, origin, spacing, direction):
+        super().__init__(origin, spacing, direction)
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+
+    @classmethod
+    def from_parameters(cls, parameters, fixed_parameters):
+        fixed_parameters = np.asarray(fixed_parameters, dtype=np.float64)
+        size = fixed_parameters[0:3].astype(int)
+        # three blocks (x, y, z) of coefficients, with x fastest in each block
+        coefficients = np.asarray(parameters, dtype=np.float64)[0:3 * np.prod(size)]
+        coefficients = coefficients.reshape(3, size[2], size[1], size[0]).transpose(3, 2, 1, 0)
+        return cls(coefficients, fixed_parameters[3:6], fixed_parameters[6:9], fixed_parameters[9:18])
+
+    def displacement(self, points):
+        size = np.array(self.coefficients.shape[0:3])
+        cindex = self.continuous_index(points)
+        start = np.floor(cindex - 1.0).astype(np.int64)
+        inside = np.all((start >= 0) & (start + 3 <= size - 1), axis=1)
+        start = np.clip(start, 0, size - 4)
+        # weights of the 4 supporting nodes along each axis, shape (N, 3, 4)
+        weights = _cubic_bspline(cindex[:, :, np.newaxis] - start[:, :, np.newaxis] - np.arange(4))
+        displacement = np.zeros(points.shape)
+        for a, b, c in itertools.product(range(4), repeat=3):
+            w = weights[:, 0, a] * weights[:, 1, b] * weights[:, 2, c]
+            displacement += w[:, np.newaxis] * self.coefficients[start[:, 0] + a, start[:, 1] + b, start[:, 2] + c]
+        displacement[~inside] = 0.0
+        return displacement
+
+
+class DisplacementFieldTransform(_DisplacementTransform):
+    """ITK displacement field transform in LPS space, linearly interpolated.
+
+    field has shape (size_x, size_y, size_z, 3). Points outside the field
+    are not displaced.
+    """
+
+    def __init__(self, field, origin, spacing, direction):
+        super().__init__(origin, spacing, direction)
+        self.field = np.asarray(field, dtype=np.float64)
+
+    @classmethod
+    def from_nifti(cls, filename):
+        """Read an ITK/ANTs displacement field image. The vectors are
+        stored in LPS; the NIfTI header geometry is in RAS."""
+        image = nibabel.load(filename)
+        field = np.asarray(image.dataobj, dtype=np.float64)
+        field = field.reshape(field.shape[0:3] + (3,))
+        affine = np.diag(np.append(_RAS_TO_LPS, 1.0)) @ image.affine
+        spacing = np.linalg.norm(affine[0:3, 0:3], axis=0)
+        return cls(field, affine[0:3, 3], spacing, affine[0:3, 0:3] / spacing)
+
+    def displacement(self, points):
+        size = np.array(self.field.shape[0:3])
+        cindex = self.continuous_index(points)
+        inside = np.all((cindex >= 0) & (cindex <= size - 1), axis=1)
+        cindex = np.clip(cindex, 0, size - 1)
+        start = np.minimum(np.floor(cindex).astype(np.int64), np.maximum(size - 2, 0))
+        fraction = cindex - start
+        displacement = np.zeros(points.shape)
+        for a, b, c in itertools.product(range(2), repeat=3):
+            w = (np.abs(1 - a - fraction[:, 0]) * np.abs(1 - b - fraction[:, 1]) * np.abs(1 - c - fraction[:, 2]))
+            idx = np.minimum(start + [a, b, c], size - 1)
+            displacement += w[:, np.newaxis] * self.field[idx[:, 0], idx[:, 1], idx[:, 2]]
+        displacement[~inside] = 0.0
+        return displacement
+
+
+_ITK_TRANSFORM_TYPES = {
+    'AffineTransform': AffineTransform,
+    'MatrixOffsetTransformBase': AffineTransform,
+    'BSplineTransform': BSplineTransform,
+    'BSplineDeformableTransform': BSplineTransform,
+}
+
+
+def read_itk_transform(filename):
+    """Read an ITK transform file and return its transforms in file order.
+
+    Text files (.tfm, .txt) may contain affine and B-spline transforms,
+    or a composite of them. NIfTI files (.nii, .nii.gz) are read as
+    displacement fields.
+    """
+
+    if filename.endswith('.nii') or filename.endswith('.nii.gz'):
+        return [DisplacementFieldTransform.from_nifti(filename)]
+
+    blocks = list()
+    with open(filename, 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            key = key.strip()
+            if key == 'Transform':
+                blocks.append({'Transform': value.strip()})
+            elif key in ('Parameters', 'FixedParameters') and blocks:
+                blocks[-1][key] = [float(v) for v in value.split()]
+
+    transforms = list()
+    for block in blocks:
+        transform_type = block['Transform'].split('_')[0]
+        if transform_type == 'CompositeTransform':
+            continue
+        if transform_type not in _ITK_TRANSFORM_TYPES:
+            raise ValueError(f"Unsupported ITK transform type {block['Transform']} in {filename}")
+        transforms.append(_ITK_TRANSFORM_TYPES[transform_type].from_parameters(
+            block.get('Parameters', []), block.get('FixedParameters', [])))
+    if not transforms:
+        raise ValueError(f"No transform found in {filename}")
+
+    return transforms
+
+
+def transform_points(points, transforms, inverse=False):
+    """Harden transforms (as returned by read_itk_transform) into RAS
+    points, the way Slicer does.
+
+    The transforms in a file compose a resampling transform where the
+    last one listed is applied first. With inverse=False the inverse of
+    that resampling transform is applied to the points, with
+    inverse=True the resampling transform itself.
+    """
+
+    output = np.asarray(points, dtype=np.float64) * _RAS_TO_LPS
+    if inverse:
+        for transform in reversed(transforms):
+            output = transform.transform_points(output)
+    else:
+        for transform in transforms:
+            output = transform.inverse_transform_points(output)
+    return output * _RAS_TO_LPS
+
+
+def _reorient_tensors(tensors, jacobians):
+    """Rotate (N, 9) tensors by the rotation part of the local Jacobians
+    (finite strain reorientation)."""
+    u, s, vt = np.linalg.svd(jacobians)
+    rotations = u @ vt
+    tensors = tensors.reshape(-1, 3, 3)
+    return (rotations @ tensors @ rotations.transpose(0, 2, 1)).reshape(-1, 9)
+
+
+def harden_transform_polydata(inpd, transforms, inverse=False, reorient_tensors=True, step=0.5):
+    """Return a copy of inpd with the transforms hardened into its points.
+
+    All 9-component point data arrays are treated as tensors and rotated
+    by the local rotation of the transform, estimated from central
+    differences of size step mm. Other point and cell data are passed
+    through unchanged.
+    """
+
+    outpd = vtk.vtkPolyData()
+    outpd.ShallowCopy(inpd)
+    if inpd.GetNumberOfPoints() == 0:
+        return outpd
+
+    points_array = numpy_support.vtk_to_numpy(inpd.GetPoints().GetData())
+    points = points_array.astype(np.float64)
+    output_points = transform_points(points, transforms, inverse)
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_support.numpy_to_vtk(output_points.astype(points_array.dtype), deep=True))
+    outpd.SetPoints(vtk_points)
+
+    inpointdata = inpd.GetPointData()
+    tensor_indices = [idx for idx in range(inpointdata.GetNumberOfArrays())
+                      if inpointdata.GetArray(idx) is not None and inpointdata.GetArray(idx).GetNumberOfComponents() == 9]
+    if not reorient_tensors or not tensor_indices:
+        return outpd
+
+    jacobians = np.zeros((points.shape[0], 3, 3))
+    for axis in range(3):
+        offset = np.zeros(3)
+        offset[axis] = step
+        jacobians[:, :, axis] = (transform_points(points + offset, transforms, inverse) -
+                                 transform_points(points - offset, transforms, inverse)) / (2.0 * step)
+
+    outpointdata = outpd.GetPointData()
+    for idx in tensor_indices:
+        array = inpointdata.GetArray(idx)
+        tensors = numpy_support.vtk_to_numpy(array)
+        out_array = numpy_support.numpy_to_vtk(_reorient_tensors(tensors.astype(np.float64), jacobians).astype(tensors.dtype), deep=True)
+        out_array.SetName(array.GetName())
+        # replaces the shared input array, keeping its attribute role
+        outpointdata.AddArray(out_array)
+
+    return outpd
+
+
+def _harden_transform_file(in_filename, transform, inverse, out_filename, profile=None, float32=False):
+    """Harden transform (a file name or a list of transforms) into one
+    polydata file. Returns None on success or an error message."""
+
+    tmp_filename = io._temporary_output_filename(out_filename)
+    try:
+        if isinstance(transform, str):
+            transform = read_itk_transform(transform)
+        inpd = io.read_polydata(in_filename)
+        if inpd.GetNumberOfCells() == 0:
+            # empty cluster, nothing to transform
+            shutil.copyfile(in_filename, tmp_filename)
+        else:
+            io.write_polydata(harden_transform_polydata(inpd, transform, inverse), tmp_filename, profile=profile, float32=float32)
+        os.replace(tmp_filename, out_filename)
+    except Exception as err:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        return f"{type(err).__name__}: {err}"
+    return None
+
+
+def harden_transform_directory(input_polydatas, transforms, output_dir, inverse=False, parallel_jobs=1, profile=None, float32=False):
+    """Harden transforms into a list of polydata files in one process
+    pool, writing outputs with the same file names to output_dir.
+
+    transforms is a single transform file (applied to all inputs) or a
+    list with one transform file per input. Existing outputs are kept, so
+    an interrupted run can be resumed. profile and float32 are passed to
+    io.write_polydata. Returns the list of (input file, error message)
+    failures.
+    """
+
+    if isinstance(transforms, str):
+        # read once, workers receive the arrays
+        transforms = [read_itk_transform(transforms)] * len(input_polydatas)
+
+    jobs = list()
+    for in_filename, transform in zip(input_polydatas, transforms):
+        out_filename = os.path.join(output_dir, os.path.basename(in_filename))
+        if not os.path.exists(out_filename):
+            jobs.append((in_filename, transform, out_filename))
+
+    if parallel_jobs is None or parallel_jobs <= 1:
+        errors = [_harden_transform_file(in_filename, transform, inverse, out_filename, profile, float32)
+                  for (in_filename, transform, out_filename) in jobs]
+    else:
+        errors = Parallel(n_jobs=parallel_jobs, verbose=0)(
+            delayed(_harden_transform_file)(in_filename, transform, inverse, out_filename, profile, float32)
+            for (in_filename, transform, out_filename) in jobs)
+
+    failures = [(job[0], error) for (job, error) in zip(jobs, errors) if error is not None]
+    for (in_filename, error) in failures:
+        print(f"<{os.path.basename(__file__)}> ERROR: Failed to transform {in_filename}: {error}")
+
+    return failures
@@ -9,6 +9,21 @@ read_polydata
 
 Function to read vtkPolyData in .vtk or .vtp form
 
+read_tract_cache, write_tract_cache
+
+Functions to read and write tractography in the native array format
+(.wmt directory of memory-mappable .npy files)
+
+iter_tck_chunks, iter_trk_chunks, read_streamline_file
+
+Functions to read MRtrix .tck and TrackVis .trk files through memory
+maps, whole or in chunks of streamlines, without vtkPolyData
+
+iter_tractography_chunks, write_tract_cache_chunks
+
+Functions to process tractography larger than memory one chunk of
+streamlines at a time (see also the *_chunks functions in filter)
+
 write_laterality_results
 
 Function to write laterality indices, histograms, polydata to summarize
@@ -20,19 +35,30 @@ This function reads in the laterality data for further analysis.
 
 """
 
+import collections
+import concurrent.futures
 import glob
+import json
 import os
 import pickle
+import shutil
+import sys
+import tempfile
 import time
 
 import numpy as np
 import vtk
 from joblib import Parallel, delayed
+from vtk.util import numpy_support
 
-from . import filter, render
+from . import cache, filter, render
 
 VERBOSE = 0
 
+# native tractography cache format
+TRACT_CACHE_EXTENSION = '.wmt'
+TRACT_CACHE_VERSION = 1
+
 
 def read_polydata(filename):
     """Read whole-brain tractography as vtkPolyData format."""
@@ -46,6 +72,10 @@ def read_polydata(filename):
         reader = vtk.vtkPolyDataReader()
     elif (extension == '.vtp'):
         reader = vtk.vtkXMLPolyDataReader()
+    elif (extension == TRACT_CACHE_EXTENSION):
+        return read_tract_cache(filename).to_polydata()
+    elif (extension == '.tck' or extension == '.trk'):
+        return read_streamline_file(filename).to_polydata()
     else:
         print('Cannot recognize model file format')
         return None
@@ -68,6 +98,12 @@ def list_vtk_files(input_dir):
     input_pd_fnames = sorted(input_pd_fnames)
     return(input_pd_fnames)
 
+def list_tract_cache_files(input_dir):
+    # Find input native cache (.wmt) directories
+    input_mask = f"{input_dir}/*{TRACT_CACHE_EXTENSION}"
+    input_fnames = [fname for fname in glob.glob(input_mask) if os.path.isdir(fname)]
+    return sorted(input_fnames)
+
 def list_transform_files(input_dir):
     # Find input files
     input_mask = f"{input_dir}/*.tfm"
@@ -75,14 +111,117 @@ def list_transform_files(input_dir):
     input_tf_fnames = sorted(input_tf_fnames)
     return (input_tf_fnames)
 
-def read_and_preprocess_polydata_directory(input_dir, fiber_length, number_of_fibers, random_seed=None, fiber_length_max=None):
-    """ Find and read all .vtk and .vtp files in the given directory
-    input_dir. Preprocess with fiber length threshold and downsample
-    to desired number of fibers."""
-    
+def _read_and_preprocess_subject(fname, sidx, fiber_length, number_of_fibers, random_seed, fiber_length_max, as_arrays):
+    """Read, length threshold and downsample one subject.
+
+    In worker processes the result is returned as TractographyArrays,
+    which pickle as plain numpy arrays. If the tractography cache is
+    enabled and random_seed is an integer, the retained fibers are
+    looked up by file contents and parameters before reading the file.
+    The third value returned tells if the cache was hit (None if it was
+    not consulted).
+    """
+
+    tract_cache = cache.get_cache()
+    if tract_cache is not None and isinstance(random_seed, (int, np.integer)):
+        key = tract_cache.key(
+            'read_and_preprocess', tract_cache.file_digest(fname),
+            fiber_length=fiber_length, number_of_fibers=number_of_fibers,
+            fiber_length_max=fiber_length_max, random_seed=int(random_seed),
+            subject_index=sidx)
+        cached = tract_cache.get(key)
+        if cached is not None:
+            arrays = TractographyArrays(cached['points'], cached['offsets'])
+            if not as_arrays:
+                arrays = arrays.to_polydata()
+            return arrays, int(cached['number_of_input_fibers']), True
+    else:
+        key = None
+
+    pd = read_polydata(fname)
+    number_of_input_fibers = pd.GetNumberOfLines()
+    # length threshold and downsample in one pass, copying the retained fibers once
+    pd2, line_indices = filter.preprocess_and_downsample(pd, min_length_mm=fiber_length, output_number_of_lines=number_of_fibers, max_length_mm=fiber_length_max, return_indices=True, verbose=False, random_seed=filter.random_generator(random_seed, sidx))
+    del pd
+    if key is not None or as_arrays:
+        arrays = TractographyArrays.from_polydata(pd2)
+    if key is not None:
+        tract_cache.put(key, points=arrays.points, offsets=arrays.offsets, line_indices=line_indices,
+                        number_of_input_fibers=np.asarray(number_of_input_fibers))
+    if as_arrays:
+        pd2 = arrays
+    return pd2, number_of_input_fibers, (None if key is None else False)
+
+def iter_read_and_preprocess_polydata_directory(input_dir, fiber_length, number_of_fibers, random_seed=None, fiber_length_max=None, parallel_jobs=1, max_in_flight=None):
+    """ Find all .vtk and .vtp files in the given directory input_dir,
+    and yield (subject_id, polydata) for each, preprocessed with fiber
+    length threshold and downsampled to desired number of fibers.
+
+    Subjects are yielded in sorted file name order, so callers can start
+    using the first subjects while later ones are still loading. With
+    parallel_jobs > 1, subjects are read and reduced in a pool of worker
+    processes, with at most max_in_flight subjects (default twice the
+    number of jobs) read ahead of the consumer. Each subject is sampled
+    with its own random stream derived from random_seed, so results do
+    not depend on the number of jobs. When the tractography cache is
+    enabled (see cache.enable_cache), results for an integer
+    random_seed are reused across runs."""
+
     input_pd_fnames = list_vtk_files(input_dir)
     num_pd = len(input_pd_fnames)
-    
+
+    def _report(sidx, subject_id, number_of_input_fibers, pd):
+        print(f"<{os.path.basename(__file__)}> {sidx + 1} / {num_pd} {subject_id} Input number of fibers: {number_of_input_fibers}")
+        print(f"<{os.path.basename(__file__)}> {sidx + 1} / {num_pd} {subject_id} Length threshold {fiber_length} mm. Downsample to {number_of_fibers} fibers. Number of fibers retained: {pd.GetNumberOfLines()}")
+
+    subject_ids = [os.path.splitext(os.path.basename(fname))[0] for fname in input_pd_fnames]
+
+    if parallel_jobs is None or parallel_jobs <= 1:
+        for sidx, (fname, subject_id) in enumerate(zip(input_pd_fnames, subject_ids)):
+            print(f"<{os.path.basename(__file__)}> {sidx + 1} / {num_pd} {subject_id} Reading {fname}...")
+            pd, number_of_input_fibers, cache_hit = _read_and_preprocess_subject(fname, sidx, fiber_length, number_of_fibers, random_seed, fiber_length_max, False)
+            _report(sidx, subject_id, number_of_input_fibers, pd)
+            yield subject_id, pd
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * parallel_jobs
+    max_in_flight = max(max_in_flight, 1)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=parallel_jobs) as executor:
+        in_flight = collections.deque()
+        next_sidx = 0
+        try:
+            for sidx in range(num_pd):
+                # keep up to max_in_flight subjects submitted ahead of the consumer
+                while next_sidx < num_pd and len(in_flight) < max_in_flight:
+                    print(f"<{os.path.basename(__file__)}> {next_sidx + 1} / {num_pd} {subject_ids[next_sidx]} Reading {input_pd_fnames[next_sidx]}...")
+                    in_flight.append(executor.submit(
+                        _read_and_preprocess_subject, input_pd_fnames[next_sidx], next_sidx,
+                        fiber_length, number_of_fibers, random_seed, fiber_length_max, True))
+                    next_sidx += 1
+                arrays, number_of_input_fibers, cache_hit = in_flight.popleft().result()
+                tract_cache = cache.get_cache()
+                if tract_cache is not None and cache_hit is not None:
+                    # the lookup was done in a worker process
+                    tract_cache.count_lookup(cache_hit)
+                pd = arrays.to_polydata()
+                _report(sidx, subject_ids[sidx], number_of_input_fibers, pd)
+                yield subject_ids[sidx], pd
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+def read_and_preprocess_polydata_directory(input_dir, fiber_length, number_of_fibers, random_seed=None, fiber_length_max=None, parallel_jobs=1, max_in_flight=None):
+    """ Find and read all .vtk and .vtp files in the given directory
+    input_dir. Preprocess with fiber length threshold and downsample
+    to desired number of fibers. Each subject is sampled with its own
+    random stream derived from random_seed. See
+    iter_read_and_preprocess_polydata_directory for parallel_jobs and
+    max_in_flight."""
+
+    num_pd = len(list_vtk_files(input_dir))
+
     print(f"<{os.path.basename(__file__)}> =======================================")
     print(f"<{os.path.basename(__file__)}> Reading vtk and vtp files from directory: {input_dir}")
     print(f"<{os.path.basename(__file__)}> Total number of files found: {num_pd}")
@@ -90,20 +229,13 @@ def read_and_preprocess_polydata_directory(input_dir, fiber_length, number_of_fi
 
     input_pds = list()
     subject_ids = list()
-    sidx = 0
 
-    for fname in input_pd_fnames:
-        subject_id = os.path.splitext(os.path.basename(fname))[0]
+    for subject_id, pd in iter_read_and_preprocess_polydata_directory(
+            input_dir, fiber_length, number_of_fibers, random_seed=random_seed,
+            fiber_length_max=fiber_length_max, parallel_jobs=parallel_jobs,
+            max_in_flight=max_in_flight):
         subject_ids.append(subject_id)
-        print(f"<{os.path.basename(__file__)}> {sidx + 1} / {num_pd} {subject_id} Reading {fname}...")
-        pd = read_polydata(fname)
-        print(f"<{os.path.basename(__file__)}> {sidx + 1} / {num_pd} {subject_id} Input number of fibers: {pd.GetNumberOfLines()}")
-        pd2 = filter.preprocess(pd, min_length_mm=fiber_length, verbose=False, max_length_mm=fiber_length_max)
-        print(f"<{os.path.basename(__file__)}> {sidx + 1} / {num_pd} {subject_id} Length threshold {fiber_length} mm. Number of fibers retained: {pd2.GetNumberOfLines()}")
-        pd3 = filter.downsample(pd2, number_of_fibers, verbose=False, random_seed=random_seed)
-        print(f"<{os.path.basename(__file__)}> {sidx + 1} / num_pd {subject_id} Downsample to {number_of_fibers} fibers. Number of fibers retained: {pd3.GetNumberOfLines()}")
-        input_pds.append(pd3)
-        sidx += 1
+        input_pds.append(pd)
         print(f"<{os.path.basename(__file__)}> =======================================")
 
     print(f"<{os.path.basename(__file__)}> =======================================")
@@ -115,20 +247,108 @@ def read_and_preprocess_polydata_directory(input_dir, fiber_length, number_of_fi
 
     
                             
-def write_polydata(polydata, filename):
-    """Write polydata as vtkPolyData format, according to extension."""
+# Named write profiles for vtp output. The legacy .vtk writer has no
+# compression, so only the float32 option applies to .vtk files.
+# Measured with utilities/wm_benchmark_write_profiles.py on a synthetic
+# 20k fiber tractography (1.6M float points, two noisy tensors and four
+# scalars per point, 172 MB uncompressed). Sizes are relative to the
+# uncompressed arrays; the default mode is larger than raw data because
+# inline binary data is base64 encoded.
+#   profile   size   write MB/s  read MB/s
+#   default   115 %       22          59
+#   fast       97 %     1677        1566
+#   small      87 %        9         147
+#   archive    81 %        3          26
+WRITE_PROFILES = {
+    'fast': {'compressor': 'lz4', 'compression_level': 1, 'block_size': 1 << 20},
+    'small': {'compressor': 'zlib', 'compression_level': 9, 'block_size': 1 << 16},
+    'archive': {'compressor': 'lzma', 'compression_level': 9, 'block_size': 1 << 20},
+}
+
+# Profile used by write_polydata when none is given. None keeps the vtk
+# defaults (zlib, level 5, 32 kB blocks, binary inline data).
+WRITE_PROFILE = None
+
+_VTK_COMPRESSORS = {
+    'none': None,
+    'zlib': 'SetCompressorTypeToZLib',
+    'lz4': 'SetCompressorTypeToLZ4',
+    'lzma': 'SetCompressorTypeToLZMA',
+}
+
+def _downcast_to_float32(polydata):
+    """Shallow copy of polydata with double precision points and point
+    and cell data arrays converted to float."""
+
+    outpd = vtk.vtkPolyData()
+    outpd.ShallowCopy(polydata)
+    points = polydata.GetPoints()
+    if points is not None and points.GetDataType() == vtk.VTK_DOUBLE:
+        outpoints = vtk.vtkPoints()
+        outpoints.SetDataTypeToFloat()
+        outpoints.DeepCopy(points)
+        outpd.SetPoints(outpoints)
+    for data in (outpd.GetPointData(), outpd.GetCellData()):
+        for idx in range(data.GetNumberOfArrays()):
+            array = data.GetArray(idx)
+            if array is not None and array.GetDataType() == vtk.VTK_DOUBLE:
+                outarray = vtk.vtkFloatArray()
+                outarray.DeepCopy(array)
+                # replaces the array of the same name, keeping its attribute role
+                data.AddArray(outarray)
+    return outpd
+
+def write_polydata(polydata, filename, profile=None, float32=False, compressor=None, compression_level=None, block_size=None):
+    """Write polydata as vtkPolyData format, according to extension.
+
+    For .vtp files, profile selects one of WRITE_PROFILES ('fast',
+    'small', 'archive'); it defaults to the module level WRITE_PROFILE.
+    compressor ('zlib', 'lz4', 'lzma' or 'none'), compression_level
+    (1-9) and block_size (bytes) override the profile settings. With a
+    profile or any of these options, data is written in raw appended
+    mode, which avoids base64 encoding. If float32 is True, double
+    precision points and data arrays are written as float.
+    """
 
     if VERBOSE:
         print("Writing ", filename, "...")
 
     basename, extension = os.path.splitext(filename)
 
+    if profile is None:
+        profile = WRITE_PROFILE
+    if profile is not None and profile not in WRITE_PROFILES:
+        raise ValueError(f"Unknown write profile {profile}, expected one of {sorted(WRITE_PROFILES)}")
+    if compressor is not None and compressor not in _VTK_COMPRESSORS:
+        raise ValueError(f"Unknown compressor {compressor}, expected one of {sorted(_VTK_COMPRESSORS)}")
+
+    if float32:
+        polydata = _downcast_to_float32(polydata)
+
     if   (extension == '.vtk'):
         writer = vtk.vtkPolyDataWriter()
         writer.SetFileTypeToBinary()
     elif (extension == '.vtp'):
         writer = vtk.vtkXMLPolyDataWriter()
         writer.SetDataModeToBinary()
+        if profile is not None or compressor is not None or compression_level is not None or block_size is not None:
+            settings = dict(WRITE_PROFILES.get(profile, {}))
+            for key, value in (('compressor', compressor), ('compression_level', compression_level), ('block_size', block_size)):
+                if value is not None:
+                    settings[key] = value
+            writer.SetDataModeToAppended()
+            writer.EncodeAppendedDataOff()
+            if settings.get('compressor', 'zlib') == 'none':
+                writer.SetCompressorTypeToNone()
+            else:
+                getattr(writer, _VTK_COMPRESSORS[settings.get('compressor', 'zlib')])()
+                if 'compression_level' in settings:
+                    writer.SetCompressionLevel(settings['compression_level'])
+            if 'block_size' in settings:
+                writer.SetBlockSize(settings['block_size'])
+    elif (extension == TRACT_CACHE_EXTENSION):
+        write_tract_cache(polydata, filename)
+        return
     else:
         print('Cannot recognize model file format')
         return None
@@ -145,6 +365,516 @@ def write_polydata(polydata, filename):
     if VERBOSE:
         print(f"Done writing {filename}")
 
+class TractographyArrays:
+
+    """Tractography stored as flat numpy arrays.
+
+    points holds the points of all lines, one line after another, and
+    offsets (number of lines + 1) gives the start of each line in
+    points. point_data and cell_data are dictionaries of named
+    per-point and per-line arrays. This is the in-memory form of the
+    native tractography cache format; arrays read from disk are memory
+    mapped and only paged in when used.
+
+    """
+
+    def __init__(self, points, offsets, point_data=None, cell_data=None, active_tensors=None):
+        self.points = points
+        self.offsets = offsets
+        self.point_data = point_data if point_data is not None else dict()
+        self.cell_data = cell_data if cell_data is not None else dict()
+        self.active_tensors = active_tensors
+
+    @property
+    def number_of_lines(self):
+        return len(self.offsets) - 1
+
+    @property
+    def number_of_points(self):
+        return len(self.points)
+
+    @classmethod
+    def from_polydata(cls, polydata):
+        """Get the lines of polydata and their point and cell data.
+
+        Arrays are shared with polydata when its lines store their
+        points in order, and copied into line order otherwise.
+        """
+
+        if polydata.GetNumberOfLines() == 0 or polydata.GetNumberOfPoints() == 0:
+            return cls(np.zeros((0, 3), dtype=np.float32), np.zeros(1, dtype=np.int64))
+
+        points, offsets, connectivity = filter._get_line_arrays(polydata)
+        # lines usually store their points in order, then no gather is needed
+        if len(connectivity) == len(points) and np.array_equal(connectivity, np.arange(len(points))):
+            line_order = slice(None)
+        else:
+            line_order = connectivity
+        point_data = dict()
+        inpointdata = polydata.GetPointData()
+        for idx in range(inpointdata.GetNumberOfArrays()):
+            array = inpointdata.GetArray(idx)
+            if array is not None:
+                point_data[array.GetName()] = numpy_support.vtk_to_numpy(array)[line_order]
+        cell_data = dict()
+        incelldata = polydata.GetCellData()
+        for idx in range(incelldata.GetNumberOfArrays()):
+            array = incelldata.GetArray(idx)
+            if array is not None:
+                cell_data[array.GetName()] = numpy_support.vtk_to_numpy(array)[:len(offsets) - 1].copy()
+        active_tensors = None
+        if inpointdata.GetTensors() is not None:
+            active_tensors = inpointdata.GetTensors().GetName()
+
+        return cls(points[line_order], offsets.astype(np.int64), point_data, cell_data, active_tensors)
+
+    def to_polydata(self):
+        """Wrap the arrays as vtkPolyData without copying them."""
+
+        outpd = vtk.vtkPolyData()
+        outpoints = vtk.vtkPoints()
+        outpoints.SetData(numpy_support.numpy_to_vtk(self.points, deep=False))
+        outlines = vtk.vtkCellArray()
+        outlines.SetData(
+            numpy_support.numpy_to_vtk(np.asarray(self.offsets, dtype=np.int64), deep=False, array_type=vtk.VTK_ID_TYPE),
+            numpy_support.numpy_to_vtk(np.arange(self.number_of_points, dtype=np.int64), deep=False, array_type=vtk.VTK_ID_TYPE))
+        outpd.SetPoints(outpoints)
+        outpd.SetLines(outlines)
+
+        for name, data in self.point_data.items():
+            array = numpy_support.numpy_to_vtk(data, deep=False)
+            array.SetName(name)
+            outpd.GetPointData().AddArray(array)
+        if self.active_tensors is not None and outpd.GetPointData().GetArray(self.active_tensors) is not None:
+            outpd.GetPointData().SetTensors(outpd.GetPointData().GetArray(self.active_tensors))
+        for name, data in self.cell_data.items():
+            array = numpy_support.numpy_to_vtk(data, deep=False)
+            array.SetName(name)
+            outpd.GetCellData().AddArray(array)
+
+        return outpd
+
+    def get_line(self, line_index):
+        """Return the points of one line."""
+        return self.points[self.offsets[line_index]:self.offsets[line_index + 1]]
+
+    def select_lines(self, line_indices, preserve_point_data=True, preserve_cell_data=True):
+        """Return TractographyArrays holding a copy of the lines
+        line_indices, in that order."""
+
+        line_indices = np.asarray(line_indices, dtype=np.int64)
+        offsets = np.asarray(self.offsets)
+        lengths = offsets[line_indices + 1] - offsets[line_indices]
+        point_indices = filter._line_point_ranges(offsets[line_indices], lengths)
+        point_data = dict()
+        if preserve_point_data:
+            point_data = {name: np.asarray(data[point_indices]) for name, data in self.point_data.items()}
+        cell_data = dict()
+        if preserve_cell_data:
+            cell_data = {name: np.asarray(data[line_indices]) for name, data in self.cell_data.items()}
+        return TractographyArrays(
+            np.asarray(self.points[point_indices]), np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+            point_data, cell_data, self.active_tensors if preserve_point_data else None)
+
+    def iter_chunks(self, chunk_size):
+        """Yield consecutive TractographyArrays of at most chunk_size
+        lines. Chunks are views, so memory mapped arrays are only read
+        as each chunk is used."""
+
+        for start in range(0, self.number_of_lines, chunk_size):
+            stop = min(start + chunk_size, self.number_of_lines)
+            offsets = np.asarray(self.offsets[start:stop + 1], dtype=np.int64)
+            point_range = slice(offsets[0], offsets[-1])
+            yield TractographyArrays(
+                self.points[point_range], offsets - offsets[0],
+                {name: data[point_range] for name, data in self.point_data.items()},
+                {name: data[start:stop] for name, data in self.cell_data.items()},
+                self.active_tensors)
+
+
+def _little_endian(array):
+    """Return array with an explicit little-endian dtype for storage."""
+    array = np.ascontiguousarray(array)
+    return array.astype(array.dtype.newbyteorder('<'), copy=False)
+
+
+def write_tract_cache(tractography, dirname):
+    """Write tractography in the native cache format.
+
+    tractography is a vtkPolyData or TractographyArrays. The output is a
+    directory (by convention with extension .wmt) containing a JSON
+    header and one little-endian .npy file per array, so that it can be
+    memory mapped by read_tract_cache. The directory is written under a
+    temporary name and renamed into place, replacing any existing
+    cache, so readers never see a partial cache.
+    """
+
+    if not isinstance(tractography, TractographyArrays):
+        tractography = TractographyArrays.from_polydata(tractography)
+
+    dirname = os.path.abspath(dirname)
+    tmpdir = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(dirname))
+    # mkdtemp creates a private directory, make the cache readable by others
+    os.chmod(tmpdir, 0o755)
+    try:
+        header = {'format': 'whitematteranalysis-tractography',
+                  'version': TRACT_CACHE_VERSION,
+                  'number_of_points': int(tractography.number_of_points),
+                  'number_of_lines': int(tractography.number_of_lines),
+                  'active_tensors': tractography.active_tensors,
+                  'point_data': list(),
+                  'cell_data': list()}
+        np.save(os.path.join(tmpdir, 'points.npy'), _little_endian(tractography.points))
+        np.save(os.path.join(tmpdir, 'offsets.npy'), _little_endian(np.asarray(tractography.offsets, dtype=np.int64)))
+        for kind, arrays in (('point_data', tractography.point_data), ('cell_data', tractography.cell_data)):
+            for idx, (name, data) in enumerate(arrays.items()):
+                fname = f'{kind}_{idx:03d}.npy'
+                np.save(os.path.join(tmpdir, fname), _little_endian(data))
+                header[kind].append({'name': name, 'file': fname})
+        with open(os.path.join(tmpdir, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1)
+
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmpdir, dirname)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+def write_tract_cache_chunks(chunks, dirname):
+    """Write an iterable of TractographyArrays as one tractography
+    cache, as write_tract_cache does, keeping only one chunk in memory.
+
+    Arrays are appended to temporary raw files as chunks arrive, then
+    copied into .npy files once their final sizes are known. Point and
+    cell data are taken from the first chunk and must be present in
+    all chunks.
+    """
+
+    dirname = os.path.abspath(dirname)
+    tmpdir = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(dirname))
+    os.chmod(tmpdir, 0o755)
+    raw_files = dict()
+    try:
+        number_of_points = 0
+        number_of_lines = 0
+        active_tensors = None
+        names = None
+        for chunk in chunks:
+            offsets = np.asarray(chunk.offsets[1:], dtype=np.int64) + number_of_points
+            if names is None:
+                names = {'point_data': list(chunk.point_data), 'cell_data': list(chunk.cell_data)}
+                active_tensors = chunk.active_tensors
+                offsets = np.concatenate(([0], offsets))
+            arrays = {'points.npy': chunk.points, 'offsets.npy': offsets}
+            for kind in ('point_data', 'cell_data'):
+                for idx, name in enumerate(names[kind]):
+                    arrays[f'{kind}_{idx:03d}.npy'] = getattr(chunk, kind)[name]
+            for fname, data in arrays.items():
+                data = _little_endian(np.asarray(data))
+                if fname not in raw_files:
+                    raw_files[fname] = [open(os.path.join(tmpdir, fname + '.raw'), 'wb'), data.dtype, data.shape[1:], 0]
+                raw_files[fname][0].write(np.ascontiguousarray(data, dtype=raw_files[fname][1]).tobytes())
+                raw_files[fname][3] += len(data)
+            number_of_points += chunk.number_of_points
+            number_of_lines += chunk.number_of_lines
+
+        if names is None:
+            # no chunks, write an empty cache
+            write_tract_cache(TractographyArrays(np.zeros((0, 3), dtype=np.float32), np.zeros(1, dtype=np.int64)), dirname)
+            shutil.rmtree(tmpdir)
+            return
+
+        for fname, (f, dtype, shape, length) in raw_files.items():
+            f.close()
+            with open(os.path.join(tmpdir, fname), 'wb') as out, open(f.name, 'rb') as raw:
+                np.lib.format.write_array_header_1_0(
+                    out, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (length,) + shape})
+                shutil.copyfileobj(raw, out, 1 << 24)
+            os.remove(f.name)
+
+        header = {'format': 'whitematteranalysis-tractography',
+                  'version': TRACT_CACHE_VERSION,
+                  'number_of_points': number_of_points,
+                  'number_of_lines': number_of_lines,
+                  'active_tensors': active_tensors,
+                  'point_data': [{'name': name, 'file': f'point_data_{idx:03d}.npy'} for idx, name in enumerate(names['point_data'])],
+                  'cell_data': [{'name': name, 'file': f'cell_data_{idx:03d}.npy'} for idx, name in enumerate(names['cell_data'])]}
+        with open(os.path.join(tmpdir, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1)
+
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmpdir, dirname)
+    except BaseException:
+        for (f, dtype, shape, length) in raw_files.values():
+            f.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+def read_tract_cache(dirname, mmap=True):
+    """Read tractography in the native cache format as TractographyArrays.
+
+    With mmap (the default) the arrays are memory mapped copy-on-write,
+    so nothing is parsed and data is only read from disk when accessed.
+    Use the to_polydata method of the result to get vtkPolyData.
+    """
+
+    with open(os.path.join(dirname, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('version', 0) > TRACT_CACHE_VERSION:
+        raise ValueError(f"Unsupported tractography cache version {header['version']} in {dirname}")
+
+    mmap_mode = 'c' if mmap else None
+
+    def _load(fname):
+        return np.load(os.path.join(dirname, fname), mmap_mode=mmap_mode)
+
+    point_data = {entry['name']: _load(entry['file']) for entry in header['point_data']}
+    cell_data = {entry['name']: _load(entry['file']) for entry in header['cell_data']}
+
+    return TractographyArrays(_load('points.npy'), _load('offsets.npy'), point_data, cell_data, header.get('active_tensors'))
+
+
+# Number of streamlines per chunk when iterating over tractography files
+DEFAULT_CHUNK_SIZE = 100000
+
+_TCK_DATATYPES = {'Float32LE': '<f4', 'Float32BE': '>f4', 'Float64LE': '<f8', 'Float64BE': '>f8'}
+
+def _read_tck_header(filename):
+    """Return the header fields of an MRtrix .tck file and the offset of
+    its data."""
+
+    header = dict()
+    with open(filename, 'rb') as f:
+        if f.readline().strip() != b'mrtrix tracks':
+            raise ValueError(f"{filename} is not an MRtrix tracks file")
+        for line in f:
+            line = line.decode('latin1').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            header[key.strip()] = value.strip()
+    if 'file' not in header or 'datatype' not in header:
+        raise ValueError(f"{filename}: missing file or datatype in tck header")
+    offset = int(header['file'].split()[1])
+    return header, offset
+
+def _tck_line_ranges(data, block_size):
+    """Yield (starts, lengths) of the streamlines in the (N, 3) tck data,
+    one block of rows at a time. Streamlines end at rows of NaN, and the
+    data ends at a row of Inf."""
+
+    start = 0
+    for block_start in range(0, len(data), block_size):
+        x = np.asarray(data[block_start:block_start + block_size, 0])
+        delimiters = np.nonzero(~np.isfinite(x))[0]
+        is_end_of_file = np.isinf(x[delimiters])
+        finished = np.any(is_end_of_file)
+        if finished:
+            delimiters = delimiters[:np.argmax(is_end_of_file) + 1]
+        if len(delimiters):
+            ends = delimiters + block_start
+            starts = np.concatenate(([start], ends[:-1] + 1))
+            lengths = ends - starts
+            start = ends[-1] + 1
+            # skip empty streamlines, such as before the end of file
+            yield starts[lengths > 0], lengths[lengths > 0]
+        if finished:
+            return
+
+def _gather_chunks(line_ranges, chunk_size, make_chunk):
+    """Group streamline (starts, lengths) blocks into chunks of
+    chunk_size streamlines, calling make_chunk(starts, lengths) on each."""
+
+    pending_starts = list()
+    pending_lengths = list()
+    pending = 0
+    for starts, lengths in line_ranges:
+        pending_starts.append(starts)
+        pending_lengths.append(lengths)
+        pending += len(starts)
+        while pending >= chunk_size:
+            starts = np.concatenate(pending_starts)
+            lengths = np.concatenate(pending_lengths)
+            yield make_chunk(starts[:chunk_size], lengths[:chunk_size])
+            pending_starts = [starts[chunk_size:]]
+            pending_lengths = [lengths[chunk_size:]]
+            pending -= chunk_size
+    if pending:
+        yield make_chunk(np.concatenate(pending_starts), np.concatenate(pending_lengths))
+
+def iter_tck_chunks(filename, chunk_size=DEFAULT_CHUNK_SIZE, block_size=1 << 20):
+    """Yield the streamlines of an MRtrix .tck file as TractographyArrays
+    of at most chunk_size streamlines.
+
+    The file is memory mapped and scanned block_size points at a time,
+    so files larger than memory can be processed. Points are in RAS mm.
+    """
+
+    header, offset = _read_tck_header(filename)
+    dtype = np.dtype(_TCK_DATATYPES[header['datatype']])
+    number_of_values = (os.path.getsize(filename) - offset) // dtype.itemsize
+    data = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(number_of_values // 3, 3))
+
+    def make_chunk(starts, lengths):
+        points = np.asarray(data[filter._line_point_ranges(starts, lengths)], dtype=np.float32)
+        return TractographyArrays(points, np.concatenate(([0], np.cumsum(lengths))).astype(np.int64))
+
+    yield from _gather_chunks(_tck_line_ranges(data, block_size), chunk_size, make_chunk)
+
+def _read_trk_header(filename):
+    """Return the TrackVis header (a dictionary), the affine from
+    voxmm to RAS mm and the numpy byte order of a .trk file."""
+
+    from nibabel.streamlines import trk
+
+    with open(filename, 'rb') as f:
+        header_rec = np.frombuffer(f.read(trk.header_2_dtype.itemsize), dtype=trk.header_2_dtype)
+    byteorder = '<' if sys.byteorder == 'little' else '>'
+    if header_rec['hdr_size'][0] != trk.TrkFile.HEADER_SIZE:
+        header_rec = header_rec.view(header_rec.dtype.newbyteorder())
+        byteorder = '>' if byteorder == '<' else '<'
+        if header_rec['hdr_size'][0] != trk.TrkFile.HEADER_SIZE:
+            raise ValueError(f"{filename} is not a TrackVis file")
+    header = dict(zip(header_rec.dtype.names, header_rec[0]))
+    # as nibabel does: version 1 and unset matrices mean identity, default order is LPS
+    if header['version'] == 1 or header['voxel_to_rasmm'][3][3] == 0:
+        header['voxel_to_rasmm'] = np.eye(4, dtype=np.float32)
+    if header['voxel_order'] == b'':
+        header['voxel_order'] = b'LPS'
+    return header, trk.get_affine_trackvis_to_rasmm(header), byteorder
+
+def _trk_data_names(names, number):
+    """Split TrackVis scalar or property names into (name, first column,
+    number of columns). Names may encode a count after a null byte."""
+
+    columns = list()
+    column = 0
+    for raw_name in names:
+        if column >= number:
+            break
+        name, _, count = bytes(raw_name).partition(b'\x00')
+        count = count.strip(b'\x00')
+        count = int(count) if count.isdigit() else 1
+        name = name.decode('latin1') or f'data_{column}'
+        columns.append((name, column, min(count, number - column)))
+        column += count
+    while column < number:
+        columns.append((f'data_{column}', column, 1))
+        column += 1
+    return columns
+
+def iter_trk_chunks(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the streamlines of a TrackVis .trk file as TractographyArrays
+    of at most chunk_size streamlines.
+
+    The file is memory mapped and only the words holding the number of
+    points of each streamline are scanned, so files larger than memory
+    can be processed. Points are converted to RAS mm. Per-point scalars
+    and per-streamline properties become point and cell data arrays.
+    """
+
+    header, affine, byteorder = _read_trk_header(filename)
+    number_of_scalars = int(header['nb_scalars_per_point'])
+    number_of_properties = int(header['nb_properties_per_streamline'])
+    words = np.memmap(filename, dtype=np.dtype(byteorder + 'f4'), mode='r', offset=1000)
+    counts = words.view(np.dtype(byteorder + 'i4'))
+    row_size = 3 + number_of_scalars
+    scalar_columns = _trk_data_names(header['scalar_name'], number_of_scalars)
+    property_columns = _trk_data_names(header['property_name'], number_of_properties)
+
+    def line_ranges(block_size=65536):
+        # the position of each streamline depends on the previous one
+        position = 0
+        number_of_words = len(words)
+        while position < number_of_words:
+            starts = list()
+            lengths = list()
+            while position < number_of_words and len(starts) < block_size:
+                length = int(counts[position])
+                starts.append(position + 1)
+                lengths.append(length)
+                position += 1 + length * row_size + number_of_properties
+            yield np.array(starts, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+    def make_chunk(starts, lengths):
+        point_ranges = filter._line_point_ranges(np.zeros(len(starts), dtype=np.int64), lengths)
+        rows = np.repeat(starts, lengths) + point_ranges * row_size
+        values = np.asarray(words[rows[:, np.newaxis] + np.arange(row_size)], dtype=np.float64)
+        points = (values[:, 0:3] @ affine[0:3, 0:3].T + affine[0:3, 3]).astype(np.float32)
+        point_data = {name: np.squeeze(values[:, 3 + column:3 + column + count].astype(np.float32), axis=1) if count == 1
+                      else values[:, 3 + column:3 + column + count].astype(np.float32)
+                      for (name, column, count) in scalar_columns}
+        cell_data = dict()
+        if number_of_properties:
+            properties = np.asarray(words[(starts + lengths * row_size)[:, np.newaxis] + np.arange(number_of_properties)], dtype=np.float32)
+            cell_data = {name: np.squeeze(properties[:, column:column + count], axis=1) if count == 1
+                         else properties[:, column:column + count]
+                         for (name, column, count) in property_columns}
+        return TractographyArrays(points, np.concatenate(([0], np.cumsum(lengths))).astype(np.int64), point_data, cell_data)
+
+    keep_nonempty = ((starts[lengths > 0], lengths[lengths > 0]) for (starts, lengths) in line_ranges())
+    yield from _gather_chunks(keep_nonempty, chunk_size, make_chunk)
+
+def iter_streamline_file_chunks(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the streamlines of a .tck or .trk file as TractographyArrays
+    of at most chunk_size streamlines."""
+
+    extension = os.path.splitext(filename)[1]
+    if extension == '.tck':
+        return iter_tck_chunks(filename, chunk_size=chunk_size)
+    elif extension == '.trk':
+        return iter_trk_chunks(filename, chunk_size=chunk_size)
+    raise ValueError(f"Cannot recognize streamline file format of {filename}")
+
+def iter_tractography_chunks(tractography, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield tractography as TractographyArrays of at most chunk_size
+    lines (points, offsets and per-point and per-line arrays).
+
+    tractography is a file name, a vtkPolyData or TractographyArrays.
+    .tck and .trk files and tractography caches (.wmt) are memory
+    mapped, so memory use is bounded by the chunk size. vtk/vtp files
+    can only be read whole by VTK and are then split into chunks.
+    """
+
+    if isinstance(tractography, str):
+        extension = os.path.splitext(tractography)[1]
+        if extension in ('.tck', '.trk'):
+            return iter_streamline_file_chunks(tractography, chunk_size=chunk_size)
+        elif extension == TRACT_CACHE_EXTENSION:
+            tractography = read_tract_cache(tractography)
+        else:
+            tractography = read_polydata(tractography)
+    if not isinstance(tractography, TractographyArrays):
+        tractography = TractographyArrays.from_polydata(tractography)
+    return tractography.iter_chunks(chunk_size)
+
+def read_streamline_file(filename):
+    """Read a whole .tck or .trk file as TractographyArrays."""
+
+    return concatenate_tractography_arrays(list(iter_streamline_file_chunks(filename)))
+
+def concatenate_tractography_arrays(chunks):
+    """Join a list of TractographyArrays into one. Point and cell data
+    arrays present in all chunks are kept."""
+
+    if not chunks:
+        return TractographyArrays(np.zeros((0, 3), dtype=np.float32), np.zeros(1, dtype=np.int64))
+    offsets = [chunks[0].offsets]
+    for chunk in chunks[1:]:
+        offsets.append(chunk.offsets[1:] + offsets[-1][-1])
+    point_names = set.intersection(*(set(chunk.point_data) for chunk in chunks))
+    cell_names = set.intersection(*(set(chunk.cell_data) for chunk in chunks))
+    return TractographyArrays(
+        np.concatenate([chunk.points for chunk in chunks]),
+        np.concatenate(offsets),
+        {name: np.concatenate([chunk.point_data[name] for chunk in chunks]) for name in sorted(point_names)},
+        {name: np.concatenate([chunk.cell_data[name] for chunk in chunks]) for name in sorted(cell_names)},
+        chunks[0].active_tensors)
+
 def transform_polydata_from_disk(in_filename, transform_filename, out_filename):
     # Read it in.
     print(f"<{os.path.basename(__file__)}> Transforming {in_filename} -> {out_filename}...")
@@ -237,44 +967,133 @@ def transform_polydata_from_disk_using_transform_object(in_filename, transform,
     del pd2
     del pd
 
-def transform_polydatas_from_disk(input_dir, transforms, output_dir):
-    """Loop over all input polydata files and apply the vtk transforms from the
+def serialize_transform(transform):
+    """Convert a vtk affine, thin-plate spline or B-spline transform to a
+    dictionary of numpy arrays and numbers.
 
-    input transforms list. Save transformed polydata files in the output
-    directory. As long as files were read in using list_vtk_files
-    originally, they will be in the same order as the transforms now.
+    Unlike vtk objects, the result can be pickled and sent to worker
+    processes. Use deserialize_transform to rebuild the vtk transform.
     """
 
-    # Find input files
-    input_pd_fnames = list_vtk_files(input_dir)
-    num_pd = len(input_pd_fnames)
-    print(f"<{os.path.basename(__file__)}> =======================================")
-    print(f"<{os.path.basename(__file__)}> Transforming vtk and vtp files from directory: {input_dir}")
-    print(f"<{os.path.basename(__file__)}> Total number of files found: {num_pd}")
-    print(f"<{os.path.basename(__file__)}> Writing output to directory: {output_dir}")
-    print(f"<{os.path.basename(__file__)}> =======================================")
+    if transform.IsA('vtkLinearTransform'):
+        matrix = np.zeros((4, 4))
+        vtk_matrix = transform.GetMatrix()
+        for i in range(0, 4):
+            for j in range(0, 4):
+                matrix[i, j] = vtk_matrix.GetElement(i, j)
+        return {'type': 'affine', 'matrix': matrix}
+
+    elif transform.GetClassName() == 'vtkThinPlateSplineTransform':
+        return {'type': 'thin_plate_spline',
+                'source_landmarks': numpy_support.vtk_to_numpy(transform.GetSourceLandmarks().GetData()).copy(),
+                'target_landmarks': numpy_support.vtk_to_numpy(transform.GetTargetLandmarks().GetData()).copy(),
+                'basis': transform.GetBasis(),
+                'sigma': transform.GetSigma(),
+                'inverse': transform.GetInverseFlag()}
+
+    elif transform.GetClassName() == 'vtkBSplineTransform':
+        coefficients = transform.GetCoefficientData()
+        return {'type': 'bspline',
+                'coefficients': numpy_support.vtk_to_numpy(coefficients.GetPointData().GetScalars()).copy(),
+                'dimensions': coefficients.GetDimensions(),
+                'origin': coefficients.GetOrigin(),
+                'spacing': coefficients.GetSpacing(),
+                'border_mode': transform.GetBorderMode(),
+                'displacement_scale': transform.GetDisplacementScale(),
+                'inverse': transform.GetInverseFlag()}
+
+    raise ValueError(f"Cannot serialize transform of class {transform.GetClassName()}")
+
+def deserialize_transform(transform_dict):
+    """Rebuild the vtk transform described by serialize_transform output."""
+
+    transform_type = transform_dict['type']
+    if transform_type == 'affine':
+        transform = vtk.vtkTransform()
+        matrix = vtk.vtkMatrix4x4()
+        for i in range(0, 4):
+            for j in range(0, 4):
+                matrix.SetElement(i, j, transform_dict['matrix'][i, j])
+        transform.SetMatrix(matrix)
 
-    if not os.path.exists(output_dir):
-        print(f"<{os.path.basename(__file__)}> ERROR: Output directory does not exist.")
-        return
-    if not os.path.exists(input_dir):
-        print(f"<{os.path.basename(__file__)}> ERROR: Output directory does not exist.")
-        return
+    elif transform_type == 'thin_plate_spline':
+        source_points = vtk.vtkPoints()
+        source_points.SetData(numpy_support.numpy_to_vtk(transform_dict['source_landmarks'], deep=True))
+        target_points = vtk.vtkPoints()
+        target_points.SetData(numpy_support.numpy_to_vtk(transform_dict['target_landmarks'], deep=True))
+        transform = vtk.vtkThinPlateSplineTransform()
+        transform.SetSourceLandmarks(source_points)
+        transform.SetTargetLandmarks(target_points)
+        transform.SetBasis(transform_dict['basis'])
+        transform.SetSigma(transform_dict['sigma'])
+        if transform_dict['inverse']:
+            transform.Inverse()
+
+    elif transform_type == 'bspline':
+        coefficients = vtk.vtkImageData()
+        coefficients.SetDimensions(*transform_dict['dimensions'])
+        coefficients.SetOrigin(*transform_dict['origin'])
+        coefficients.SetSpacing(*transform_dict['spacing'])
+        coefficients.GetPointData().SetScalars(numpy_support.numpy_to_vtk(transform_dict['coefficients'], deep=True))
+        transform = vtk.vtkBSplineTransform()
+        transform.SetCoefficientData(coefficients)
+        transform.SetBorderMode(transform_dict['border_mode'])
+        transform.SetDisplacementScale(transform_dict['displacement_scale'])
+        if transform_dict['inverse']:
+            transform.Inverse()
 
-    # Transform the files
-    for idx in range(0, len(input_pd_fnames)):
-        in_filename = input_pd_fnames[idx]
-        subject_id = os.path.splitext(os.path.basename(in_filename))[0]
-        out_filename = os.path.join(output_dir, f'{subject_id}_reg.vtk')
-        transform_polydata_from_disk_using_transform_object(in_filename, transforms[idx], out_filename)
+    else:
+        raise ValueError(f"Unknown transform type {transform_type}")
 
-# This function was faster but is not always safe. Could crash due to missing file if any write/disk access issue
-def transform_polydatas_from_diskUNSAFE(input_dir, transforms, output_dir, parallel_jobs=3):
+    return transform
+
+def _temporary_output_filename(out_filename):
+    """Hidden temporary name in the output directory with the same extension."""
+    dirname, basename = os.path.split(out_filename)
+    return os.path.join(dirname, f'.tmp_{os.getpid()}_{basename}')
+
+def _transform_polydata_subject(in_filename, transform_dict, out_filename):
+    """Read, transform and write one polydata. Returns None on success or
+    an error message.
+
+    The output is written under a temporary name and renamed into place,
+    so a failed or interrupted subject never leaves a partial output file.
+    """
+
+    tmp_filename = _temporary_output_filename(out_filename)
+    try:
+        pd = read_polydata(in_filename)
+        if pd is None:
+            raise OSError(f"Cannot read {in_filename}")
+        transformer = vtk.vtkTransformPolyDataFilter()
+        transformer.SetInputData(pd)
+        transformer.SetTransform(deserialize_transform(transform_dict))
+        transformer.Update()
+        write_polydata(transformer.GetOutput(), tmp_filename)
+        if not os.path.exists(tmp_filename):
+            raise OSError(f"Failed to write {out_filename}")
+        os.replace(tmp_filename, out_filename)
+    except Exception as err:
+        if os.path.isdir(tmp_filename):
+            shutil.rmtree(tmp_filename, ignore_errors=True)
+        elif os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        return f"{type(err).__name__}: {err}"
+    return None
+
+def transform_polydatas_from_disk(input_dir, transforms, output_dir, parallel_jobs=1):
     """Loop over all input polydata files and apply the vtk transforms from the
 
     input transforms list. Save transformed polydata files in the output
     directory. As long as files were read in using list_vtk_files
     originally, they will be in the same order as the transforms now.
+
+    Affine, thin-plate spline and B-spline transforms are passed to
+    parallel_jobs worker processes as numpy arrays (see
+    serialize_transform), so no temporary transform files are
+    written. Each output is written atomically. A subject that fails
+    does not stop the others; the list of (subject_id, error message)
+    failures is printed and returned.
     """
 
     # Find input files
@@ -290,67 +1109,42 @@ def transform_polydatas_from_diskUNSAFE(input_dir, transforms, output_dir, paral
         print(f"<{os.path.basename(__file__)}> ERROR: Output directory does not exist.")
         return
     if not os.path.exists(input_dir):
-        print(f"<{os.path.basename(__file__)}> ERROR: Output directory does not exist.")
+        print(f"<{os.path.basename(__file__)}> ERROR: Input directory does not exist.")
         return
 
     # Set up inputs for subprocesses
-    fname_list = list()
+    subject_ids = list()
     out_fname_list = list()
-    message_list = list()
     transform_list = list()
     for idx in range(0, len(input_pd_fnames)):
-        fname = input_pd_fnames[idx]
-        tx = transforms[idx]
-        subject_id = os.path.splitext(os.path.basename(fname))[0]
-        out_fname = os.path.join(output_dir, f'{subject_id}_reg.vtk')
-        fname_list.append(fname)
-        out_fname_list.append(out_fname)
-        # save the transform to disk because we cannot pickle it
-        if tx.GetClassName() == 'vtkThinPlateSplineTransform':
-            writer = vtk.vtkMNITransformWriter()
-            writer.AddTransform(tx)
-            fname = f'.tmp_vtk_txform_{str(subject_id)}.xfm'
-            fname = os.path.join(output_dir, fname)
-            writer.SetFileName(fname)
-            writer.Write()
-            del writer
-        elif tx.GetClassName() == 'vtkBSplineTransform':
-            # there is no vtk file format for bspline transforms, unfortunately.
-            print("Saving bspline transformed polydata without writing transform to disk for multiprocessing")
-            transform_polydata_from_disk_using_transform_object(fname, tx, out_fname)
-            # this did not work, and also it would lose the grid size information
-            ## image = tx.GetCoefficients()
-            ## writer = vtk.vtkImageWriter()
-            ## writer.SetFileDimensionality(1)
-            ## fname = '.tmp_vtk_txform_' + str(subject_id) + '.img'
-            ## fname = os.path.join(output_dir, fname)
-            ## writer.SetFileName(fname)
-            ## writer.SetInput(image)
-            ## writer.Write()
-            ## del writer
-        else:
-            fname = f'.tmp_vtk_txform_{str(subject_id)}.txt'
-            f = open(fname, 'w')
-            for i in range(0,4):
-                for j in range(0,4):
-                    f.write(str(tx.GetMatrix().GetElement(i,j))+'\n')
-            f.close()
-        transform_list.append(fname)
+        subject_id = os.path.splitext(os.path.basename(input_pd_fnames[idx]))[0]
+        subject_ids.append(subject_id)
+        out_fname_list.append(os.path.join(output_dir, f'{subject_id}_reg.vtk'))
+        transform_list.append(serialize_transform(transforms[idx]))
+
+    if parallel_jobs is None or parallel_jobs <= 1:
+        errors = list()
+        for (in_filename, transform_dict, out_filename) in zip(input_pd_fnames, transform_list, out_fname_list):
+            print(f"<{os.path.basename(__file__)}> Transforming {in_filename} -> {out_filename}...")
+            errors.append(_transform_polydata_subject(in_filename, transform_dict, out_filename))
+    else:
+        errors = Parallel(
+            n_jobs=parallel_jobs, verbose=0)(
+                delayed(_transform_polydata_subject)(in_filename, transform_dict, out_filename)
+                for (in_filename, transform_dict, out_filename) in zip(input_pd_fnames, transform_list, out_fname_list))
 
-    # Run this in parallel
-    if tx.GetClassName() != 'vtkBSplineTransform':
-        ret = Parallel(
-                n_jobs=parallel_jobs, verbose=0)(
-                    delayed(transform_polydata_from_disk)(in_filename, transform_filename, out_filename)
-                    for (in_filename, transform_filename, out_filename) in zip(fname_list, transform_list, out_fname_list))
+    failures = [(subject_id, error) for (subject_id, error) in zip(subject_ids, errors) if error is not None]
+    for (subject_id, error) in failures:
+        print(f"<{os.path.basename(__file__)}> ERROR: Failed to transform {subject_id}: {error}")
+    print(f"<{os.path.basename(__file__)}> Transformed {num_pd - len(failures)} / {num_pd} files.")
 
-        # remove the temporary transform files
-        for fname in transform_list:
-            os.remove(fname)
+    return failures
 
-    #for idx in range(0, len(input_pd_fnames)):
-        #print(f"<{os.path.basename(__file__)}> {idx + 1} / {num_pd} {subject_id} Transforming {in_filename} -> {out_filename}...")
-        #transform_polydata_from_disk(in_filename, transform, out_filename)
+def transform_polydatas_from_diskUNSAFE(input_dir, transforms, output_dir, parallel_jobs=3):
+    """Deprecated name of the parallel transform_polydatas_from_disk,
+    kept for backwards compatibility."""
+
+    return transform_polydatas_from_disk(input_dir, transforms, output_dir, parallel_jobs=parallel_jobs)
 
 def transform_polydatas_from_diskOLD(input_dir, transforms, output_dir):
     """Loop over all input polydata files and apply the vtk transforms from the
@@ -622,6 +1416,12 @@ def write_transforms_to_itk_format(transform_list, outdir, subject_ids=None):
     return(tx_fnames)
 
 
+LATERALITY_RESULTS_FILENAME = 'laterality_results.npz'
+LATERALITY_POLYDATA_FILENAME = 'tractography_with_LI.vtp'
+LATERALITY_ARRAYS = ('laterality_index', 'left_hem_similarity', 'right_hem_similarity', 'hemisphere')
+LATERALITY_DISTANCE_ARRAYS = ('right_hem_distance', 'left_hem_distance')
+LATERALITY_PARAMETERS = ('sigma', 'points_per_fiber', 'threshold')
+
 class LateralityResults:
 
     """Results of laterality computation for a subject.
@@ -647,122 +1447,80 @@ class LateralityResults:
         self.right_hem_similarity = None
         self.hemisphere = None
         
-    def write(self, dirname, savedist=False):
-        """Write output laterality results for one subject."""
-        print("a")
+    def write(self, dirname, savedist=False, savepd=True):
+        """Write output laterality results for one subject.
+
+        All arrays and computation parameters are stored in one
+        compressed laterality_results.npz file. The polydata with the
+        laterality index as cell data is written to
+        tractography_with_LI.vtp if savepd is True.
+        """
+
         if not os.path.isdir(dirname):
             os.mkdir(dirname)
-        print("b")
+
         # output polydata
-        writer = vtk.vtkPolyDataWriter()
-        if (vtk.vtkVersion().GetVTKMajorVersion() >= 6.0):
-            writer.SetInputData(self.polydata)
-        else:
-            writer.SetInput(self.polydata)
-        
-        writer.SetFileName(os.path.join(dirname, 'tractography_with_LI.vtk'))
-        writer.Write()
-        print("c")
-        # output LI and other data values to text file
-        # first pickle everything for later python processing
-        fid = open(os.path.join(dirname, 'pickle_laterality_index.txt'), 'w')
-        pickle.dump(self.laterality_index, fid)
-        fid.close()
-
-        fid = open(os.path.join(dirname, 'pickle_left_hem_similarity.txt'), 'w')
-        pickle.dump(self.left_hem_similarity, fid)
-        fid.close()
-        fid = open(os.path.join(dirname, 'pickle_right_hem_similarity.txt'), 'w')
-        pickle.dump(self.right_hem_similarity, fid)
-        fid.close()
-        fid = open(os.path.join(dirname, 'pickle_hemisphere.txt'), 'w')
-        pickle.dump(self.hemisphere, fid)
-        fid.close()
+        if savepd and self.polydata is not None:
+            write_polydata(self.polydata, os.path.join(dirname, LATERALITY_POLYDATA_FILENAME))
 
+        # output LI, similarities and parameters for later python processing
+        arrays = dict()
+        names = list(LATERALITY_ARRAYS) + list(LATERALITY_PARAMETERS)
         if savedist:
-            fid = open(os.path.join(dirname, 'pickle_right_hem_distance.txt'), 'w')
-            pickle.dump(self.right_hem_distance, fid)
-            fid.close()
-            fid = open(os.path.join(dirname, 'pickle_left_hem_distance.txt'), 'w')
-            pickle.dump(self.left_hem_distance, fid)
-            fid.close()
-            print("d")
+            names += list(LATERALITY_DISTANCE_ARRAYS)
+        for name in names:
+            value = getattr(self, name)
+            if value is not None:
+                arrays[name] = np.asarray(value)
+        np.savez_compressed(os.path.join(dirname, LATERALITY_RESULTS_FILENAME), **arrays)
+
         # now output human-readable LI values
-        fid = open(os.path.join(dirname, 'laterality_index_values.txt'), 'w')
-        for idx in range(0, len(self.laterality_index)):
-            fid.write(str(self.laterality_index[idx]))
-            fid.write('\n')
-        fid.close()
-        print("e")
-        # generate histogram (needs matplotlib)
-        li_stats = self.laterality_index[np.nonzero(self.laterality_index)]
-        ## if USE_MATPLOTLIB and 0:
-        ##     try:
-        ##         print "f"
-        ##         matplotlib.pyplot.hist(li_stats, bins=25, color=[.6, .6, .6])
-        ##         print "f1"
-        ##         matplotlib.pyplot.savefig(
-        ##             os.path.join(dirname, 'LI_histogram.pdf'))
-        ##         print "f2"
-        ##         matplotlib.pyplot.close()
-        ##         print "g"
-        ##     except Exception:
-        ##         print(f"<{os.path.basename(__file__)}> matplotlib was unable to write histogram.")
-        ##         raise
-        ## print "1"
-        # generate fiber visualization
-        #try:
-            # pd3_li = filter.maskFibers(pd3_out,abs(li)>max(abs(li))*.01, li)
-            #ren = render.render(self.polydata)
-            #ren.save_views(dirname)
-        #except Exception:
-        #    print(f"<{os.path.basename(__file__)}> vtk or rendering issue. Failed to save views.")
-        #    print(f"<{os.path.basename(__file__)}> polydata was saved to disk so you can re-render.")
-        #    raise
-
-        #print "IMPLEMENT SAVING OF PARAMETERS TOO"
-
-    def read(self, dirname, readpd=False, readdist=False):
-        """Read output (class laterality.LateralityResults) for one subject."""
+        if self.laterality_index is not None:
+            np.savetxt(os.path.join(dirname, 'laterality_index_values.txt'), self.laterality_index)
+
+    def read(self, dirname, readpd=False, readdist=False, lazy=False):
+        """Read output (class laterality.LateralityResults) for one subject.
+
+        If lazy is True, only the laterality index and hemisphere arrays
+        needed for group statistics are loaded, and the other arrays are
+        left as None. Results written by older versions as pickle files
+        are also read.
+        """
 
         if not os.path.isdir(dirname):
             print(f"<{os.path.basename(__file__)}> error: directory does not exist {dirname}")
 
         if readpd:
             # input polydata
-            reader = vtk.vtkPolyDataReader()
-            fname = os.path.join(dirname, 'tractography_with_LI.vtk')
-            reader.SetFileName(fname)
-            reader.Update()
-            self.polydata = reader.GetOutput()
-
-        # input LI and other data values using pickle
-        fname = os.path.join(dirname, 'pickle_laterality_index.txt')
-        fid = open(fname)
-        self.laterality_index = pickle.load(fid)
-        fid.close()
-
-        fname = os.path.join(dirname, 'pickle_left_hem_similarity.txt')
-        fid = open(fname)
-        self.left_hem_similarity = pickle.load(fid)
-        fid.close()
-        fname = os.path.join(dirname, 'pickle_right_hem_similarity.txt')
-        fid = open(fname)
-        self.right_hem_similarity = pickle.load(fid)
-        fid.close()
-        fname = os.path.join(dirname, 'pickle_hemisphere.txt')
-        fid = open(fname)
-        self.hemisphere = pickle.load(fid)
-        fid.close()
+            fname = os.path.join(dirname, LATERALITY_POLYDATA_FILENAME)
+            if not os.path.exists(fname):
+                fname = os.path.join(dirname, 'tractography_with_LI.vtk')
+            self.polydata = read_polydata(fname)
 
+        if lazy:
+            names = ['laterality_index', 'hemisphere']
+        else:
+            names = list(LATERALITY_ARRAYS) + list(LATERALITY_PARAMETERS)
         if readdist:
-            fid = open(os.path.join(dirname, 'pickle_right_hem_distance.txt'))
-            self.right_hem_distance = pickle.load(fid)
-            fid.close()
-            fid = open(os.path.join(dirname, 'pickle_left_hem_distance.txt'))
-            self.left_hem_distance = pickle.load(fid)
-            fid.close()
+            names += list(LATERALITY_DISTANCE_ARRAYS)
+
+        fname = os.path.join(dirname, LATERALITY_RESULTS_FILENAME)
+        if os.path.exists(fname):
+            # arrays in the npz file are only decompressed when accessed
+            with np.load(fname) as data:
+                for name in names:
+                    if name not in data.files:
+                        continue
+                    value = data[name]
+                    if name in LATERALITY_PARAMETERS:
+                        value = value.item()
+                    setattr(self, name, value)
+        else:
+            # older output, one pickle per array
+            for name in names:
+                fname = os.path.join(dirname, f'pickle_{name}.txt')
+                if os.path.exists(fname):
+                    with open(fname, 'rb') as fid:
+                        setattr(self, name, pickle.load(fid, encoding='latin1'))
 
         self.directory = dirname
-
-        #print "IMPLEMENT READING OF PARAMETERS TOO"
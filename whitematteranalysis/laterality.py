@@ -18,6 +18,11 @@ parameters include sigma, points used to parametrize the fiber, and
 lower threshold on fiber distance.  Output is of class
 LateralityResults (io.py)
 
+The similarity of every fiber to every fiber in each hemisphere is
+computed in one pass over blocks of fiber pairs. Left hemisphere
+fibers are reflected into the right hemisphere once, so comparing a
+fiber to either hemisphere is a comparison between reflected fibers.
+
 """
 
 import os
@@ -36,7 +41,11 @@ joblib, have_joblib, _ = optional_package("joblib")
 Parallel, _, _ = optional_package("joblib.Parallel")
 delayed, _, _ = optional_package("joblib.delayed")
 
-if not have_joblib:
+if have_joblib:
+    # Parallel and delayed are not modules, so optional_package cannot
+    # import them
+    from joblib import Parallel, delayed
+else:
     warnings.warn(joblib._msg)
     warnings.warn("Cannot multiprocess.")
 
@@ -46,7 +55,7 @@ def compute_laterality_index(left, right, idx=None):
 
     laterality_index = np.zeros(len(left))
 
-    if idx == None:
+    if idx is None:
         # if L=R=0, output 0. (avoid divide by 0, skip masked out data)
         idx = np.nonzero(left)[0] & np.nonzero(right)[0]
 
@@ -58,6 +67,71 @@ def compute_laterality_index(left, right, idx=None):
     return laterality_index
 
 
+def _thresholded_distance(fibers_1, fibers_2, threshold):
+    """ Sum over corresponding points of the squared point distance
+    minus the squared threshold (or 0 if below the threshold), for each
+    fiber in fibers_1 and each fiber in fibers_2. Fibers are arrays of
+    R, A, S by fiber by point."""
+
+    # squared point distances by point, fiber 1 and fiber 2, from
+    # products of the points and their squared lengths
+    distance = np.matmul(np.ascontiguousarray(fibers_1.transpose(2, 1, 0)),
+                         np.ascontiguousarray(fibers_2.transpose(2, 0, 1)))
+    distance *= -2
+    distance += np.sum(np.square(fibers_1), 0).T[:, :, np.newaxis]
+    distance += np.sum(np.square(fibers_2), 0).T[:, np.newaxis, :]
+
+    # set values less than threshold to 0 (this also removes rounding
+    # below 0 when there is no threshold)
+    distance -= threshold * threshold
+    np.maximum(distance, 0, out=distance)
+    return np.sum(distance, 0)
+
+
+def _strict_similarity(fibers_1, fibers_2, threshold, sigmasq):
+    """ Similarity of each fiber in fibers_1 to each fiber in fibers_2,
+    as similarity.fiber_distance with the StrictSimilarity method: the
+    product of the Gaussian similarities of corresponding points, for
+    the better of the two fiber orders."""
+
+    # the product of point similarities is the exponential of the sum
+    distance = np.minimum(_thresholded_distance(fibers_1, fibers_2, threshold),
+                          _thresholded_distance(fibers_1, fibers_2[:, :, ::-1], threshold))
+    return similarity.distance_to_similarity(distance, sigmasq)
+
+
+# this must be a function to allow pickling by Parallel
+def _hemisphere_similarity_block(fibers, is_right, start, stop, threshold, sigmasq, block_size):
+    """ Contribution of rows start:stop of the symmetric fiber
+    similarity matrix to the total similarity of every fiber to the
+    right and to the left hemisphere.
+
+    fibers are all hemisphere fibers, as R, A, S by fiber by point,
+    reflected into the right hemisphere, and is_right is True for
+    fibers that were not reflected. Only blocks on or above the diagonal are computed, and
+    blocks above it are added to the totals of both their rows and
+    their columns.
+    """
+
+    number_of_fibers = fibers.shape[1]
+    right_total = np.zeros(number_of_fibers)
+    left_total = np.zeros(number_of_fibers)
+
+    rows = fibers[:, start:stop]
+    for column_start in range(start, number_of_fibers, block_size):
+        column_stop = min(column_start + block_size, number_of_fibers)
+        block = _strict_similarity(rows, fibers[:, column_start:column_stop], threshold, sigmasq)
+        column_is_right = is_right[column_start:column_stop]
+        right_total[start:stop] += np.sum(block[:, column_is_right], 1)
+        left_total[start:stop] += np.sum(block[:, ~column_is_right], 1)
+        if column_start != start:
+            row_is_right = is_right[start:stop]
+            right_total[column_start:column_stop] += np.sum(block[row_is_right, :], 0)
+            left_total[column_start:column_stop] += np.sum(block[~row_is_right, :], 0)
+
+    return right_total, left_total
+
+
 class WhiteMatterLaterality:
 
     """Laterality computation from fiber tracts."""
@@ -81,12 +155,14 @@ class WhiteMatterLaterality:
         # set parallel_jobs to 0 to turn off multiprocessing
         self.parallel_jobs = 2
         self.parallel_verbose = 0
+        # fibers per block of the similarity computation
+        self.block_size = 128
 
         # internal data storage
         self.fibers = FiberArray()
 
     def __str__(self):
-        output = f" sigma\t\t\t{str(self.sigma)}\n points_per_fiber\t{str(self.points_per_fiber)}\n threshold\t\t{str(self.threshold)}\n verbose\t\t{str(self.verbose)} \n parallel_jobs\t\t{str(self.parallel_jobs)}\n parallel_verbose\t{str(self.parallel_verbose)}\n fibers\n\t\t\t{str(self.fibers)}"
+        output = f" sigma\t\t\t{str(self.sigma)}\n points_per_fiber\t{str(self.points_per_fiber)}\n threshold\t\t{str(self.threshold)}\n verbose\t\t{str(self.verbose)} \n parallel_jobs\t\t{str(self.parallel_jobs)}\n parallel_verbose\t{str(self.parallel_verbose)}\n block_size\t\t{str(self.block_size)}\n fibers\n\t\t\t{str(self.fibers)}"
 
         return output
 
@@ -137,8 +213,9 @@ class WhiteMatterLaterality:
             mask[selected_left] = 1
             # go back to the input data and use just those fibers
             input_vtk_polydata = filter.mask(input_vtk_polydata, mask)
-            # Now convert to array with points and hemispheres as above
-            self.fibers.convert_from_polydata(input_vtk_polydata)
+            # the masked polydata keeps the input order, so its fibers
+            # are the selected ones and need not be converted again
+            self.fibers = self.fibers.get_fibers(np.nonzero(mask)[0])
             if self.verbose:
                 print(f"<{os.path.basename(__file__)}> Using {num_fibers} fibers per hemisphere.")
                 
@@ -154,9 +231,17 @@ class WhiteMatterLaterality:
         #left_hem_distance = np.zeros([nf, nf])
 
 
-        # grab all fibers from each hemisphere
-        fiber_array_right = self.fibers.get_fibers(self.fibers.index_right_hem)
-        fiber_array_left = self.fibers.get_fibers(self.fibers.index_left_hem)
+        # all hemisphere fibers, with left hemisphere fibers reflected
+        # into the right hemisphere. The similarity of a fiber to the
+        # right (left) hemisphere is then its total similarity to the
+        # reflected fibers that were (were not) right hemisphere fibers.
+        index_hem = self.fibers.index_hem
+        fibers = np.array([self.fibers.fiber_array_r[index_hem],
+                           self.fibers.fiber_array_a[index_hem],
+                           self.fibers.fiber_array_s[index_hem]])
+        is_right = self.fibers.is_right_hem[index_hem]
+        fibers[0, ~is_right, :] *= -1
+        block_starts = range(0, len(index_hem), self.block_size)
 
         # tell user we are doing something
         if self.verbose:
@@ -168,61 +253,25 @@ class WhiteMatterLaterality:
             if self.verbose:
                 print(f"<{os.path.basename(__file__)}> Starting parallel code. Processes: {self.parallel_jobs}")
 
-            # compare to right hemisphere (reflect fiber first if in left hem)
             ret = Parallel(
                 n_jobs=self.parallel_jobs, verbose=self.parallel_verbose)(
-                delayed(similarity.total_similarity_for_laterality)(
-                    self.fibers.get_fiber(lidx),
-                    fiber_array_right,
-                    self.fibers.is_left_hem[lidx],
+                delayed(_hemisphere_similarity_block)(
+                    fibers,
+                    is_right,
+                    start,
+                    start + self.block_size,
                     self.threshold,
-                    sigmasq)
-                for lidx in self.fibers.index_hem)
-
-            #ret = zip(*ret)
-            right_hem_total[self.fibers.index_hem] = ret
-            #right_hem_distance = ret[1]
-
-            # compare to left hemisphere (reflect fiber first if in right hem)
-            ret = Parallel(
-                n_jobs=self.parallel_jobs, verbose=self.parallel_verbose)(
-                delayed(similarity.total_similarity_for_laterality)(
-                    self.fibers.get_fiber(lidx),
-                    fiber_array_left,
-                    self.fibers.is_right_hem[lidx],
-                    self.threshold,
-                    sigmasq)
-                for lidx in self.fibers.index_hem)
-            #ret = zip(*ret)
-            left_hem_total[self.fibers.index_hem] = ret
-            #left_hem_distance = ret[1]
+                    sigmasq,
+                    self.block_size)
+                for start in block_starts)
 
         else:
-            right_hem_distance = np.zeros([nf, len(self.fibers.index_right_hem)])
-            left_hem_distance = np.zeros([nf, len(self.fibers.index_left_hem)])
-
-            # compare to right hemisphere (reflect fiber first if in left hem)
-            for lidx in self.fibers.index_hem:
-                ret = similarity.total_similarity_for_laterality(
-                    self.fibers.get_fiber(lidx),
-                    fiber_array_right,
-                    self.fibers.is_left_hem[lidx],
-                    self.threshold,
-                    sigmasq)
-                right_hem_total[lidx] = ret
-                #right_hem_total[lidx] = ret[0]
-                #right_hem_distance[lidx,:] = ret[1]
-
-            # compare to left hemisphere (reflect fiber first if in right hem)
-            for lidx in self.fibers.index_hem:
-                ret = similarity.total_similarity_for_laterality(
-                    self.fibers.get_fiber(lidx),
-                    fiber_array_left,
-                    self.fibers.is_right_hem[lidx],
-                    self.threshold,
-                    sigmasq)
-                left_hem_total[lidx] = ret
-                #left_hem_distance[lidx,:] = ret[1]
+            ret = [_hemisphere_similarity_block(fibers, is_right, start, start + self.block_size, self.threshold, sigmasq, self.block_size)
+                   for start in block_starts]
+
+        for (right_block_total, left_block_total) in ret:
+            right_hem_total[index_hem] += right_block_total
+            left_hem_total[index_hem] += left_block_total
 
         laterality_index = compute_laterality_index(left_hem_total,
                                                     right_hem_total,
@@ -235,7 +284,7 @@ class WhiteMatterLaterality:
         cell_data.SetName('Laterality')
         for lidx in range(0, self.fibers.number_of_fibers):
             cell_data.InsertNextTuple1(laterality_index[lidx])
-            input_vtk_polydata.GetCellData().SetScalars(cell_data)
+        input_vtk_polydata.GetCellData().SetScalars(cell_data)
 
         # output everything
         results = LateralityResults()
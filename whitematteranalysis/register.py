@@ -81,7 +81,7 @@ class RegistrationInformation:
         transformer.SetTransform(vtktrans)
         transformer.Update()
         pd_out = transformer.GetOutput()
-        out_array.convert_from_polydata(pd_out, self.points_per_fiber)
+        out_array.convert_from_polydata(pd_out, self.points_per_fiber, use_cache=False)
         return out_array
 
     def transform_fiber_array(self):
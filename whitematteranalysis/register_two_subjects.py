@@ -9,16 +9,74 @@ class RegisterTractography
 
 """
 
+import collections
 import os
 import sys
 import time
 
 import numpy as np
 import scipy.optimize
+import scipy.spatial
 import vtk
 
 import whitematteranalysis as wma
 
+# number of recent objective values remembered by RegisterTractography
+OBJECTIVE_MEMO_SIZE = 256
+
+
+class ObjectiveMemo:
+
+    """Bounded memo of objective values (or, for gradient based
+    optimizers, objective values and gradients) by parameter vector,
+    evicting the least recently used. If decimals is given, parameter vectors
+    are rounded to that many decimals before comparison, so nearly
+    identical vectors share a value."""
+
+    def __init__(self, max_size=OBJECTIVE_MEMO_SIZE, decimals=None):
+        self.max_size = max_size
+        self.decimals = decimals
+        self._values = collections.OrderedDict()
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.decimals is not None:
+            x = np.round(x, self.decimals)
+        # adding 0.0 makes -0.0 and 0.0 the same key
+        return (x + 0.0).tobytes()
+
+    def get(self, x):
+        """Return the value stored for x, or None."""
+
+        key = self.key(x)
+        value = self._values.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._values.move_to_end(key)
+        return value
+
+    def put(self, x, value):
+        key = self.key(x)
+        self._values[key] = value
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        """Human-readable hit statistics."""
+
+        return (f"OBJECTIVE MEMO: {self.hits} hits, {self.misses} misses, "
+                f"hit rate {100 * self.hit_rate():.1f}%")
+
 
 class RegisterTractography:
 
@@ -117,7 +175,21 @@ class RegisterTractography:
 
         # choice of optimization method
         #self.optimizer = "Powell"
+        # "LBFGS" uses the analytic gradient of the objective
         self.optimizer = "Cobyla"
+
+        # compare moving fibers only with fixed fibers within a few
+        # sigma (see TruncatedObjective). Used by objective_function.
+        self.approximate = False
+        self.truncation_sigmas = TRUNCATION_SIGMAS
+        self.truncated_objective = None
+
+        # remember recent objective values by parameter vector, as the
+        # optimizers often revisit the same point. Optionally the
+        # parameters are rounded to objective_memo_decimals first.
+        self.objective_memo_size = OBJECTIVE_MEMO_SIZE
+        self.objective_memo_decimals = None
+        self.objective_memo = None
         
     def objective_function(self, current_x):
         """ The actual objective used in registration.  Function of
@@ -128,6 +200,41 @@ class RegisterTractography:
         # keep track of current x value
         self._x_opt = current_x
 
+        obj = self.memoized_objective(current_x)
+
+        # save objective function value for analysis of performance
+        self.objective_function_values.append(obj)
+
+        if self.verbose:
+            print(f"O: {obj} X: {self._x_opt}")
+
+        return obj
+
+    def memoized_objective(self, current_x):
+        """ Objective value at current_x, reused from objective_memo
+        if current_x was evaluated recently."""
+
+        if self.objective_memo is None:
+            return self._evaluate_objective(current_x)
+        obj = self.objective_memo.get(current_x)
+        if obj is None:
+            obj = self._evaluate_objective(current_x)
+            self.objective_memo.put(current_x, obj)
+        return obj
+
+    def reset_objective_memo(self):
+        """ Start a new objective_memo, as the fixed and moving fibers
+        or sigma may have changed since the last compute."""
+
+        if self.objective_memo_size:
+            self.objective_memo = ObjectiveMemo(self.objective_memo_size, self.objective_memo_decimals)
+        else:
+            self.objective_memo = None
+
+    def _evaluate_objective(self, current_x):
+        """ Transform the moving fibers by current_x and compute the
+        objective."""
+
         # get and apply transforms from current_x
         ## t1 = time.time()
         moving = transform_fiber_array_numpy(self.moving, current_x, self.mode)
@@ -138,15 +245,64 @@ class RegisterTractography:
         ## print "DIFFERENCE IN TXFORMS:", np.max(diff), "TIME:", t2-t1, t3-t2
 
         # compute objective
-        obj = inner_loop_objective(self.fixed, moving, self.sigma * self.sigma)
+        if self.approximate:
+            obj = self.truncated_objective(moving)
+        else:
+            obj = inner_loop_objective(self.fixed, moving, self.sigma * self.sigma)
+
+        return obj
+
+    def objective_function_and_gradient(self, current_x):
+        """ The objective_function and its analytic gradient with
+        respect to current_x, for gradient based optimizers."""
+
+        self._x_opt = current_x
+
+        if self.objective_memo is None:
+            (obj, gradient) = self._evaluate_objective_and_gradient(current_x)
+        else:
+            value = self.objective_memo.get(current_x)
+            if value is None:
+                value = self._evaluate_objective_and_gradient(current_x)
+                self.objective_memo.put(current_x, value)
+            (obj, gradient) = value
 
-        # save objective function value for analysis of performance
         self.objective_function_values.append(obj)
 
         if self.verbose:
-            print(f"O: {obj} X: {self._x_opt}")
+            print(f"O: {obj} X: {self._x_opt} G: {gradient}")
 
-        return obj
+        return obj, gradient.copy()
+
+    def _evaluate_objective_and_gradient(self, current_x):
+        """ Transform the moving fibers by current_x and compute the
+        objective and its gradient with respect to current_x."""
+
+        matrix, translation, matrix_derivatives, translation_derivatives = \
+            affine_transform_matrix(current_x, self.mode, derivatives=True)
+        moving = np.tensordot(matrix, self.moving, axes=(1, 0))
+        moving += translation[:, np.newaxis, np.newaxis]
+
+        if self.approximate:
+            obj, moving_gradient = self.truncated_objective.objective_and_gradient(moving)
+        else:
+            obj, moving_gradient = inner_loop_objective_and_gradient(self.fixed, moving, self.sigma * self.sigma)
+
+        # chain rule through moved point = matrix * point + translation
+        matrix_gradient = np.tensordot(moving_gradient, self.moving, axes=([1, 2], [1, 2]))
+        gradient = np.tensordot(matrix_derivatives, matrix_gradient, axes=([1, 2], [0, 1]))
+        gradient += translation_derivatives @ np.sum(moving_gradient, axis=(1, 2))
+
+        return obj, gradient
+
+    def bounds(self):
+        """ Box bounds in the optimizer search space matching the
+        region allowed by constraint."""
+
+        lower = [-100, -100, -100, -90, -90, -90, 0.95, 0.95, 0.95, -90, -90, -90, -90, -90, -90]
+        upper = [100, 100, 100, 90, 90, 90, None, None, None, 90, 90, 90, 90, 90, 90]
+        return [(None if lo is None else lo * scale, None if hi is None else hi * scale)
+                for (lo, hi, scale) in zip(lower, upper, self.transform_scaling)]
 
     def compute(self):
 
@@ -207,6 +363,9 @@ class RegisterTractography:
         if self.verbose:
             print(f"<{os.path.basename(__file__)}> Initial value for X: {self.initial_transform}")
 
+        if self.approximate:
+            self.truncated_objective = TruncatedObjective(self.fixed, self.sigma * self.sigma, truncation_sigmas=self.truncation_sigmas)
+        self.reset_objective_memo()
 
         if self.optimizer == "Cobyla":
 
@@ -239,6 +398,19 @@ class RegisterTractography:
                                                                            iprint=0)
             print(f, dict)
 
+        elif self.optimizer == "LBFGS":
+            # L-BFGS-B with the analytic gradient of the objective, so
+            # each step costs one evaluation instead of one per
+            # parameter for finite differences. The constraint region
+            # is given as box bounds.
+            result = scipy.optimize.minimize(self.objective_function_and_gradient,
+                                             np.multiply(self.initial_transform,self.transform_scaling),
+                                             jac=True, method='L-BFGS-B', bounds=self.bounds(),
+                                             options={'maxfun': self.maxfun, 'maxiter': self.maxfun})
+            self.final_transform = result.x
+            if self.verbose:
+                print(result.fun, result.message)
+
         elif self.optimizer == "Powell":
             # Test optimization with Powell's method
             # Powell's method is a conjugate direction method.
@@ -257,6 +429,11 @@ class RegisterTractography:
             raise NotImplementedError(
                 f"Workflow not implemented for optimizer: {self.optimizer}.")
 
+        if self.approximate:
+            print(self.truncated_objective.report(transform_fiber_array_numpy(self.moving, self.final_transform, self.mode)))
+        if self.objective_memo is not None:
+            print(self.objective_memo.report())
+
         self.final_transform = np.divide(self.final_transform, self.transform_scaling)
 
         # modify the output according to the mode. Note: ideally for
@@ -290,33 +467,287 @@ class RegisterTractography:
         return self.final_transform
 
 
-def inner_loop_objective(fixed, moving, sigmasq):
+# Maximum number of (moving, fixed) fiber pairs compared at once by
+# inner_loop_objective, bounding its temporary memory (8 bytes each)
+OBJECTIVE_BLOCK_PAIRS = 1 << 22
+
+def _flatten_fiber_array(fibers):
+    """Reshape a (3, number of fibers, points per fiber) array into
+    (number of fibers, 3 * points per fiber), one row per fiber."""
+
+    return np.ascontiguousarray(np.transpose(fibers, (1, 2, 0))).reshape(fibers.shape[1], -1)
+
+def inner_loop_objective(fixed, moving, sigmasq, block_pairs=OBJECTIVE_BLOCK_PAIRS):
     """The code called within the objective_function to find the negative log
 
     probability of one brain given all other brains.
+
+    Equivalent to summing total_probability_numpy over the moving
+    fibers, but computed for blocks of moving fibers at once. The mean
+    squared point distance between fibers m and f is
+    (|m|^2 + |f|^2 - 2 m.f) / points_per_fiber, so each block needs
+    one matrix product for each fiber orientation (forward, and the
+    moving fibers reversed). Probabilities are summed as log-sum-exp,
+    so they do not underflow for distant fibers.
+    """
+
+    return _inner_loop_objective(fixed, moving, sigmasq, block_pairs)
+
+def inner_loop_objective_and_gradient(fixed, moving, sigmasq, block_pairs=OBJECTIVE_BLOCK_PAIRS):
+    """inner_loop_objective and its gradient with respect to the moving
+    fiber points, an array shaped like moving.
+
+    Each fixed fiber pulls the points of a moving fiber towards its own
+    points (in the orientation giving the lower distance), weighted by
+    its share of the moving fiber's probability.
     """
 
+    return _inner_loop_objective(fixed, moving, sigmasq, block_pairs, gradient=True)
+
+def _block_log_probability(moving_flat, moving_reversed_flat, moving_sqnorm, fixed_flat, fixed_sqnorm, points_per_fiber, sigmasq, gradient=False):
+    """Log of the total probability of each of a block of moving fibers
+    given the fixed fibers, and the largest exponent of each. With
+    gradient, also the derivative of the negative log probability with
+    respect to the flattened moving fibers."""
+
+    # small probability added to each fiber, as a floor for outliers
+    log_floor = np.log(1e-20)
+    scale = -1.0 / (points_per_fiber * sigmasq)
+
+    dot_forward = moving_flat @ fixed_flat.T
+    dot_reversed = moving_reversed_flat @ fixed_flat.T
+    # largest dot product of the two orientations gives the lower distance
+    is_reversed = dot_reversed > dot_forward
+    distance = moving_sqnorm[:, np.newaxis] + fixed_sqnorm[np.newaxis, :]
+    distance -= 2.0 * np.maximum(dot_forward, dot_reversed)
+    # rounding can make distances of identical fibers slightly negative
+    np.maximum(distance, 0.0, out=distance)
+    # log of the total probability exp(-distance / sigmasq) over fixed fibers
+    exponent = distance
+    exponent *= scale
+    max_exponent = np.max(exponent, axis=1)
+    exponent -= max_exponent[:, np.newaxis]
+    weights = np.exp(exponent, out=exponent)
+    log_probability = np.logaddexp(max_exponent + np.log(np.sum(weights, axis=1)), log_floor)
+    if not gradient:
+        return log_probability, max_exponent
+
+    # weight of each fixed fiber in the probability of each moving fiber
+    weights *= np.exp(max_exponent - log_probability)[:, np.newaxis]
+    weights_reversed = np.where(is_reversed, weights, 0.0)
+    weights_forward = weights - weights_reversed
+    pull = (weights_forward @ fixed_flat).reshape(-1, points_per_fiber, 3)
+    pull += (weights_reversed @ fixed_flat).reshape(-1, points_per_fiber, 3)[:, ::-1, :]
+    # derivative of -log probability, through d distance / d moving = 2 (moving - fixed)
+    block_gradient = np.sum(weights, axis=1)[:, np.newaxis] * moving_flat - pull.reshape(len(weights), -1)
+    return log_probability, max_exponent, block_gradient * (2.0 / (points_per_fiber * sigmasq))
+
+def _unflatten_gradient(moving_gradient, points_per_fiber):
+    """Reshape a gradient with one row per fiber back to the
+    (3, number of fibers, points per fiber) layout of the fibers."""
+
+    return np.transpose(moving_gradient.reshape(moving_gradient.shape[0], points_per_fiber, 3), (2, 0, 1))
+
+def _inner_loop_objective(fixed, moving, sigmasq, block_pairs, gradient=False):
+    """Blocked implementation of inner_loop_objective and its gradient."""
+
     (dims, number_of_fibers_moving, points_per_fiber) = moving.shape
     # number of compared fibers (normalization factor)
     (dims, number_of_fibers_fixed, points_per_fiber) = fixed.shape
 
-    probability = np.zeros(number_of_fibers_moving) + 1e-20
-    
-    # Loop over fibers in moving. Find total probability of
-    # each fiber using all fibers from fixed.
-    for idx in range(number_of_fibers_moving):
-        probability[idx] += total_probability_numpy(moving[:,idx,:], fixed,
-                sigmasq)
+    fixed_flat = _flatten_fiber_array(fixed)
+    moving_flat = _flatten_fiber_array(moving)
+    moving_reversed_flat = _flatten_fiber_array(moving[:, :, ::-1])
+    fixed_sqnorm = np.sum(np.square(fixed_flat), axis=1)
+    moving_sqnorm = np.sum(np.square(moving_flat), axis=1)
+
+    log_probability = np.zeros(number_of_fibers_moving)
+    if gradient:
+        moving_gradient = np.zeros(moving_flat.shape)
+    block_size = max(1, block_pairs // max(1, number_of_fibers_fixed))
+    for start in range(0, number_of_fibers_moving, block_size):
+        block = slice(start, start + block_size)
+        result = _block_log_probability(moving_flat[block], moving_reversed_flat[block], moving_sqnorm[block],
+                                        fixed_flat, fixed_sqnorm, points_per_fiber, sigmasq, gradient=gradient)
+        log_probability[block] = result[0]
+        if gradient:
+            moving_gradient[block] = result[2]
 
     # Divide total probability by number of fibers in the atlas ("mean
     # brain").  This neglects Z, the normalization constant for the
     # pdf, which would not affect the optimization.
-    probability /= number_of_fibers_fixed
-    #print np.min(probability), np.max(probability)
+    log_probability -= np.log(number_of_fibers_fixed)
     # add negative log probabilities of all fibers in this brain.
-    entropy = np.sum(- np.log(probability))
+    entropy = np.sum(- log_probability)
+
+    if gradient:
+        return entropy, _unflatten_gradient(moving_gradient, points_per_fiber)
     return entropy
 
+# Fixed fibers whose centroid is farther than this many sigma from a
+# moving fiber's centroid are left out of the approximate objective
+TRUNCATION_SIGMAS = 3.0
+
+def _fiber_centroids(fibers):
+    """Mean point of each fiber in a (3, number of fibers, points per
+    fiber) array, as (number of fibers, 3)."""
+
+    return np.mean(fibers, axis=2).T
+
+class TruncatedObjective:
+
+    """Approximation of inner_loop_objective that compares each moving
+    fiber only with the fixed fibers near it.
+
+    The mean squared point distance between two fibers, in either
+    orientation, is at least the squared distance between their
+    centroids. Fixed fibers with a centroid farther than
+    truncation_sigmas * sigma from that of a moving fiber therefore
+    each add less than exp(-truncation_sigmas**2) to its probability,
+    and are left out. Moving fibers with no fixed fiber that close are
+    outliers and are compared with all fixed fibers.
+
+    Moving fibers are grouped by the grid cell (truncation_sigmas *
+    sigma wide) of their centroid. The candidate neighbours of each
+    group are found in a k-d tree of the fixed fiber centroids, out to
+    an extra margin (default sigma), and compared with one matrix
+    product. The groups and candidates are reused for later transforms
+    of the same moving fibers until a moving centroid has moved by more
+    than the margin, which triggers a new search.
+    """
+
+    def __init__(self, fixed, sigmasq, truncation_sigmas=TRUNCATION_SIGMAS, margin=None, block_pairs=OBJECTIVE_BLOCK_PAIRS):
+        self.fixed = fixed
+        self.sigmasq = sigmasq
+        self.truncation_sigmas = truncation_sigmas
+        self.radius = truncation_sigmas * np.sqrt(sigmasq)
+        if margin is None:
+            margin = np.sqrt(sigmasq)
+        self.margin = margin
+        self.block_pairs = block_pairs
+
+        self._fixed_flat = _flatten_fiber_array(fixed)
+        self._fixed_sqnorm = np.sum(np.square(self._fixed_flat), axis=1)
+        self._tree = scipy.spatial.cKDTree(_fiber_centroids(fixed))
+        # moving centroids at the last search, and the groups of
+        # (moving fiber indices, candidate fixed fiber indices)
+        self._search_centroids = None
+        self._groups = None
+
+        # statistics
+        self.evaluations = 0
+        self.searches = 0
+        self.compared_pairs = 0
+
+    def _candidate_groups(self, moving):
+        """Groups of moving fibers and their candidate neighbours,
+        searched again if the fibers have moved too far since the last
+        search."""
+
+        centroids = _fiber_centroids(moving)
+        if self._search_centroids is not None and centroids.shape == self._search_centroids.shape and \
+                np.max(np.sum(np.square(centroids - self._search_centroids), axis=1)) <= self.margin ** 2:
+            return self._groups
+
+        cells = np.floor(centroids / max(self.radius, np.finfo(float).tiny)).astype(np.int64)
+        (unique_cells, cell_index) = np.unique(cells, axis=0, return_inverse=True)
+        cell_index = cell_index.ravel()
+        order = np.argsort(cell_index, kind='stable')
+        boundaries = np.cumsum(np.bincount(cell_index, minlength=len(unique_cells)))
+
+        self._groups = list()
+        start = 0
+        for stop in boundaries:
+            members = order[start:stop]
+            start = stop
+            center = np.mean(centroids[members], axis=0)
+            extent = np.sqrt(np.max(np.sum(np.square(centroids[members] - center), axis=1)))
+            candidates = np.array(self._tree.query_ball_point(center, self.radius + self.margin + extent), dtype=np.intp)
+            self._groups.append((members, candidates))
+        self._search_centroids = centroids
+        self.searches += 1
+        return self._groups
+
+    def __call__(self, moving):
+        """Approximate inner_loop_objective(fixed, moving, sigmasq)."""
+
+        return self._objective(moving)
+
+    def objective_and_gradient(self, moving):
+        """Approximate inner_loop_objective_and_gradient(fixed, moving,
+        sigmasq). Left out fixed fibers do not contribute to the
+        gradient, as they do not to the objective."""
+
+        return self._objective(moving, gradient=True)
+
+    def _objective(self, moving, gradient=False):
+        (dims, number_of_fibers_moving, points_per_fiber) = moving.shape
+        groups = self._candidate_groups(moving)
+
+        moving_flat = _flatten_fiber_array(moving)
+        moving_reversed_flat = _flatten_fiber_array(moving[:, :, ::-1])
+        moving_sqnorm = np.sum(np.square(moving_flat), axis=1)
+        log_floor = np.log(1e-20)
+
+        log_probability = np.full(number_of_fibers_moving, log_floor)
+        max_exponent_per_fiber = np.full(number_of_fibers_moving, -np.inf)
+        if gradient:
+            moving_gradient = np.zeros(moving_flat.shape)
+        for (members, candidates) in groups:
+            if len(candidates) == 0:
+                continue
+            fixed_flat = self._fixed_flat[candidates]
+            fixed_sqnorm = self._fixed_sqnorm[candidates]
+            block_size = max(1, self.block_pairs // len(candidates))
+            for start in range(0, len(members), block_size):
+                block = members[start:start + block_size]
+                # as in _inner_loop_objective, restricted to the candidates
+                result = _block_log_probability(moving_flat[block], moving_reversed_flat[block], moving_sqnorm[block],
+                                                fixed_flat, fixed_sqnorm, points_per_fiber, self.sigmasq, gradient=gradient)
+                log_probability[block] = result[0]
+                max_exponent_per_fiber[block] = result[1]
+                if gradient:
+                    moving_gradient[block] = result[2]
+            self.compared_pairs += len(members) * len(candidates)
+        log_probability -= np.log(self.fixed.shape[1])
+        entropy = np.sum(- log_probability)
+        if gradient:
+            moving_gradient = _unflatten_gradient(moving_gradient, points_per_fiber)
+
+        # outliers are dominated by the left out fibers
+        outliers = max_exponent_per_fiber < -self.truncation_sigmas ** 2
+        if np.any(outliers):
+            entropy -= np.sum(- log_probability[outliers])
+            if gradient:
+                (outlier_entropy, outlier_gradient) = inner_loop_objective_and_gradient(
+                    self.fixed, moving[:, outliers, :], self.sigmasq, block_pairs=self.block_pairs)
+                moving_gradient[:, outliers, :] = outlier_gradient
+            else:
+                outlier_entropy = inner_loop_objective(self.fixed, moving[:, outliers, :], self.sigmasq, block_pairs=self.block_pairs)
+            entropy += outlier_entropy
+            self.compared_pairs += np.count_nonzero(outliers) * self.fixed.shape[1]
+
+        self.evaluations += 1
+        if gradient:
+            return entropy, moving_gradient
+        return entropy
+
+    def approximation_error(self, moving):
+        """Return the approximate and exact objective for moving, and
+        their relative difference."""
+
+        approximate = self(moving)
+        exact = inner_loop_objective(self.fixed, moving, self.sigmasq, block_pairs=self.block_pairs)
+        return approximate, exact, abs(approximate - exact) / max(abs(exact), np.finfo(float).tiny)
+
+    def report(self, moving):
+        """Human-readable approximation error for moving and statistics."""
+
+        approximate, exact, relative_error = self.approximation_error(moving)
+        fraction = self.compared_pairs / max(1, self.evaluations * moving.shape[1] * self.fixed.shape[1])
+        return (f"APPROXIMATE OBJECTIVE: {approximate} EXACT: {exact} RELATIVE ERROR: {relative_error:.3e} "
+                f"PAIRS COMPARED: {100 * fraction:.1f}% NEIGHBOR SEARCHES: {self.searches} EVALUATIONS: {self.evaluations}")
+
 def total_probability_numpy(moving_fiber, fixed_fibers, sigmasq):
     """Compute total probability for moving fiber when compared to all fixed
 
@@ -377,23 +808,13 @@ def transform_fiber_array_numpy(in_array, transform, mode=[1,1,1,1]):
     shear. Fibers are assumed to be in RAS (or LPS as long as all inputs
     are consistent).  Transformed fibers are returned.
     """
-    (dims, number_of_fibers, points_per_fiber) = in_array.shape
-    out_array = np.zeros(in_array.shape)
-
-    vtktrans = convert_transform_to_vtk(transform, scaled=True, mode=mode)
+    matrix, translation = affine_transform_matrix(transform, mode=mode)
 
     # Transform moving fiber array by applying transform to original fibers
-    for lidx in range(0, number_of_fibers):
-        for pidx in range(0, points_per_fiber):
-            pt = vtktrans.TransformPoint(in_array[0, lidx, pidx],
-                                         in_array[1, lidx, pidx], 
-                                         in_array[2, lidx, pidx])
-            out_array[0, lidx, pidx] = pt[0]
-            out_array[1, lidx, pidx] = pt[1]
-            out_array[2, lidx, pidx] = pt[2]
+    out_array = np.tensordot(matrix, in_array, axes=(1, 0))
+    out_array += translation[:, np.newaxis, np.newaxis]
 
     #print in_array[0, lidx, pidx], in_array[1, lidx, pidx], in_array[2, lidx, pidx], "===>>>", out_array[0, lidx, pidx], out_array[1, lidx, pidx], out_array[2, lidx, pidx]
-    del vtktrans
 
     ## uncomment for testing only
     ## # convert it back to a fiber object and render it
@@ -413,6 +834,92 @@ def transform_fiber_array_numpy(in_array, transform, mode=[1,1,1,1]):
     
     return out_array
 
+# transform_scaling of RegisterTractography, as used by convert_transform_to_vtk
+TRANSFORM_SCALING = np.array([1, 1, 1, .5, .5, .5, 200, 200, 200, 1, 1, 1, 1, 1, 1])
+
+def _rotation_matrix(axis, angle):
+    """Rotation by angle (radians) about axis 0, 1 or 2, as in
+    vtkTransform.RotateX/Y/Z, and its derivative with respect to the
+    angle."""
+
+    (c, s) = (np.cos(angle), np.sin(angle))
+    (i, j) = [(1, 2), (2, 0), (0, 1)][axis]
+    rotation = np.eye(3)
+    rotation[i, i] = rotation[j, j] = c
+    rotation[i, j] = -s
+    rotation[j, i] = s
+    derivative = np.zeros((3, 3))
+    derivative[i, i] = derivative[j, j] = -s
+    derivative[i, j] = -c
+    derivative[j, i] = c
+    return rotation, derivative
+
+def affine_transform_matrix(transform, mode=[1,1,1,1], derivatives=False):
+    """Return the 3x3 matrix and translation of the 15-component
+    transform as scaled in the optimizer search space, built like
+    convert_transform_to_vtk(transform, scaled=True, mode=mode).
+
+    If derivatives is True, also return the derivatives of the matrix
+    (15x3x3) and of the translation (15x3) with respect to each
+    component. Components disabled by mode have zero derivatives.
+    """
+
+    transform = np.divide(transform, TRANSFORM_SCALING)
+    degrees = np.pi / 180.0
+
+    # factors of the matrix in order: rotations about R, A, S, scale,
+    # then skews. Each is (factor, [(parameter index, derivative of
+    # factor with respect to the parameter), ...]).
+    factors = list()
+    if mode[1]:
+        for axis in range(3):
+            rotation, derivative = _rotation_matrix(axis, transform[3 + axis] * degrees)
+            factors.append((rotation, [(3 + axis, derivative * degrees / TRANSFORM_SCALING[3 + axis])]))
+    if mode[2]:
+        for axis in range(3):
+            scale = np.eye(3)
+            scale[axis, axis] = transform[6 + axis]
+            derivative = np.zeros((3, 3))
+            derivative[axis, axis] = 1.0 / TRANSFORM_SCALING[6 + axis]
+            factors.append((scale, [(6 + axis, derivative)]))
+    if mode[3]:
+        # skewx (szy, syz), skewy (szx, sxz), skewz (sxy, syx) as (parameter index, row, column)
+        for skew in ([(14, 2, 1), (12, 1, 2)], [(13, 2, 0), (10, 0, 2)], [(9, 1, 0), (11, 0, 1)]):
+            skew_matrix = np.eye(3)
+            skew_derivatives = list()
+            for (index, row, column) in skew:
+                skew_matrix[row, column] = np.tan(transform[index] * degrees)
+                derivative = np.zeros((3, 3))
+                derivative[row, column] = degrees / np.cos(transform[index] * degrees) ** 2 / TRANSFORM_SCALING[index]
+                skew_derivatives.append((index, derivative))
+            factors.append((skew_matrix, skew_derivatives))
+
+    matrix = np.eye(3)
+    for (factor, factor_derivatives) in factors:
+        matrix = matrix @ factor
+
+    translation = transform[0:3] if mode[0] else np.zeros(3)
+
+    if not derivatives:
+        return matrix, translation
+
+    # product rule: replace one factor by its derivative
+    matrix_derivatives = np.zeros((15, 3, 3))
+    for (factor_index, (factor, factor_derivatives)) in enumerate(factors):
+        before = np.eye(3)
+        for (other, other_derivatives) in factors[:factor_index]:
+            before = before @ other
+        after = np.eye(3)
+        for (other, other_derivatives) in factors[factor_index + 1:]:
+            after = after @ other
+        for (index, derivative) in factor_derivatives:
+            matrix_derivatives[index] = before @ derivative @ after
+    translation_derivatives = np.zeros((15, 3))
+    if mode[0]:
+        translation_derivatives[0:3, 0:3] = np.diag(1.0 / TRANSFORM_SCALING[0:3])
+
+    return matrix, translation, matrix_derivatives, translation_derivatives
+
 def transform_fiber_array_numpyNOTUSED(moving_points, number_of_fibers, points_per_fiber, transform):
     """Transform in_array of R,A,S by transform (15 components, rotation about
     R,A,S, translation in R, A, S,  scale along R, A, S, and
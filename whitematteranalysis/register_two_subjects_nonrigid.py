@@ -16,9 +16,14 @@ import time
 import numpy as np
 import scipy.optimize
 import vtk
+from vtk.util import numpy_support
 
 import whitematteranalysis as wma
 
+# Maximum number of (point, landmark) pairs in one block of the thin
+# plate spline kernel matrix, bounding its temporary memory
+TPS_BLOCK_PAIRS = 1 << 22
+
 
 class RegisterTractographyNonrigidThinPlateSplines(wma.register_two_subjects.RegisterTractography):
 
@@ -93,6 +98,16 @@ class RegisterTractographyNonrigidThinPlateSplines(wma.register_two_subjects.Reg
         # keep track of the best objective we have seen so far to return that when computation stops.
         self.minimum_objective = np.inf
 
+        # thin plate spline evaluation: single precision kernel, and its block size
+        self.float32 = False
+        self.block_pairs = TPS_BLOCK_PAIRS
+
+        # remember recent objective values by parameter vector
+        # (see register_two_subjects.ObjectiveMemo)
+        self.objective_memo_size = wma.register_two_subjects.OBJECTIVE_MEMO_SIZE
+        self.objective_memo_decimals = None
+        self.objective_memo = None
+
         # choice of optimization method
         #self.optimizer = "Powell"
         self.optimizer = "Cobyla"
@@ -137,11 +152,7 @@ class RegisterTractographyNonrigidThinPlateSplines(wma.register_two_subjects.Reg
         class: threshold, sigma. Compares sampled fibers from moving
         input, to all fibers of fixed input."""
 
-        # get and apply transforms from current_x
-        moving = self.transform_fiber_array_numpy(self.moving, current_x)
-
-        # compute objective
-        obj = wma.register_two_subjects.inner_loop_objective(self.fixed, moving, self.sigma * self.sigma)
+        obj = self.memoized_objective(current_x)
 
         # keep track of minimum objective so far and its matching transform
         if obj < self.minimum_objective:
@@ -158,28 +169,37 @@ class RegisterTractographyNonrigidThinPlateSplines(wma.register_two_subjects.Reg
         #print "X:", self._x_opt
         return obj
 
+    def _evaluate_objective(self, current_x):
+        """ Transform the moving fibers by current_x and compute the
+        objective."""
+
+        # get and apply transforms from current_x
+        moving = self.transform_fiber_array_numpy(self.moving, current_x)
+
+        # compute objective
+        return wma.register_two_subjects.inner_loop_objective(self.fixed, moving, self.sigma * self.sigma)
+
     def transform_fiber_array_numpy(self, in_array, source_landmarks):
         """Transform in_array of R,A,S by transform (a list of source points).  Transformed fibers are returned.
+
+        The thin plate spline is solved and evaluated with numpy, giving
+        the same result as TransformPoint of
+        convert_transform_to_vtk(source_landmarks, self.target_points).
+        With self.float32 the kernel matrix is computed in single
+        precision, and self.block_pairs bounds its size.
         """
         (dims, number_of_fibers, points_per_fiber) = in_array.shape
-        out_array = np.zeros(in_array.shape)
 
-        vtktrans = convert_transform_to_vtk(source_landmarks, self.target_points)
-        #print "2:", vtktrans
-        #vtktrans = vtk.vtkTransform()
-        
+        source_landmarks = np.asarray(source_landmarks, dtype=np.float64).reshape(-1, 3)
+        target_landmarks = np.asarray(self.target_landmarks, dtype=np.float64).reshape(-1, 3)
+        (kernel_weights, affine_weights) = thin_plate_spline_coefficients(source_landmarks, target_landmarks)
+
         # Transform moving fiber array by applying transform to original fibers
-        for lidx in range(0, number_of_fibers):
-            for pidx in range(0, points_per_fiber):
-                pt = vtktrans.TransformPoint(in_array[0, lidx, pidx],
-                                            in_array[1, lidx, pidx], 
-                                            in_array[2, lidx, pidx])
-                out_array[0, lidx, pidx] = pt[0]
-                out_array[1, lidx, pidx] = pt[1]
-                out_array[2, lidx, pidx] = pt[2]
-
-        #print in_array[0, lidx, pidx], in_array[1, lidx, pidx], in_array[2, lidx, pidx], "===>>>", out_array[0, lidx, pidx], out_array[1, lidx, pidx], out_array[2, lidx, pidx]
-        del vtktrans
+        points = in_array.reshape(3, -1).T
+        dtype = np.float32 if self.float32 else np.float64
+        out_array = thin_plate_spline_transform_points(points, source_landmarks, kernel_weights, affine_weights,
+                                                       block_pairs=self.block_pairs, dtype=dtype)
+        out_array = out_array.T.reshape(in_array.shape)
 
         ## uncomment for testing only
         ## # convert it back to a fiber object and render it
@@ -248,6 +268,8 @@ class RegisterTractographyNonrigidThinPlateSplines(wma.register_two_subjects.Reg
         if self.verbose:
             print(f"<{os.path.basename(__file__)}> Initial value for X: {self.initial_transform}")
 
+        self.reset_objective_memo()
+
         if self.optimizer == "Cobyla":
 
             # Optimize using cobyla. Allows definition of initial and
@@ -309,6 +331,9 @@ class RegisterTractographyNonrigidThinPlateSplines(wma.register_two_subjects.Reg
             raise NotImplementedError(
                 f"Workflow not implemented for optimizer: {self.optimizer}.")
 
+        if self.objective_memo is not None:
+            print(self.objective_memo.report())
+
         if self.verbose:
             print("O:", self.objective_function_values)
 
@@ -317,17 +342,59 @@ class RegisterTractographyNonrigidThinPlateSplines(wma.register_two_subjects.Reg
 
 def convert_numpy_array_to_vtk_points(inarray):
     """ Convert numpy array or flat list of points to vtkPoints."""
-    
-    number_of_points = len(inarray)/3
+
+    points = np.ascontiguousarray(np.asarray(inarray, dtype=np.float64).reshape(-1, 3))
     vtk_points = vtk.vtkPoints()
-    vtk_points.SetNumberOfPoints(number_of_points)
-    idx = 0
-    for pt in zip(inarray[::3], inarray[1::3], inarray[2::3]):
-        #print pt
-        vtk_points.SetPoint(idx, pt[0], pt[1], pt[2])
-        idx += 1
+    vtk_points.SetData(numpy_support.numpy_to_vtk(points, deep=True))
     return vtk_points
 
+def thin_plate_spline_coefficients(source_landmarks, target_landmarks):
+    """Solve for the thin plate spline mapping the (N, 3)
+    source_landmarks onto target_landmarks, with the R basis as in
+    vtkThinPlateSplineTransform.
+
+    Returns the (N, 3) kernel weights and the (4, 3) affine part (the
+    constant term, then the matrix) for
+    thin_plate_spline_transform_points.
+    """
+
+    number_of_landmarks = len(source_landmarks)
+    system = np.zeros((number_of_landmarks + 4, number_of_landmarks + 4))
+    system[:number_of_landmarks, :number_of_landmarks] = \
+        np.linalg.norm(source_landmarks[:, np.newaxis, :] - source_landmarks[np.newaxis, :, :], axis=2)
+    system[:number_of_landmarks, number_of_landmarks] = 1.0
+    system[:number_of_landmarks, number_of_landmarks + 1:] = source_landmarks
+    system[number_of_landmarks:, :number_of_landmarks] = system[:number_of_landmarks, number_of_landmarks:].T
+    right_hand_side = np.zeros((number_of_landmarks + 4, 3))
+    right_hand_side[:number_of_landmarks] = target_landmarks
+    solution = np.linalg.solve(system, right_hand_side)
+    return solution[:number_of_landmarks], solution[number_of_landmarks:]
+
+def thin_plate_spline_transform_points(points, source_landmarks, kernel_weights, affine_weights,
+                                       block_pairs=TPS_BLOCK_PAIRS, dtype=np.float64):
+    """Transform the (M, 3) points by the thin plate spline from
+    thin_plate_spline_coefficients.
+
+    The kernel matrix of distances from points to landmarks is computed
+    for blocks of points of at most block_pairs entries, in dtype
+    (np.float32 halves its memory and time).
+    """
+
+    points = np.asarray(points, dtype=np.float64)
+    out_points = points @ affine_weights[1:] + affine_weights[0]
+    landmarks = np.asarray(source_landmarks, dtype=dtype)
+    kernel_weights = np.asarray(kernel_weights, dtype=dtype)
+    block_size = max(1, block_pairs // max(1, len(landmarks)))
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size].astype(dtype)
+        # distance from each point to each landmark, one coordinate at a time
+        kernel = np.square(block[:, 0:1] - landmarks[:, 0])
+        kernel += np.square(block[:, 1:2] - landmarks[:, 1])
+        kernel += np.square(block[:, 2:3] - landmarks[:, 2])
+        np.sqrt(kernel, out=kernel)
+        out_points[start:start + block_size] += kernel @ kernel_weights
+    return out_points
+
 def convert_transform_to_vtk(source_landmarks, target_points):
     """Produce an output vtkThinPlateSplineTransform corresponding to the
 
@@ -9,12 +9,14 @@ class RegisterTractographyNonrigid
 
 """
 
+import functools
 import os
 import sys
 import time
 
 import numpy as np
 import scipy.optimize
+import scipy.sparse
 import vtk
 import vtk.util.numpy_support
 
@@ -99,11 +101,26 @@ class RegisterTractographyNonrigid(wma.register_two_subjects.RegisterTractograph
         # keep track of the best objective we have seen so far to return that when computation stops.
         self.minimum_objective = np.inf
 
+        # spline weights of the moving fiber points: (moving array, grid dims, sparse matrix)
+        self._weight_matrix = None
+
         # choice of optimization method
         #self.optimizer = "Powell"
         #self.optimizer = "Cobyla"
         self.optimizer = "BFGS"
 
+        # compare moving fibers only with fixed fibers within a few sigma
+        # (see register_two_subjects.TruncatedObjective)
+        self.approximate = False
+        self.truncation_sigmas = wma.register_two_subjects.TRUNCATION_SIGMAS
+        self.truncated_objective = None
+
+        # remember recent objective values by parameter vector
+        # (see register_two_subjects.ObjectiveMemo)
+        self.objective_memo_size = wma.register_two_subjects.OBJECTIVE_MEMO_SIZE
+        self.objective_memo_decimals = None
+        self.objective_memo = None
+
     def initialize_nonrigid_grid(self):
         res = self.nonrigid_grid_resolution
         self.displacement_field_numpy = np.zeros(res*res*res*3)
@@ -119,11 +136,7 @@ class RegisterTractographyNonrigid(wma.register_two_subjects.RegisterTractograph
         #scaled_current_x = current_x * 0.01
         scaled_current_x = current_x / self.scaling
         
-        # get and apply transforms from current_x
-        moving = self.transform_fiber_array_numpy(self.moving, scaled_current_x)
-
-        # compute objective
-        obj = wma.register_two_subjects.inner_loop_objective(self.fixed, moving, self.sigma * self.sigma)
+        obj = self.memoized_objective(current_x)
 
         # keep track of minimum objective so far and its matching transform
         if obj < self.minimum_objective:
@@ -149,44 +162,42 @@ class RegisterTractographyNonrigid(wma.register_two_subjects.RegisterTractograph
 
         return obj
 
+    def _evaluate_objective(self, current_x):
+        """ Transform the moving fibers by current_x and compute the
+        objective."""
+
+        # get and apply transforms from current_x
+        moving = self.transform_fiber_array_numpy(self.moving, current_x / self.scaling)
+
+        # compute objective
+        if self.approximate:
+            obj = self.truncated_objective(moving)
+        else:
+            obj = wma.register_two_subjects.inner_loop_objective(self.fixed, moving, self.sigma * self.sigma)
+
+        return obj
+
     def transform_fiber_array_numpy(self, in_array, transform):
         """Transform in_array of R,A,S by transform (a list of source points).  Transformed fibers are returned.
+
+        The B-spline transform is evaluated with numpy, giving the same
+        result as TransformPoint of convert_transform_to_vtk(transform).
         """
         (dims, number_of_fibers, points_per_fiber) = in_array.shape
-        out_array = np.zeros(in_array.shape)
 
-        vtktrans = convert_transform_to_vtk(transform)
-        #print "2:", vtktrans
-        #vtktrans = vtk.vtkTransform()
-        
+        coefficients = bspline_coefficients(transform)
+        dims = coefficients.shape[0]
+
+        # The moving fibers are the same in every objective evaluation,
+        # so their spline weights are computed once.
+        if self._weight_matrix is None or self._weight_matrix[0] is not in_array or self._weight_matrix[1] != dims:
+            (origin, spacing) = grid_geometry(dims)
+            points = in_array.reshape(3, -1).T
+            self._weight_matrix = (in_array, dims, bspline_weight_matrix(points, dims, origin, spacing))
+
         # Transform moving fiber array by applying transform to original fibers
-        for lidx in range(0, number_of_fibers):
-            for pidx in range(0, points_per_fiber):
-                pt = vtktrans.TransformPoint(in_array[0, lidx, pidx],
-                                            in_array[1, lidx, pidx], 
-                                            in_array[2, lidx, pidx])
-                out_array[0, lidx, pidx] = pt[0]
-                out_array[1, lidx, pidx] = pt[1]
-                out_array[2, lidx, pidx] = pt[2]
-
-        #print in_array[0, lidx, pidx], in_array[1, lidx, pidx], in_array[2, lidx, pidx], "===>>>", out_array[0, lidx, pidx], out_array[1, lidx, pidx], out_array[2, lidx, pidx]
-        del vtktrans
-
-        ## uncomment for testing only
-        ## # convert it back to a fiber object and render it
-        ## global __render_count
-        ## if (np.mod(__render_count, 500) == 0) & False:
-        ##     fiber_array = wma.fibers.FiberArray()
-        ##     fiber_array.fiber_array_r = out_array[0,:,:]
-        ##     fiber_array.fiber_array_a = out_array[1,:,:]
-        ##     fiber_array.fiber_array_s = out_array[2,:,:]
-        ##     fiber_array.points_per_fiber = points_per_fiber
-        ##     fiber_array.number_of_fibers = number_of_fibers
-        ##     pd = fiber_array.convert_to_polydata()
-        ##     ren = wma.render.render(pd, number_of_fibers, verbose=False)
-        ##     ren.save_views('.', 'moving_{0:05d}_'.format(__render_count)+str(time.clock())[-5:-1])
-        ##     del ren
-        ## __render_count += 1
+        displacement = self._weight_matrix[2] @ coefficients.reshape(-1, 3)
+        out_array = in_array + displacement.T.reshape(in_array.shape)
 
         return out_array
 
@@ -254,6 +265,10 @@ class RegisterTractographyNonrigid(wma.register_two_subjects.RegisterTractograph
         # initialize time for objective function computations
         self.last_time = time.time()
 
+        if self.approximate:
+            self.truncated_objective = wma.register_two_subjects.TruncatedObjective(self.fixed, self.sigma * self.sigma, truncation_sigmas=self.truncation_sigmas)
+        self.reset_objective_memo()
+
         if self.optimizer == "Cobyla":
 
             print(f"INITIAL transform shape {self.initial_transform.shape}")
@@ -324,6 +339,12 @@ class RegisterTractographyNonrigid(wma.register_two_subjects.RegisterTractograph
         progress_file = open(self.progress_filename, 'a')
         self.total_time = time.time() - self.start_time
         print(f"Done optimizing. TOTAL TIME: {self.total_time}", file=progress_file)
+        if self.approximate:
+            report = self.truncated_objective.report(self.transform_fiber_array_numpy(self.moving, self.final_transform))
+            print(report)
+            print(report, file=progress_file)
+        if self.objective_memo is not None:
+            print(self.objective_memo.report(), file=progress_file)
         progress_file.close()
 
         if self.verbose:
@@ -332,6 +353,93 @@ class RegisterTractographyNonrigid(wma.register_two_subjects.RegisterTractograph
         # Return output transforms from this iteration
         return self.final_transform
 
+def grid_geometry(dims):
+    """Origin and spacing of the displacement grid with dims points per
+    axis. The grid always covers 200mm x 200mm x 200mm, centered at the
+    origin."""
+
+    # This MUST correspond to the size used in congeal_multisubject update_nonrigid_grid
+    size_mm = 200.0
+    return -size_mm / 2.0, size_mm / (dims - 1)
+
+@functools.lru_cache(maxsize=None)
+def _bspline_prefilter(dims):
+    """Matrix converting dims samples along one axis to cubic B-spline
+    coefficients, with the samples clamped beyond the edges as in
+    vtkImageBSplineCoefficients."""
+
+    # sampling the spline at the grid points gives (c[i-1] + 4 c[i] + c[i+1]) / 6
+    interpolation = np.zeros((dims, dims))
+    for idx in range(dims):
+        interpolation[idx, idx] += 4.0 / 6.0
+        interpolation[idx, max(idx - 1, 0)] += 1.0 / 6.0
+        interpolation[idx, min(idx + 1, dims - 1)] += 1.0 / 6.0
+    return np.linalg.inv(interpolation)
+
+def bspline_coefficients(transform):
+    """Cubic B-spline coefficients of the displacement field transform
+    (a flat array of displacement vectors on the grid, x fastest), as
+    an array indexed [z, y, x, component].
+
+    This computes what vtkImageBSplineCoefficients does in
+    convert_transform_to_vtk. The filter is separable, so it is one
+    small matrix product along each axis.
+    """
+
+    num_vectors = len(transform) // 3
+    dims = int(round(np.power(num_vectors, 1.0/3.0)))
+    prefilter = _bspline_prefilter(dims)
+    field = np.asarray(transform, dtype=np.float64).reshape(dims, dims, dims, 3)
+    return np.einsum('zk,yj,xi,kjic->zyxc', prefilter, prefilter, prefilter, field, optimize=True)
+
+def _bspline_weights(u, dims):
+    """Indices and cubic B-spline weights of the 4 coefficients along
+    one axis that affect each continuous grid coordinate u. Weights of
+    coefficients outside the grid are zero (vtkBSplineTransform border
+    mode Zero)."""
+
+    first = np.floor(u)
+    t = (u - first)[:, np.newaxis]
+    weights = np.concatenate(((1 - t) ** 3 / 6.0,
+                              (3 * t ** 3 - 6 * t ** 2 + 4) / 6.0,
+                              (-3 * t ** 3 + 3 * t ** 2 + 3 * t + 1) / 6.0,
+                              t ** 3 / 6.0), axis=1)
+    indices = first.astype(np.int64)[:, np.newaxis] + np.arange(-1, 3)
+    outside = (indices < 0) | (indices >= dims)
+    weights[outside] = 0.0
+    return np.clip(indices, 0, dims - 1), weights
+
+def bspline_weight_matrix(points, dims, origin, spacing):
+    """Sparse matrix (number of points x dims^3) of the weights of the
+    B-spline coefficients in the displacement of each of the (N, 3)
+    points, for a grid with the given origin and spacing. The
+    displacements are this matrix times the coefficients. Each point
+    depends on its 4 x 4 x 4 neighboring coefficients."""
+
+    u = (np.asarray(points, dtype=np.float64) - origin) / spacing
+    # points far outside the grid are not displaced, keep them from overflowing the indices
+    u = np.clip(u, -4.0, dims + 3.0)
+    (index_x, weight_x) = _bspline_weights(u[:, 0], dims)
+    (index_y, weight_y) = _bspline_weights(u[:, 1], dims)
+    (index_z, weight_z) = _bspline_weights(u[:, 2], dims)
+    number_of_points = len(u)
+    columns = ((index_z[:, :, np.newaxis, np.newaxis] * dims + index_y[:, np.newaxis, :, np.newaxis]) * dims
+               + index_x[:, np.newaxis, np.newaxis, :]).reshape(number_of_points, 64)
+    weights = (weight_z[:, :, np.newaxis, np.newaxis] * weight_y[:, np.newaxis, :, np.newaxis]
+               * weight_x[:, np.newaxis, np.newaxis, :]).reshape(number_of_points, 64)
+    # clipped indices repeat with zero weight, the sparse matrix sums duplicates
+    return scipy.sparse.csr_matrix((weights.ravel(), columns.ravel(), np.arange(0, 64 * number_of_points + 1, 64)),
+                                   shape=(number_of_points, dims ** 3))
+
+def bspline_displacement(points, coefficients, origin, spacing):
+    """Displacement of each of the (N, 3) points by the cubic B-spline
+    with coefficients (indexed [z, y, x, component]) on a grid with the
+    given origin and spacing, as vtkBSplineTransform computes it with
+    border mode Zero."""
+
+    dims = coefficients.shape[0]
+    return bspline_weight_matrix(points, dims, origin, spacing) @ coefficients.reshape(-1, 3)
+
 def convert_numpy_array_to_vtk_points(inarray):
     """ Convert numpy array or flat list of points to vtkPoints."""
     
@@ -370,12 +478,7 @@ def convert_transform_to_vtk(transform):
     #spacing origin extent
     num_vectors = len(transform) / 3
     dims = round(np.power(num_vectors, 1.0/3.0))
-    # This MUST correspond to the size used in congeal_multisubject update_nonrigid_grid
-    #size_mm = 240.0
-    size_mm = 200.0
-    origin = -size_mm / 2.0
-    # assume 240mm x 240mm x 240mm grid
-    spacing = size_mm / (dims - 1)
+    (origin, spacing) = grid_geometry(dims)
     grid_image.SetOrigin(origin, origin, origin)
     grid_image.SetSpacing(spacing, spacing, spacing)
     #grid_image.SetExtent(0, dims-1.0, 0, dims-1.0, 0, dims-1.0)
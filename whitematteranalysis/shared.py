@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+""" shared.py
+
+Read-only numpy arrays shared with worker processes.
+
+Large inputs such as the "mean brain" of a group registration or the
+fibers of a distance matrix are needed by every job. Instead of
+pickling a copy of them for each job, they are written once to a
+memory mapped file (in /dev/shm where available, so they stay in
+memory) and each job receives a small handle. Workers attach to the
+file by name and all of them read the same pages.
+
+class SharedArrays
+
+Registry of shared arrays, used as a context manager by the parent
+process. The files are removed when it is closed.
+
+class SharedArray
+
+Picklable handle to one shared array. attach() returns the array as a
+read-only memory map.
+
+"""
+
+import functools
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# number of arrays each process keeps attached between jobs
+_ATTACHED_ARRAYS = 16
+
+
+def _default_directory():
+    """Directory for shared array files: memory backed if possible."""
+
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+
+@functools.lru_cache(maxsize=_ATTACHED_ARRAYS)
+def _attach(filename):
+    return np.load(filename, mmap_mode='r', allow_pickle=False)
+
+
+class SharedArray:
+
+    """Handle to an array in a SharedArrays registry. Only the file
+    name, shape and type are pickled when it is sent to a worker."""
+
+    def __init__(self, filename, shape, dtype):
+        self.filename = filename
+        self.shape = shape
+        self.dtype = dtype
+
+    def __repr__(self):
+        return f"SharedArray({self.filename!r}, shape={self.shape}, dtype={self.dtype})"
+
+    def attach(self):
+        """Return the shared array, read-only. The mapping is reused by
+        later jobs in the same process."""
+
+        return _attach(self.filename)
+
+
+class SharedArrays:
+
+    """Registry of read-only arrays shared with worker processes, by
+    name. Use as a context manager, or call close() when the workers
+    are done, to remove the files.
+
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = _default_directory()
+        self.directory = tempfile.mkdtemp(prefix='wma_shared_', dir=directory)
+        self._arrays = dict()
+
+    def add(self, name, array):
+        """Copy array into shared memory under name, and return its
+        SharedArray handle."""
+
+        if name in self._arrays:
+            raise KeyError(f"Shared array {name} already exists")
+        array = np.asarray(array)
+        # a unique file name, so that arrays attached in long-lived
+        # workers are never confused with a later array of the same name
+        fd, filename = tempfile.mkstemp(suffix='.npy', prefix=f'{name}_', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array, allow_pickle=False)
+        handle = SharedArray(filename, array.shape, array.dtype)
+        self._arrays[name] = handle
+        return handle
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def close(self):
+        """Remove all shared arrays. Workers that still have them
+        attached keep their mapping until it is released."""
+
+        self._arrays = dict()
+        # release the mappings held by this process
+        _attach.cache_clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
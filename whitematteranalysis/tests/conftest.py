@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import vtk
+
+
+def _make_polydata(number_of_lines=60, seed=0):
+    """Build a small tractography polydata with point and cell data."""
+
+    rng = np.random.default_rng(seed)
+    points = vtk.vtkPoints()
+    lines = vtk.vtkCellArray()
+    fa = vtk.vtkFloatArray()
+    fa.SetName("FA")
+    tensors = vtk.vtkFloatArray()
+    tensors.SetName("tensors")
+    tensors.SetNumberOfComponents(9)
+    label = vtk.vtkIntArray()
+    label.SetName("Label")
+    for lidx in range(number_of_lines):
+        num_points = int(rng.integers(3, 40))
+        start = rng.uniform(-60, 60, 3)
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        ptids = vtk.vtkIdList()
+        for pidx in range(num_points):
+            point = start + pidx * 2.0 * direction
+            ptids.InsertNextId(points.InsertNextPoint(point))
+            fa.InsertNextTuple1(rng.uniform())
+            tensors.InsertNextTuple(rng.uniform(size=9))
+        lines.InsertNextCell(ptids)
+        label.InsertNextTuple1(lidx)
+    pd = vtk.vtkPolyData()
+    pd.SetPoints(points)
+    pd.SetLines(lines)
+    pd.GetPointData().AddArray(fa)
+    pd.GetPointData().AddArray(tensors)
+    pd.GetCellData().AddArray(label)
+    return pd
+
+
+@pytest.fixture
+def make_polydata():
+    return _make_polydata
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import pytest
+
+from whitematteranalysis import cache, fibers, filter, io
+
+
+@pytest.fixture
+def tract_cache(tmp_path):
+    yield cache.enable_cache(str(tmp_path / "cache"))
+    cache.disable_cache()
+
+
+def test_cache_disabled_by_default():
+
+    assert cache.get_cache() is None
+
+
+def test_get_put_and_stats(tract_cache):
+
+    key = tract_cache.key("test", "digest", number=1)
+    assert key != tract_cache.key("test", "digest", number=2)
+    assert tract_cache.get(key) is None
+    tract_cache.put(key, values=np.arange(5))
+    np.testing.assert_array_equal(tract_cache.get(key)["values"], np.arange(5))
+
+    stats = tract_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["stores"], stats["entries"]) == (1, 1, 1, 1)
+    assert "1 hits, 1 misses" in tract_cache.report()
+
+
+def test_lru_eviction(tract_cache):
+
+    keys = [tract_cache.key("test", str(idx)) for idx in range(3)]
+    for idx, key in enumerate(keys):
+        tract_cache.put(key, values=np.zeros(1000))
+        os.utime(tract_cache._filename(key), ns=(idx * 10 ** 9, idx * 10 ** 9))
+    # use the oldest entry, so the second one is least recently used
+    assert tract_cache.get(keys[0]) is not None
+
+    tract_cache.evict(max_size=2 * os.path.getsize(tract_cache._filename(keys[0])))
+
+    assert tract_cache.get(keys[1]) is None
+    assert tract_cache.get(keys[0]) is not None and tract_cache.get(keys[2]) is not None
+    assert tract_cache.stats()["evictions"] == 1
+
+
+def test_cache_from_environment_is_limited(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("WMA_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("WMA_CACHE_MAX_SIZE", raising=False)
+    try:
+        assert cache.get_cache().max_size == cache.DEFAULT_MAX_SIZE
+    finally:
+        cache.disable_cache()
+
+
+def test_preprocess_and_sampling_do_not_use_cache(tract_cache, make_polydata):
+
+    pd = make_polydata()
+    filter.preprocess(pd, 40, verbose=False)
+    filter.downsample(pd, 20, verbose=False, random_seed=1234)
+    filter.sample_line_indices(100, 10, random_seed=1234)
+    stats = tract_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (0, 0, 0)
+
+
+def test_fiber_array_uses_cache(tract_cache, make_polydata):
+
+    pd = make_polydata()
+    expected = fibers.FiberArray()
+    expected.convert_from_polydata(pd, points_per_fiber=7, use_cache=False)
+    for repeat in range(2):
+        fiber_array = fibers.FiberArray()
+        fiber_array.convert_from_polydata(pd, points_per_fiber=7)
+        np.testing.assert_array_equal(fiber_array.fiber_array_r, expected.fiber_array_r)
+        np.testing.assert_array_equal(fiber_array.fiber_array_s, expected.fiber_array_s)
+    assert tract_cache.hits == 1
+
+
+def test_read_and_preprocess_directory_uses_cache(tmp_path, tract_cache, make_polydata):
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for idx in range(3):
+        io.write_polydata(make_polydata(seed=idx), str(input_dir / f"subject{idx}.vtp"))
+
+    pds1, ids1 = io.read_and_preprocess_polydata_directory(str(input_dir), 30, 20, random_seed=1234)
+    hits = tract_cache.hits
+    pds2, ids2 = io.read_and_preprocess_polydata_directory(str(input_dir), 30, 20, random_seed=1234, parallel_jobs=2)
+
+    assert ids1 == ids2
+    assert tract_cache.hits == hits + 3
+    for pd1, pd2 in zip(pds1, pds2):
+        np.testing.assert_array_equal(io.TractographyArrays.from_polydata(pd1).points,
+                                      io.TractographyArrays.from_polydata(pd2).points)
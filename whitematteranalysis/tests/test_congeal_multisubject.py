@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import vtk
+
+from whitematteranalysis import congeal_multisubject, fibers, filter
+
+
+def _fiber_array(pd, points_per_fiber):
+    fiber_array = fibers.FiberArray()
+    fiber_array.convert_from_polydata(pd, points_per_fiber, use_cache=False)
+    return np.array([fiber_array.fiber_array_r, fiber_array.fiber_array_a, fiber_array.fiber_array_s])
+
+
+def test_leave_one_out_mean_matches_appended_polydata(make_polydata):
+    points_per_fiber = 10
+    samples = [filter.downsample(make_polydata(number_of_lines=n), 20, verbose=False, random_seed=1234) for n in (30, 25, 40)]
+
+    sampled_fibers = [_fiber_array(pd, points_per_fiber) for pd in samples]
+    offsets = np.cumsum([0] + [sample.shape[1] for sample in sampled_fibers])
+    all_sampled_fibers = np.concatenate(sampled_fibers, axis=1)
+
+    for subj_idx in range(len(samples)):
+        # the mean brain as computed by appending the other subjects' polydata
+        appender = vtk.vtkAppendPolyData()
+        for subj_idx2, pd in enumerate(samples):
+            if subj_idx2 != subj_idx:
+                appender.AddInputData(pd)
+        appender.Update()
+        expected = _fiber_array(appender.GetOutput(), points_per_fiber)
+
+        mean = congeal_multisubject.leave_one_out_mean(all_sampled_fibers, (offsets[subj_idx], offsets[subj_idx + 1]))
+        np.testing.assert_array_equal(mean, expected)
+
+
+def test_convergence_helpers():
+    assert congeal_multisubject.relative_improvement(100.0, 99.0) == 0.01
+    assert congeal_multisubject.relative_improvement(0.0, -1.0) == 0.0
+    assert not congeal_multisubject.has_converged(0.0, 0.0)
+    assert congeal_multisubject.has_converged(0.0005, 5.0, objective_tolerance=0.001)
+    assert not congeal_multisubject.has_converged(0.01, 5.0, objective_tolerance=0.001, transform_tolerance=0.1)
+    assert congeal_multisubject.has_converged(0.01, 0.05, objective_tolerance=0.001, transform_tolerance=0.1)
+
+    identity = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0, 0], dtype=float)
+    scaled = identity.copy()
+    scaled[6] = 1.01
+    # affine parameters are compared in the optimizer search space
+    np.testing.assert_allclose(congeal_multisubject.transform_change(identity, scaled, "Affine"), 2.0)
+    assert congeal_multisubject.transform_change(np.zeros(81), np.full(81, 0.5), "Nonrigid") == 0.5
+
+
+def test_converged_subjects_are_skipped(tmp_path, make_polydata):
+    register = congeal_multisubject.MultiSubjectRegistration()
+    register.output_directory = str(tmp_path)
+    register.parallel_jobs = 1
+    register.render = False
+    register.random_seed = 1000
+    register.mean_brain_size = 60
+    register.subject_brain_size = 30
+    register.maxfun = 20
+    for idx in range(3):
+        register.add_polydata(make_polydata(number_of_lines=40, seed=idx), f"subject_{idx}")
+
+    # any improvement below 100% counts as converged
+    register.objective_tolerance = 1.0
+    register.iterate()
+    assert all(register.subject_converged)
+    assert register.converged
+    register.iterate()
+    assert register.total_iterations == 1
+
+    # a new scale registers all subjects again
+    register.sigma = 10
+    register.objective_tolerance = None
+    register.iterate()
+    assert register.total_iterations == 2
+    assert not any(register.subject_converged)
+    assert not register.converged
+
+
+def test_skipped_subjects_keep_their_objective_in_totals(tmp_path, make_polydata):
+    register = congeal_multisubject.MultiSubjectRegistration()
+    register.output_directory = str(tmp_path)
+    register.parallel_jobs = 1
+    register.render = False
+    register.random_seed = 1000
+    register.mean_brain_size = 60
+    register.subject_brain_size = 30
+    register.maxfun = 20
+    for idx in range(3):
+        register.add_polydata(make_polydata(number_of_lines=40, seed=idx), f"subject_{idx}")
+
+    register.iterate()
+    np.testing.assert_allclose(register.objectives_after[-1], np.sum(register.subject_objectives))
+    skipped_objective = register.subject_objectives[0]
+    register.subject_converged[0] = True
+    register.iterate()
+
+    assert register.subject_objectives[0] == skipped_objective
+    np.testing.assert_allclose(register.objectives_after[-1], np.sum(register.subject_objectives))
+    assert register.objectives_before[-1] > skipped_objective
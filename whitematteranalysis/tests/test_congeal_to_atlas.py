@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from whitematteranalysis import congeal_to_atlas, fibers, filter, io
+
+
+def test_preprocessed_fibers_sample_matches_polydata_chain(make_polydata):
+    pd = make_polydata(number_of_lines=200)
+    register = congeal_to_atlas.SubjectToAtlasRegistration()
+    register.fiber_length = 20
+    register.points_per_fiber = 10
+    register.set_atlas(pd, "atlas")
+
+    cached = register._preprocessed_fibers('atlas', register.atlas_polydata)
+    assert register._preprocessed_fibers('atlas', register.atlas_polydata) is cached
+
+    for seed in (1001, 1002):
+        line_indices = filter.sample_line_indices(cached.shape[1], 50, random_seed=seed)
+
+        # filtering, downsampling and resampling the polydata as before
+        expected_pd = filter.preprocess(pd, register.fiber_length, max_length_mm=register.fiber_length_max, verbose=False)
+        expected_pd = filter.downsample(expected_pd, 50, verbose=False, random_seed=seed)
+        expected = fibers.FiberArray()
+        expected.convert_from_polydata(expected_pd, register.points_per_fiber, use_cache=False)
+
+        np.testing.assert_array_equal(cached[0][line_indices], expected.fiber_array_r)
+        np.testing.assert_array_equal(cached[2][line_indices], expected.fiber_array_s)
+
+    # changing the parameters recomputes the fibers
+    register.points_per_fiber = 5
+    assert register._preprocessed_fibers('atlas', register.atlas_polydata).shape == (3, cached.shape[1], 5)
+
+
+def test_register_subjects_to_atlas_batch(make_polydata, tmp_path):
+    atlas = make_polydata(number_of_lines=60)
+    subject_filenames = []
+    for subject in ("subject_a", "subject_b"):
+        filename = str(tmp_path / f"{subject}.vtp")
+        io.write_polydata(make_polydata(number_of_lines=60), filename)
+        subject_filenames.append(filename)
+    output_directory = tmp_path / "output"
+    output_directory.mkdir()
+
+    schedule = {'sigma': [20], 'iterations': [1], 'maxfun': [20],
+                'mean_brain_size': [30], 'subject_brain_size': [30],
+                'initial_step': [5], 'final_step': [2]}
+    settings = {'fiber_length': 20, 'points_per_fiber': 5}
+    failures = congeal_to_atlas.register_subjects_to_atlas(
+        subject_filenames + [str(tmp_path / "missing.vtp")], atlas, "atlas",
+        str(output_directory), schedule, settings, parallel_jobs=2)
+
+    # the missing subject fails without stopping the batch
+    assert [filename for (filename, error) in failures] == [str(tmp_path / "missing.vtp")]
+    for subject in ("subject_a", "subject_b"):
+        progress = (output_directory / subject / "progress.txt").read_text()
+        assert "Finished registration." in progress
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from whitematteranalysis import fibers, io
+
+
+def _convert_with_loop(pd, points_per_fiber):
+    """Resample lines one point at a time, as FiberArray did before it
+    was vectorized."""
+
+    fiber_array = fibers.FiberArray()
+    arrays = io.TractographyArrays.from_polydata(pd)
+    resampled = np.zeros((arrays.number_of_lines, points_per_fiber, 3))
+    for lidx in range(arrays.number_of_lines):
+        line = arrays.get_line(lidx)
+        for pidx, line_index in enumerate(fiber_array._calculate_line_indices(len(line), points_per_fiber)):
+            resampled[lidx, pidx] = line[int(round(line_index))]
+    return resampled
+
+
+def test_convert_from_polydata_matches_loop(make_polydata):
+    pd = make_polydata()
+    for points_per_fiber in (3, 10, 15, 50):
+        expected = _convert_with_loop(pd, points_per_fiber)
+        fiber_array = fibers.FiberArray()
+        fiber_array.convert_from_polydata(pd, points_per_fiber=points_per_fiber)
+        np.testing.assert_array_equal(fiber_array.fiber_array_r, expected[:, :, 0])
+        np.testing.assert_array_equal(fiber_array.fiber_array_a, expected[:, :, 1])
+        np.testing.assert_array_equal(fiber_array.fiber_array_s, expected[:, :, 2])
+
+
+def test_convert_from_chunks(make_polydata):
+    pd = make_polydata()
+    fiber_array = fibers.FiberArray()
+    fiber_array.convert_from_polydata(pd, points_per_fiber=15)
+
+    arrays = io.TractographyArrays.from_polydata(pd)
+    chunks = [io.TractographyArrays(arrays.points, arrays.offsets[start:start + 8])
+              for start in range(0, arrays.number_of_lines, 7)]
+    chunk_fiber_array = fibers.FiberArray()
+    chunk_fiber_array.convert_from_chunks(chunks, points_per_fiber=15)
+
+    assert chunk_fiber_array.number_of_fibers == fiber_array.number_of_fibers
+    np.testing.assert_array_equal(chunk_fiber_array.fiber_array_r, fiber_array.fiber_array_r)
+    np.testing.assert_array_equal(chunk_fiber_array.fiber_array_s, fiber_array.fiber_array_s)
+    np.testing.assert_array_equal(chunk_fiber_array.fiber_hemisphere, fiber_array.fiber_hemisphere)
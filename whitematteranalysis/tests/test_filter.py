@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from whitematteranalysis import filter, io
+
+
+def _lines(pd):
+    points, offsets, connectivity = filter._get_line_arrays(pd)
+    return [points[connectivity[offsets[i]:offsets[i + 1]]] for i in range(len(offsets) - 1)]
+
+
+def test_compute_lengths(make_polydata):
+    pd = make_polydata()
+    lengths, step_size = filter.compute_lengths(pd)
+    np.testing.assert_allclose(step_size, 2.0, rtol=1e-5)
+    assert len(lengths) == pd.GetNumberOfLines()
+
+
+def test_preprocess_and_downsample_matches_chain(make_polydata):
+    pd = make_polydata()
+    pd2 = filter.preprocess(pd, 20, max_length_mm=60, remove_u=True, remove_u_endpoint_dist=30,
+                            preserve_point_data=True, preserve_cell_data=True, verbose=False)
+    pd3 = filter.downsample(pd2, 10, preserve_point_data=True, preserve_cell_data=True,
+                            verbose=False, random_seed=5)
+    out = filter.preprocess_and_downsample(pd, 20, 10, max_length_mm=60, remove_u=True,
+                                           remove_u_endpoint_dist=30,
+                                           preserve_point_data=True, preserve_cell_data=True,
+                                           verbose=False, random_seed=5)
+
+    assert out.GetNumberOfLines() == pd3.GetNumberOfLines() == 10
+    for line_a, line_b in zip(_lines(out), _lines(pd3)):
+        np.testing.assert_allclose(line_a, line_b)
+    for name in ("FA", "tensors"):
+        np.testing.assert_allclose(
+            numpy_support.vtk_to_numpy(out.GetPointData().GetArray(name)),
+            numpy_support.vtk_to_numpy(pd3.GetPointData().GetArray(name)))
+    np.testing.assert_array_equal(
+        numpy_support.vtk_to_numpy(out.GetCellData().GetArray("Label")),
+        numpy_support.vtk_to_numpy(pd3.GetCellData().GetArray("Label")))
+
+
+def test_preprocess_and_downsample_no_filtering(make_polydata):
+    pd = make_polydata()
+    out, indices = filter.preprocess_and_downsample(pd, return_indices=True, verbose=False)
+    np.testing.assert_array_equal(indices, np.arange(pd.GetNumberOfLines()))
+    assert out.GetNumberOfPoints() == pd.GetNumberOfPoints()
+
+
+def test_downsample_seeded_and_global_state_untouched(make_polydata):
+    pd = make_polydata()
+    state = np.random.get_state()
+    idx1 = filter.downsample(pd, 10, verbose=False, random_seed=3, indices_only=True)
+    idx2 = filter.downsample(pd, 10, verbose=False, random_seed=3, indices_only=True)
+    assert np.array_equal(np.random.get_state()[1], state[1])
+    np.testing.assert_array_equal(idx1, idx2)
+    assert len(np.unique(idx1)) == 10
+    assert np.all(np.diff(idx1) > 0)
+
+    out, idx3 = filter.downsample(pd, 10, return_indices=True, verbose=False, random_seed=3)
+    np.testing.assert_array_equal(idx1, idx3)
+    assert out.GetNumberOfLines() == 10
+
+
+def test_random_generator_subject_streams():
+    a = filter.random_generator(7, 0).integers(0, 1000000, 5)
+    b = filter.random_generator(7, 1).integers(0, 1000000, 5)
+    c = filter.random_generator(7, 0).integers(0, 1000000, 5)
+    np.testing.assert_array_equal(a, c)
+    assert not np.array_equal(a, b)
+
+
+def test_add_point_data_array(make_polydata):
+    pd = make_polydata(20)
+    values = np.arange(pd.GetNumberOfLines()) * 1.5
+    filter.add_point_data_array(pd, values, "LineValue")
+    array = pd.GetPointData().GetArray("LineValue")
+    assert array.GetDataType() == vtk.VTK_FLOAT
+    assert array.GetNumberOfTuples() == pd.GetNumberOfPoints()
+    point_values = numpy_support.vtk_to_numpy(array)
+    points, offsets, connectivity = filter._get_line_arrays(pd)
+    for lidx in range(pd.GetNumberOfLines()):
+        ptids = connectivity[offsets[lidx]:offsets[lidx + 1]]
+        np.testing.assert_allclose(point_values[ptids], values[lidx])
+
+
+def test_line_to_point_data_unordered_points(make_polydata):
+    pd = make_polydata(5)
+    # reverse the points of every line so connectivity is not sequential
+    points, offsets, connectivity = filter._get_line_arrays(pd)
+    reversed_connectivity = np.concatenate(
+        [connectivity[offsets[i]:offsets[i + 1]][::-1] for i in range(len(offsets) - 1)])
+    lines = vtk.vtkCellArray()
+    lines.SetData(numpy_support.numpy_to_vtk(offsets.copy(), deep=True, array_type=vtk.VTK_ID_TYPE),
+                  numpy_support.numpy_to_vtk(reversed_connectivity, deep=True, array_type=vtk.VTK_ID_TYPE))
+    pd.SetLines(lines)
+    per_point = filter.line_to_point_data(pd, np.arange(5))
+    for lidx in range(5):
+        np.testing.assert_array_equal(per_point[connectivity[offsets[lidx]:offsets[lidx + 1]]], lidx)
+
+
+def test_symmetrize(make_polydata):
+    pd = make_polydata(10)
+    out = filter.symmetrize(pd)
+    assert out.GetNumberOfLines() == 2 * pd.GetNumberOfLines()
+    lines_in = _lines(pd)
+    lines_out = _lines(out)
+    reflect = np.array([-1, 1, 1])
+    for lidx, line in enumerate(lines_in):
+        np.testing.assert_allclose(lines_out[2 * lidx], line)
+        np.testing.assert_allclose(lines_out[2 * lidx + 1], line * reflect)
+    colors = numpy_support.vtk_to_numpy(out.GetCellData().GetScalars())
+    np.testing.assert_array_equal(colors[:4], [1, -1, 1, -1])
+
+
+def test_remove_hemisphere_splits_lines():
+    points = vtk.vtkPoints()
+    for r in [-3, -2, 1, 2, 3, -1, 4, 5]:
+        points.InsertNextPoint(r, 0, 0)
+    lines = vtk.vtkCellArray()
+    ptids = vtk.vtkIdList()
+    for idx in range(8):
+        ptids.InsertNextId(idx)
+    lines.InsertNextCell(ptids)
+    pd = vtk.vtkPolyData()
+    pd.SetPoints(points)
+    pd.SetLines(lines)
+
+    # remove left hemisphere
+    out = filter.remove_hemisphere(pd, hemisphere=-1)
+    pieces = _lines(out)
+    assert len(pieces) == 2
+    np.testing.assert_array_equal(pieces[0][:, 0], [1, 2, 3])
+    np.testing.assert_array_equal(pieces[1][:, 0], [4, 5])
+
+    # remove right hemisphere
+    out = filter.remove_hemisphere(pd, hemisphere=1)
+    pieces = _lines(out)
+    assert len(pieces) == 1
+    np.testing.assert_array_equal(pieces[0][:, 0], [-3, -2])
+
+
+def test_chunks_match_polydata_functions(make_polydata, tmp_path):
+    pd = make_polydata(number_of_lines=100)
+    chunks = list(io.iter_tractography_chunks(pd, chunk_size=9))
+    assert sum(chunk.number_of_lines for chunk in chunks) == 100
+
+    lengths, step_size = filter.compute_lengths(pd)
+    chunk_lengths, chunk_step_size = filter.compute_lengths_chunks(chunks)
+    np.testing.assert_allclose(chunk_lengths, lengths)
+    assert chunk_step_size == step_size
+
+    outpd = filter.preprocess(pd, 20, remove_u=True, remove_u_endpoint_dist=10, preserve_point_data=True, preserve_cell_data=True, verbose=False)
+    result = filter.preprocess_chunks(chunks, 20, remove_u=True, remove_u_endpoint_dist=10, preserve_point_data=True, preserve_cell_data=True, verbose=False)
+    fname = str(tmp_path / "preprocessed.wmt")
+    io.write_tract_cache_chunks(result, fname)
+    expected = io.TractographyArrays.from_polydata(outpd)
+    result = io.read_tract_cache(fname)
+    np.testing.assert_array_equal(result.offsets, expected.offsets)
+    np.testing.assert_array_equal(result.points, expected.points)
+    np.testing.assert_array_equal(result.point_data["tensors"], expected.point_data["tensors"])
+    np.testing.assert_array_equal(result.cell_data["Label"], expected.cell_data["Label"])
+
+
+def test_downsample_chunks(make_polydata):
+    pd = make_polydata(number_of_lines=100)
+    arrays = io.TractographyArrays.from_polydata(pd)
+
+    sample, line_indices = filter.downsample_chunks(arrays.iter_chunks(7), 30, return_indices=True, verbose=False)
+    assert sample.number_of_lines == 30
+    assert np.all(np.diff(line_indices) > 0)
+    np.testing.assert_array_equal(sample.cell_data["Label"], arrays.cell_data["Label"][line_indices])
+    np.testing.assert_array_equal(sample.points, arrays.select_lines(line_indices).points)
+
+    # the sample depends on the seed, not on the chunk size
+    sample2, line_indices2 = filter.downsample_chunks(arrays.iter_chunks(50), 30, return_indices=True, verbose=False)
+    np.testing.assert_array_equal(line_indices2, line_indices)
+
+    # every line is equally likely to be sampled
+    counts = np.zeros(100)
+    for seed in range(200):
+        counts[filter.downsample_chunks(arrays.iter_chunks(7), 10, return_indices=True, verbose=False, random_seed=seed)[1]] += 1
+    assert counts.min() > 0
+    assert abs(counts[:50].sum() - counts[50:].sum()) < 0.2 * counts.sum()
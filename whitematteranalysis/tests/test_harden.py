@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import nibabel
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from whitematteranalysis import harden, io
+
+
+def _vtk_affine():
+    transform = vtk.vtkTransform()
+    transform.RotateZ(20)
+    transform.RotateX(-10)
+    transform.Scale(1.1, 0.9, 1.0)
+    transform.Translate(5, -3, 2)
+    return transform
+
+
+def _points(polydata):
+    return numpy_support.vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float64)
+
+
+def test_affine_tfm_matches_registration_transform(tmp_path, make_polydata):
+
+    transform = _vtk_affine()
+    tfm = io.write_transforms_to_itk_format([transform], str(tmp_path))[0]
+    transforms = harden.read_itk_transform(tfm)
+    points = _points(make_polydata())
+
+    expected = np.array([transform.TransformPoint(p) for p in points])
+    np.testing.assert_allclose(harden.transform_points(points, transforms), expected, atol=1e-6)
+    np.testing.assert_allclose(harden.transform_points(expected, transforms, inverse=True), points, atol=1e-6)
+
+
+def test_affine_center_fixed_parameters():
+
+    transform = harden.AffineTransform.from_parameters([0, -1, 0, 1, 0, 0, 0, 0, 1, 1, 2, 3], [10, 0, 0])
+    np.testing.assert_allclose(transform.transform_points(np.array([[10.0, 0, 0], [11.0, 0, 0]])),
+                               [[11, 2, 3], [11, 3, 3]])
+
+
+def test_bspline_matches_vtk(tmp_path):
+
+    rng = np.random.default_rng(0)
+    size = (6, 7, 8)
+    coefficients = rng.normal(0, 2, size + (3,))
+    with open(tmp_path / "bspline.tfm", "w") as f:
+        f.write("#Insight Transform File V1.0\n#Transform 0\nTransform: BSplineTransform_double_3_3\n")
+        f.write("Parameters: " + " ".join(str(v) for v in coefficients.transpose(3, 2, 1, 0).ravel()) + "\n")
+        f.write("FixedParameters: 6 7 8 -50 -60 -70 20 20 20 1 0 0 0 1 0 0 0 1\n")
+    transform = harden.read_itk_transform(str(tmp_path / "bspline.tfm"))[0]
+
+    image = vtk.vtkImageData()
+    image.SetDimensions(*size)
+    image.SetOrigin(-50, -60, -70)
+    image.SetSpacing(20, 20, 20)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(coefficients.transpose(2, 1, 0, 3).reshape(-1, 3), deep=True))
+    vtk_transform = vtk.vtkBSplineTransform()
+    vtk_transform.SetCoefficientData(image)
+
+    # inside the valid region of the grid
+    points = rng.uniform([-30, -40, -50], [10, 20, 30], (200, 3))
+    expected = np.array([vtk_transform.TransformPoint(p) for p in points])
+    np.testing.assert_allclose(transform.transform_points(points), expected, atol=1e-6)
+
+    # not displaced outside
+    np.testing.assert_array_equal(transform.transform_points(np.array([[500.0, 0, 0]])), [[500, 0, 0]])
+
+    # inverted inside, for a smooth invertible deformation
+    transform.coefficients *= 0.25
+    np.testing.assert_allclose(transform.inverse_transform_points(transform.transform_points(points)), points, atol=1e-3)
+
+
+def test_displacement_field_nifti(tmp_path):
+
+    field = np.zeros((5, 5, 5, 1, 3))
+    field[..., 0, 0] = 2.0
+    field[..., 0, 2] = np.arange(5)[np.newaxis, np.newaxis, :]
+    affine = np.diag([-10.0, -10.0, 10.0, 1.0])
+    affine[0:3, 3] = [20, 20, -20]
+    nibabel.save(nibabel.Nifti1Image(field, affine), str(tmp_path / "warp.nii.gz"))
+
+    transforms = harden.read_itk_transform(str(tmp_path / "warp.nii.gz"))
+    # RAS (0, 0, 5) is LPS (0, 0, 5), voxel (2, 2, 2.5)
+    np.testing.assert_allclose(harden.transform_points(np.array([[0.0, 0, 5]]), transforms, inverse=True),
+                               [[-2, 0, 7.5]])
+
+
+def test_harden_reorients_tensors(make_polydata):
+
+    inpd = make_polydata()
+    inpd.GetPointData().SetActiveTensors("tensors")
+    transforms = [harden.AffineTransform(np.array([[0, -1, 0, 0], [1, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1.0]]))]
+    outpd = harden.harden_transform_polydata(inpd, transforms, inverse=True)
+
+    rotation = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 1.0]])
+    tensors = numpy_support.vtk_to_numpy(inpd.GetPointData().GetArray("tensors")).reshape(-1, 3, 3)
+    out_tensors = numpy_support.vtk_to_numpy(outpd.GetPointData().GetArray("tensors")).reshape(-1, 3, 3)
+    np.testing.assert_allclose(out_tensors, rotation @ tensors @ rotation.T, rtol=1e-4, atol=1e-6)
+    assert outpd.GetPointData().GetTensors().GetName() == "tensors"
+    np.testing.assert_allclose(_points(outpd), _points(inpd) @ np.diag([-1, -1, 1]) @ rotation.T @ np.diag([-1, -1, 1]), atol=1e-4)
+    # input untouched
+    np.testing.assert_array_equal(numpy_support.vtk_to_numpy(inpd.GetPointData().GetArray("tensors")).reshape(-1, 3, 3), tensors)
+
+
+def test_harden_transform_directory(tmp_path, make_polydata):
+
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    for idx in range(3):
+        io.write_polydata(make_polydata(seed=idx), str(input_dir / f"cluster_{idx:05d}.vtp"))
+    transform = _vtk_affine()
+    tfm = io.write_transforms_to_itk_format([transform], str(tmp_path))[0]
+
+    input_polydatas = io.list_vtk_files(str(input_dir))
+    failures = harden.harden_transform_directory(input_polydatas, tfm, str(output_dir), inverse=True, parallel_jobs=2)
+
+    assert failures == []
+    assert sorted(os.listdir(output_dir)) == [os.path.basename(f) for f in input_polydatas]
+    for fname in input_polydatas:
+        points = _points(io.read_polydata(fname))
+        out_points = _points(io.read_polydata(str(output_dir / os.path.basename(fname))))
+        expected = np.array([transform.GetInverse().TransformPoint(p) for p in points])
+        np.testing.assert_allclose(out_points, expected, atol=1e-3)
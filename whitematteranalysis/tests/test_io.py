@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from whitematteranalysis import filter, io
+
+
+def _assert_same_tractography(pd1, pd2, point_data_names=(), cell_data_names=()):
+    assert pd1.GetNumberOfLines() == pd2.GetNumberOfLines()
+    arrays1 = io.TractographyArrays.from_polydata(pd1)
+    arrays2 = io.TractographyArrays.from_polydata(pd2)
+    np.testing.assert_array_equal(arrays1.offsets, arrays2.offsets)
+    np.testing.assert_allclose(arrays1.points, arrays2.points, rtol=1e-6)
+    for name in point_data_names:
+        np.testing.assert_allclose(arrays1.point_data[name], arrays2.point_data[name], rtol=1e-6)
+    for name in cell_data_names:
+        np.testing.assert_array_equal(arrays1.cell_data[name], arrays2.cell_data[name])
+
+
+def test_tract_cache_round_trip(make_polydata, tmp_path):
+    pd = make_polydata()
+    pd.GetPointData().SetTensors(pd.GetPointData().GetArray("tensors"))
+    fname = os.path.join(tmp_path, "subject.wmt")
+    io.write_polydata(pd, fname)
+    assert fname in io.list_tract_cache_files(str(tmp_path))
+
+    arrays = io.read_tract_cache(fname)
+    assert isinstance(arrays.points, np.memmap)
+    assert arrays.number_of_lines == pd.GetNumberOfLines()
+
+    pd2 = io.read_polydata(fname)
+    _assert_same_tractography(pd, pd2, ("FA", "tensors"), ("Label",))
+    assert pd2.GetPointData().GetTensors().GetName() == "tensors"
+
+    # the wrapped polydata works with the regular filters
+    out = filter.downsample(pd2, 5, preserve_point_data=True, verbose=False)
+    assert out.GetNumberOfLines() == 5
+
+
+def test_tract_cache_overwrite(make_polydata, tmp_path):
+    fname = os.path.join(tmp_path, "subject.wmt")
+    io.write_tract_cache(make_polydata(10), fname)
+    io.write_tract_cache(make_polydata(20), fname)
+    assert io.read_tract_cache(fname).number_of_lines == 20
+    assert os.listdir(tmp_path) == ["subject.wmt"]
+
+
+def test_read_and_preprocess_polydata_directory_parallel(make_polydata, tmp_path):
+    for sidx in range(4):
+        io.write_polydata(make_polydata(50, seed=sidx), os.path.join(tmp_path, f"subject{sidx}.vtp"))
+
+    pds_serial, ids_serial = io.read_and_preprocess_polydata_directory(
+        str(tmp_path), 10, 20, random_seed=11)
+    pds_parallel, ids_parallel = io.read_and_preprocess_polydata_directory(
+        str(tmp_path), 10, 20, random_seed=11, parallel_jobs=2, max_in_flight=1)
+    assert ids_serial == ids_parallel == [f"subject{sidx}" for sidx in range(4)]
+    for pd_serial, pd_parallel in zip(pds_serial, pds_parallel):
+        assert pd_serial.GetNumberOfLines() == 20
+        _assert_same_tractography(pd_serial, pd_parallel)
+
+    subject_ids = [subject_id for subject_id, pd in io.iter_read_and_preprocess_polydata_directory(
+        str(tmp_path), 10, 20, random_seed=11, parallel_jobs=2)]
+    assert subject_ids == ids_serial
+
+
+def _transforms_for_test():
+
+    affine = vtk.vtkTransform()
+    affine.RotateZ(10)
+    affine.Translate(1, 2, 3)
+
+    rng = np.random.default_rng(0)
+    source = vtk.vtkPoints()
+    target = vtk.vtkPoints()
+    for point in rng.uniform(-50, 50, (8, 3)):
+        source.InsertNextPoint(point)
+        target.InsertNextPoint(point + rng.normal(0, 2, 3))
+    tps = vtk.vtkThinPlateSplineTransform()
+    tps.SetSourceLandmarks(source)
+    tps.SetTargetLandmarks(target)
+    tps.SetBasisToR()
+
+    image = vtk.vtkImageData()
+    image.SetDimensions(5, 5, 5)
+    image.SetOrigin(-100, -100, -100)
+    image.SetSpacing(50, 50, 50)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(rng.normal(0, 2, (125, 3)), deep=True))
+    bspline = vtk.vtkBSplineTransform()
+    bspline.SetCoefficientData(image)
+    bspline.SetBorderModeToZero()
+    bspline.Inverse()
+
+    return [affine, tps, bspline]
+
+
+def test_serialize_transform_round_trip():
+
+    points = np.random.default_rng(1).uniform(-60, 60, (20, 3))
+    for transform in _transforms_for_test():
+        restored = io.deserialize_transform(io.serialize_transform(transform))
+        for point in points:
+            np.testing.assert_allclose(restored.TransformPoint(point), transform.TransformPoint(point), atol=1e-6)
+
+
+def test_transform_polydatas_from_disk_parallel(tmp_path, make_polydata):
+
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    transforms = _transforms_for_test()
+    for idx in range(len(transforms)):
+        io.write_polydata(make_polydata(seed=idx), str(input_dir / f"subject{idx}.vtp"))
+
+    failures = io.transform_polydatas_from_disk(str(input_dir), transforms, str(output_dir), parallel_jobs=2)
+
+    assert failures == []
+    assert sorted(os.listdir(output_dir)) == [f"subject{idx}_reg.vtk" for idx in range(len(transforms))]
+    for idx, transform in enumerate(transforms):
+        pd = io.read_polydata(str(output_dir / f"subject{idx}_reg.vtk"))
+        expected = np.array([transform.TransformPoint(p) for p in numpy_support.vtk_to_numpy(make_polydata(seed=idx).GetPoints().GetData())])
+        np.testing.assert_allclose(numpy_support.vtk_to_numpy(pd.GetPoints().GetData()), expected, atol=1e-3)
+
+
+def test_write_profiles_round_trip(tmp_path, make_polydata):
+
+    pd = make_polydata()
+    for profile in [None] + list(io.WRITE_PROFILES):
+        fname = str(tmp_path / f"{profile}.vtp")
+        io.write_polydata(pd, fname, profile=profile)
+        _assert_same_tractography(pd, io.read_polydata(fname), point_data_names=["FA"], cell_data_names=["Label"])
+
+    fname = str(tmp_path / "none.vtp")
+    io.write_polydata(pd, fname, compressor="none", block_size=4096)
+    _assert_same_tractography(pd, io.read_polydata(fname), point_data_names=["FA"])
+
+
+def test_write_polydata_float32(tmp_path, make_polydata):
+
+    pd = make_polydata()
+    points = vtk.vtkPoints()
+    points.SetDataTypeToDouble()
+    points.DeepCopy(pd.GetPoints())
+    pd.SetPoints(points)
+    array = vtk.vtkDoubleArray()
+    array.DeepCopy(pd.GetPointData().GetArray("FA"))
+    pd.GetPointData().AddArray(array)
+
+    for extension in ["vtk", "vtp"]:
+        fname = str(tmp_path / f"float32.{extension}")
+        io.write_polydata(pd, fname, profile="fast", float32=True)
+        pd2 = io.read_polydata(fname)
+        assert pd2.GetPoints().GetDataType() == vtk.VTK_FLOAT
+        assert pd2.GetPointData().GetArray("FA").GetDataType() == vtk.VTK_FLOAT
+        assert pd2.GetCellData().GetArray("Label").GetDataType() == pd.GetCellData().GetArray("Label").GetDataType()
+        _assert_same_tractography(pd, pd2, point_data_names=["FA"], cell_data_names=["Label"])
+    # input untouched
+    assert pd.GetPoints().GetDataType() == vtk.VTK_DOUBLE
+
+
+def _laterality_results(make_polydata):
+
+    rng = np.random.default_rng(0)
+    results = io.LateralityResults()
+    results.polydata = make_polydata()
+    results.laterality_index = rng.uniform(-1, 1, 60)
+    results.left_hem_similarity = rng.uniform(0, 1, 60)
+    results.right_hem_similarity = rng.uniform(0, 1, 60)
+    results.hemisphere = rng.integers(-1, 2, 60)
+    results.sigma = 5.0
+    results.points_per_fiber = 5
+    results.threshold = 0.0
+    return results
+
+
+def test_laterality_results_round_trip(tmp_path, make_polydata):
+
+    results = _laterality_results(make_polydata)
+    results.write(str(tmp_path / "subject"))
+
+    results2 = io.LateralityResults()
+    results2.read(str(tmp_path / "subject"), readpd=True)
+    for name in io.LATERALITY_ARRAYS:
+        np.testing.assert_array_equal(getattr(results2, name), getattr(results, name))
+    assert (results2.sigma, results2.points_per_fiber, results2.threshold) == (5.0, 5, 0.0)
+    assert results2.polydata.GetNumberOfLines() == 60
+    np.testing.assert_allclose(np.loadtxt(str(tmp_path / "subject" / "laterality_index_values.txt")), results.laterality_index)
+
+    results3 = io.LateralityResults()
+    results3.read(str(tmp_path / "subject"), lazy=True)
+    np.testing.assert_array_equal(results3.laterality_index, results.laterality_index)
+    np.testing.assert_array_equal(results3.hemisphere, results.hemisphere)
+    assert results3.left_hem_similarity is None and results3.polydata is None
+
+
+def test_laterality_results_read_pickles(tmp_path, make_polydata):
+
+    results = _laterality_results(make_polydata)
+    for name in io.LATERALITY_ARRAYS:
+        with open(tmp_path / f"pickle_{name}.txt", "wb") as fid:
+            pickle.dump(getattr(results, name), fid)
+
+    results2 = io.LateralityResults()
+    results2.read(str(tmp_path))
+    for name in io.LATERALITY_ARRAYS:
+        np.testing.assert_array_equal(getattr(results2, name), getattr(results, name))
+
+
+def _write_streamline_files(tmp_path, make_polydata):
+    import nibabel as nib
+
+    arrays = io.TractographyArrays.from_polydata(make_polydata())
+    streamlines = [arrays.get_line(idx) for idx in range(arrays.number_of_lines)]
+    fa = [arrays.point_data["FA"][arrays.offsets[idx]:arrays.offsets[idx + 1], np.newaxis]
+          for idx in range(arrays.number_of_lines)]
+    label = [arrays.cell_data["Label"][idx:idx + 1].astype(np.float32) for idx in range(arrays.number_of_lines)]
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[0:3, 3] = [-90, -126, -72]
+    tractogram = nib.streamlines.Tractogram(
+        streamlines, data_per_point={"FA": fa}, data_per_streamline={"Label": label}, affine_to_rasmm=np.eye(4))
+    tck_fname = str(tmp_path / "tracts.tck")
+    trk_fname = str(tmp_path / "tracts.trk")
+    nib.streamlines.save(nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4)), tck_fname)
+    header = {nib.streamlines.Field.VOXEL_TO_RASMM: affine,
+              nib.streamlines.Field.VOXEL_SIZES: np.array([2.0, 2.0, 2.0]),
+              nib.streamlines.Field.DIMENSIONS: np.array([90, 126, 72])}
+    nib.streamlines.save(tractogram, trk_fname, header=header)
+    return arrays, tck_fname, trk_fname
+
+
+def test_read_tck_and_trk(tmp_path, make_polydata):
+    arrays, tck_fname, trk_fname = _write_streamline_files(tmp_path, make_polydata)
+
+    for fname in (tck_fname, trk_fname):
+        chunks = list(io.iter_streamline_file_chunks(fname, chunk_size=7))
+        assert [chunk.number_of_lines for chunk in chunks[:-1]] == [7] * (len(chunks) - 1)
+        result = io.concatenate_tractography_arrays(chunks)
+        np.testing.assert_array_equal(result.offsets, arrays.offsets)
+        np.testing.assert_allclose(result.points, arrays.points, atol=1e-4)
+
+    trk_arrays = io.read_streamline_file(trk_fname)
+    np.testing.assert_allclose(trk_arrays.point_data["FA"], arrays.point_data["FA"], rtol=1e-6)
+    np.testing.assert_array_equal(trk_arrays.cell_data["Label"], arrays.cell_data["Label"])
+
+    pd = io.read_polydata(tck_fname)
+    assert pd.GetNumberOfLines() == arrays.number_of_lines
+
+
+def test_read_tck_small_blocks(tmp_path, make_polydata):
+    arrays, tck_fname, trk_fname = _write_streamline_files(tmp_path, make_polydata)
+
+    # lines span several scanned blocks
+    result = io.concatenate_tractography_arrays(list(io.iter_tck_chunks(tck_fname, chunk_size=1000, block_size=5)))
+    np.testing.assert_array_equal(result.offsets, arrays.offsets)
+    np.testing.assert_allclose(result.points, arrays.points, atol=1e-4)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from whitematteranalysis import laterality, similarity
+
+
+def _per_fiber_totals(fibers, threshold, sigmasq):
+    """Hemisphere similarity totals, one fiber at a time as before."""
+
+    right_total = np.zeros(fibers.number_of_fibers)
+    left_total = np.zeros(fibers.number_of_fibers)
+    fiber_array_right = fibers.get_fibers(fibers.index_right_hem)
+    fiber_array_left = fibers.get_fibers(fibers.index_left_hem)
+    for lidx in fibers.index_hem:
+        right_total[lidx] = similarity.total_similarity_for_laterality(
+            fibers.get_fiber(lidx), fiber_array_right, fibers.is_left_hem[lidx], threshold, sigmasq)
+        left_total[lidx] = similarity.total_similarity_for_laterality(
+            fibers.get_fiber(lidx), fiber_array_left, fibers.is_right_hem[lidx], threshold, sigmasq)
+    return right_total, left_total
+
+
+@pytest.mark.parametrize("parallel_jobs", [0, 2])
+@pytest.mark.parametrize("threshold", [0.0, 5.0])
+def test_blocked_laterality_matches_per_fiber_similarity(make_polydata, parallel_jobs, threshold):
+    lat = laterality.WhiteMatterLaterality()
+    lat.sigma = 30.0
+    lat.threshold = threshold
+    lat.parallel_jobs = parallel_jobs
+    lat.block_size = 16
+    lat.verbose = False
+    results = lat.compute(make_polydata(number_of_lines=150))
+
+    assert lat.fibers.number_left_hem == lat.fibers.number_right_hem > lat.block_size
+    assert results.polydata.GetNumberOfLines() == lat.fibers.number_of_fibers
+
+    right_total, left_total = _per_fiber_totals(lat.fibers, threshold, lat.sigma * lat.sigma)
+    np.testing.assert_allclose(results.right_hem_similarity, right_total, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(results.left_hem_similarity, left_total, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(
+        results.laterality_index[lat.fibers.index_hem],
+        laterality.compute_laterality_index(left_total, right_total, lat.fibers.index_hem)[lat.fibers.index_hem])
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from whitematteranalysis import register_two_subjects
+
+
+def _fiber_arrays(number_of_fibers, seed, points_per_fiber=10):
+    rng = np.random.default_rng(seed)
+    start = rng.uniform(-60, 60, (3, number_of_fibers, 1))
+    direction = rng.normal(size=(3, number_of_fibers, 1))
+    return start + direction * np.arange(points_per_fiber) * 3.0
+
+
+def _objective_with_loop(fixed, moving, sigmasq):
+    """inner_loop_objective as one total_probability_numpy call per
+    moving fiber."""
+
+    probability = np.zeros(moving.shape[1]) + 1e-20
+    for idx in range(moving.shape[1]):
+        probability[idx] += register_two_subjects.total_probability_numpy(moving[:, idx, :], fixed, sigmasq)
+    probability /= fixed.shape[1]
+    return np.sum(-np.log(probability))
+
+
+def test_inner_loop_objective_matches_loop():
+    fixed = _fiber_arrays(300, 0)
+    moving = _fiber_arrays(80, 1)
+    # include exact and reversed copies of fixed fibers
+    moving[:, :5, :] = fixed[:, :5, :]
+    moving[:, 5:10, :] = fixed[:, 5:10, ::-1]
+
+    for sigma in (5, 10, 20):
+        expected = _objective_with_loop(fixed, moving, sigma * sigma)
+        for block_pairs in (1, 1000, register_two_subjects.OBJECTIVE_BLOCK_PAIRS):
+            obj = register_two_subjects.inner_loop_objective(fixed, moving, sigma * sigma, block_pairs=block_pairs)
+            np.testing.assert_allclose(obj, expected, rtol=1e-9)
+
+
+def test_inner_loop_objective_far_fibers():
+    fixed = _fiber_arrays(20, 0)
+    # all probabilities underflow, leaving the 1e-20 floor
+    moving = _fiber_arrays(10, 1) + 1e4
+    obj = register_two_subjects.inner_loop_objective(fixed, moving, 25.0)
+    np.testing.assert_allclose(obj, _objective_with_loop(fixed, moving, 25.0))
+
+
+def _random_transform(seed):
+    rng = np.random.default_rng(seed)
+    transform = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0, 0], dtype=float)
+    transform += np.concatenate((rng.normal(0, 5, 3), rng.normal(0, 10, 3), rng.normal(0, 0.05, 3), rng.normal(0, 5, 6)))
+    return transform * register_two_subjects.TRANSFORM_SCALING
+
+
+def test_affine_transform_matrix_matches_vtk():
+    for mode in ([1, 1, 1, 1], [1, 1, 0, 0], [0, 1, 1, 0]):
+        transform = _random_transform(3)
+        vtktrans = register_two_subjects.convert_transform_to_vtk(transform, scaled=True, mode=mode)
+        vtk_matrix = np.array([[vtktrans.GetMatrix().GetElement(i, j) for j in range(4)] for i in range(4)])
+        matrix, translation = register_two_subjects.affine_transform_matrix(transform, mode=mode)
+        np.testing.assert_allclose(matrix, vtk_matrix[0:3, 0:3], atol=1e-12)
+        np.testing.assert_allclose(translation, vtk_matrix[0:3, 3], atol=1e-12)
+
+        fibers = _fiber_arrays(5, 0)
+        point = vtktrans.TransformPoint(fibers[:, 2, 3])
+        np.testing.assert_allclose(register_two_subjects.transform_fiber_array_numpy(fibers, transform, mode)[:, 2, 3], point)
+
+
+def test_affine_transform_matrix_derivatives():
+    transform = _random_transform(4)
+    matrix, translation, matrix_derivatives, translation_derivatives = \
+        register_two_subjects.affine_transform_matrix(transform, derivatives=True)
+    for index in range(15):
+        step = np.zeros(15)
+        step[index] = 1e-4
+        matrix_plus, translation_plus = register_two_subjects.affine_transform_matrix(transform + step)
+        matrix_minus, translation_minus = register_two_subjects.affine_transform_matrix(transform - step)
+        np.testing.assert_allclose(matrix_derivatives[index], (matrix_plus - matrix_minus) / 2e-4, atol=1e-7)
+        np.testing.assert_allclose(translation_derivatives[index], (translation_plus - translation_minus) / 2e-4, atol=1e-7)
+
+
+def test_objective_gradient_matches_finite_differences():
+    register = register_two_subjects.RegisterTractography()
+    register.fixed = _fiber_arrays(200, 0)
+    register.moving = _fiber_arrays(50, 0)[:, :, :] + 2.0
+    register.sigma = 20
+    x = _random_transform(5)
+
+    obj, gradient = register.objective_function_and_gradient(x)
+    np.testing.assert_allclose(obj, register.objective_function(x), rtol=1e-10)
+    for index in range(15):
+        step = np.zeros(15)
+        step[index] = 1e-4
+        numeric = (register.objective_function(x + step) - register.objective_function(x - step)) / 2e-4
+        np.testing.assert_allclose(gradient[index], numeric, rtol=1e-4, atol=1e-4)
+
+
+def test_lbfgs_recovers_translation():
+    fixed = _fiber_arrays(150, 0)
+    register = register_two_subjects.RegisterTractography()
+    register.fixed = fixed
+    register.moving = fixed - np.array([4.0, -3.0, 2.0])[:, np.newaxis, np.newaxis]
+    register.sigma = 10
+    register.mode = [1, 1, 0, 0]
+    register.optimizer = "LBFGS"
+    register.maxfun = 100
+    transform = register.compute()
+    np.testing.assert_allclose(transform[0:3], [4.0, -3.0, 2.0], atol=0.05)
+    np.testing.assert_allclose(transform[3:6], 0, atol=0.05)
+
+
+def test_truncated_objective_approximates_exact():
+    fixed = _fiber_arrays(400, 0)
+    moving = _fiber_arrays(100, 1)
+    moving[:, :5, :] = fixed[:, :5, ::-1]
+
+    for sigma in (5, 10):
+        exact = register_two_subjects.inner_loop_objective(fixed, moving, sigma * sigma)
+        # with no truncation in practice, all pairs are compared
+        untruncated = register_two_subjects.TruncatedObjective(fixed, sigma * sigma, truncation_sigmas=100)
+        np.testing.assert_allclose(untruncated(moving), exact, rtol=1e-9)
+
+        objective = register_two_subjects.TruncatedObjective(fixed, sigma * sigma, block_pairs=1000)
+        approximate, exact2, relative_error = objective.approximation_error(moving)
+        assert exact2 == exact
+        assert relative_error < 1e-3
+        assert objective.compared_pairs < moving.shape[1] * fixed.shape[1]
+
+
+def test_truncated_objective_reuses_neighbors():
+    fixed = _fiber_arrays(400, 0)
+    moving = _fiber_arrays(100, 1)
+    objective = register_two_subjects.TruncatedObjective(fixed, 25.0)
+
+    objective(moving)
+    # small moves reuse the neighbour search, large moves refresh it
+    objective(moving + 0.5 * objective.margin)
+    assert objective.searches == 1
+    moved = moving + 2.0 * objective.margin
+    approximate = objective(moved)
+    assert objective.searches == 2
+    np.testing.assert_allclose(approximate, register_two_subjects.inner_loop_objective(fixed, moved, 25.0), rtol=1e-3)
+
+
+def test_approximate_registration_recovers_translation():
+    fixed = _fiber_arrays(300, 0)
+    register = register_two_subjects.RegisterTractography()
+    register.fixed = fixed
+    register.moving = fixed[:, ::2, :] - np.array([3.0, -2.0, 1.0])[:, np.newaxis, np.newaxis]
+    register.sigma = 5
+    register.mode = [1, 0, 0, 0]
+    register.approximate = True
+    register.maxfun = 200
+    register.initial_step = 2
+    register.final_step = 0.1
+    transform = register.compute()
+    np.testing.assert_allclose(transform[:3], [3.0, -2.0, 1.0], atol=0.3)
+    assert register.truncated_objective.searches >= 1
+
+
+def test_objective_memo_lru_and_rounding():
+    memo = register_two_subjects.ObjectiveMemo(max_size=2)
+    memo.put([0.0, 1.0], 5.0)
+    memo.put([1.0, 1.0], 6.0)
+    assert memo.get([-0.0, 1.0]) == 5.0
+    # [1, 1] is now least recently used
+    memo.put([2.0, 1.0], 7.0)
+    assert memo.get([1.0, 1.0]) is None
+    assert memo.get([0.0, 1.0]) == 5.0
+    assert (memo.hits, memo.misses) == (2, 1)
+
+    rounded = register_two_subjects.ObjectiveMemo(decimals=3)
+    rounded.put([0.1, 0.2], 1.0)
+    assert rounded.get([0.1000001, 0.2]) == 1.0
+    assert rounded.get([0.101, 0.2]) is None
+
+
+def test_memoized_objective_matches_evaluation():
+    fixed = _fiber_arrays(100, 0)
+    register = register_two_subjects.RegisterTractography()
+    register.fixed = fixed
+    register.moving = fixed[:, ::2, :] + 1.0
+    register.reset_objective_memo()
+    x = np.multiply(register.initial_transform, register.transform_scaling).astype(float)
+
+    obj = register.objective_function(x)
+    assert register.objective_function(x.copy()) == obj
+    assert obj == register_two_subjects.inner_loop_objective(fixed, register_two_subjects.transform_fiber_array_numpy(register.moving, x), register.sigma * register.sigma)
+    # every call is recorded, including those answered by the memo
+    assert register.objective_function_values == [obj, obj]
+    assert register.objective_memo.hits == 1
+
+
+def test_truncated_objective_gradient():
+    fixed = _fiber_arrays(400, 0)
+    moving = _fiber_arrays(100, 1)
+    moving[:, :5, :] = fixed[:, :5, ::-1]
+    exact, exact_gradient = register_two_subjects.inner_loop_objective_and_gradient(fixed, moving, 100.0)
+
+    untruncated = register_two_subjects.TruncatedObjective(fixed, 100.0, truncation_sigmas=100)
+    obj, gradient = untruncated.objective_and_gradient(moving)
+    np.testing.assert_allclose(obj, exact, rtol=1e-9)
+    np.testing.assert_allclose(gradient, exact_gradient, rtol=1e-7, atol=1e-12)
+
+    objective = register_two_subjects.TruncatedObjective(fixed, 100.0)
+    obj, gradient = objective.objective_and_gradient(moving)
+    assert obj == objective(moving)
+    np.testing.assert_allclose(gradient, exact_gradient, atol=1e-3 * np.max(np.abs(exact_gradient)))
+
+
+def test_approximate_lbfgs_uses_truncated_objective_and_memo():
+    fixed = _fiber_arrays(300, 0)
+    register = register_two_subjects.RegisterTractography()
+    register.fixed = fixed
+    register.moving = fixed[:, ::2, :] - np.array([3.0, -2.0, 1.0])[:, np.newaxis, np.newaxis]
+    register.sigma = 5
+    register.mode = [1, 0, 0, 0]
+    register.optimizer = "LBFGS"
+    register.approximate = True
+    register.maxfun = 100
+    transform = register.compute()
+    np.testing.assert_allclose(transform[:3], [3.0, -2.0, 1.0], atol=0.3)
+    # the final report evaluates the truncated objective once more
+    assert register.truncated_objective.evaluations == len(register.objective_function_values) - register.objective_memo.hits + 1
+
+    # the optimizer started from the initial transform
+    hits = register.objective_memo.hits
+    x = np.multiply(register.initial_transform, register.transform_scaling).astype(float)
+    register.objective_function_and_gradient(x)
+    assert register.objective_memo.hits == hits + 1
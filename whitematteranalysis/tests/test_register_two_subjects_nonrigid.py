@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from whitematteranalysis import register_two_subjects_nonrigid as nonrigid
+
+
+def test_convert_numpy_array_to_vtk_points():
+    points = nonrigid.convert_numpy_array_to_vtk_points([1, 2, 3, 4, 5, 6])
+    assert points.GetNumberOfPoints() == 2
+    assert points.GetPoint(1) == (4.0, 5.0, 6.0)
+
+
+def test_transform_fiber_array_matches_vtk():
+    rng = np.random.default_rng(0)
+    register = nonrigid.RegisterTractographyNonrigidThinPlateSplines()
+    source_landmarks = np.array(register.target_landmarks, dtype=float) + rng.normal(0, 5, len(register.target_landmarks))
+    fibers = rng.uniform(-150, 150, (3, 30, 15))
+
+    vtktrans = nonrigid.convert_transform_to_vtk(source_landmarks, register.target_points)
+    expected = np.zeros(fibers.shape)
+    for lidx in range(fibers.shape[1]):
+        for pidx in range(fibers.shape[2]):
+            expected[:, lidx, pidx] = vtktrans.TransformPoint(fibers[:, lidx, pidx])
+
+    np.testing.assert_allclose(register.transform_fiber_array_numpy(fibers, source_landmarks), expected, atol=1e-6)
+
+    # small blocks and single precision kernel
+    register.block_pairs = 100
+    register.float32 = True
+    np.testing.assert_allclose(register.transform_fiber_array_numpy(fibers, source_landmarks), expected, atol=1e-2)
+
+
+def test_objective_function_uses_memo():
+    rng = np.random.default_rng(1)
+    register = nonrigid.RegisterTractographyNonrigidThinPlateSplines()
+    register.fixed = rng.uniform(-60, 60, (3, 40, 10))
+    register.moving = register.fixed[:, ::2, :] + 1.0
+    register.final_transform = np.zeros(register.initial_transform.shape)
+    register.reset_objective_memo()
+    x = register.initial_transform.astype(float)
+
+    obj = register.objective_function(x)
+    assert register.objective_function(x.copy()) == obj
+    assert obj == register._evaluate_objective(x)
+    # every call is recorded and tracked, including those answered by the memo
+    assert register.objective_function_values == [obj, obj]
+    assert register.minimum_objective == obj
+    assert (register.objective_memo.hits, register.objective_memo.misses) == (1, 1)
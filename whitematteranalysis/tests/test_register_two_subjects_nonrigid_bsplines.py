@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from whitematteranalysis import \
+    register_two_subjects_nonrigid_bsplines as bsplines
+
+
+def test_bspline_coefficients_match_vtk():
+    from vtk.util import numpy_support
+
+    rng = np.random.default_rng(0)
+    for dims in (3, 6, 10):
+        transform = rng.normal(0, 3, dims ** 3 * 3)
+        vtktrans = bsplines.convert_transform_to_vtk(transform)
+        vtk_coefficients = numpy_support.vtk_to_numpy(vtktrans.GetCoefficientData().GetPointData().GetScalars())
+        np.testing.assert_allclose(bsplines.bspline_coefficients(transform).reshape(-1, 3), vtk_coefficients, atol=1e-4)
+
+
+def test_transform_fiber_array_matches_vtk():
+    rng = np.random.default_rng(1)
+    register = bsplines.RegisterTractographyNonrigid()
+    for dims in (4, 6):
+        transform = rng.normal(0, 5, dims ** 3 * 3)
+        # points inside the grid, near its border, and outside its support
+        fibers = rng.uniform(-160, 160, (3, 40, 15))
+        fibers[:, 0, :] = -100
+        fibers[:, 1, :] = 100
+        out_array = register.transform_fiber_array_numpy(fibers, transform)
+
+        vtktrans = bsplines.convert_transform_to_vtk(transform)
+        expected = np.zeros(fibers.shape)
+        for lidx in range(fibers.shape[1]):
+            for pidx in range(fibers.shape[2]):
+                expected[:, lidx, pidx] = vtktrans.TransformPoint(fibers[:, lidx, pidx])
+        np.testing.assert_allclose(out_array, expected, atol=1e-4)
+
+        # the cached spline weights of these fibers give the transform of the next evaluation
+        transform2 = rng.normal(0, 5, dims ** 3 * 3)
+        vtktrans2 = bsplines.convert_transform_to_vtk(transform2)
+        np.testing.assert_allclose(register.transform_fiber_array_numpy(fibers, transform2)[:, 7, 3],
+                                   vtktrans2.TransformPoint(fibers[:, 7, 3]), atol=1e-4)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from whitematteranalysis import cluster, fibers, shared, similarity
+
+
+def test_shared_arrays_attach_and_close(tmp_path):
+    array = np.arange(3 * 100 * 15, dtype=float).reshape(3, 100, 15)
+    with shared.SharedArrays(directory=str(tmp_path)) as shared_arrays:
+        handle = shared_arrays.add('fibers', array)
+        assert 'fibers' in shared_arrays
+        assert shared_arrays['fibers'] is handle
+        with pytest.raises(KeyError):
+            shared_arrays.add('fibers', array)
+
+        # only the handle is pickled for a worker
+        copy = pickle.loads(pickle.dumps(handle))
+        assert len(pickle.dumps(handle)) < array.nbytes
+        attached = copy.attach()
+        np.testing.assert_array_equal(attached, array)
+        assert not attached.flags.writeable
+        assert (handle.shape, handle.dtype) == (array.shape, array.dtype)
+        directory = shared_arrays.directory
+
+    assert not os.path.exists(directory)
+
+
+def test_pairwise_distance_matrix_matches_fiber_distance(make_polydata):
+    pd = make_polydata(number_of_lines=30)
+    distances = cluster._pairwise_distance_matrix(pd, 0.0, number_of_jobs=1, bilateral=True)
+
+    fiber_array = fibers.FiberArray()
+    fiber_array.convert_from_polydata(pd, points_per_fiber=15)
+    expected = np.array([similarity.fiber_distance(fiber_array.get_fiber(lidx), fiber_array, 0.0, distance_method='Hausdorff', bilateral=True)
+                         for lidx in range(fiber_array.number_of_fibers)])
+    np.testing.assert_array_equal(distances, expected)